@@ -20,13 +20,13 @@ import numpy as np
 import pandas as pd
 import seaborn as sns
 import matplotlib.pyplot as plt
-from tqdm import tqdm, trange
+from tqdm import trange
 
 from src.Analysis.Utils.funcs import compute_direction
 from src.Analysis.data_loader import DataLoader
-from src.Helpers.Fitness.ValueGraphFitness import convert, MAX_FITNESS
+from src.Helpers.Fitness.FitnessLandscape import convert, MAX_FITNESS
 from src.Settings.args import args
-from src.Utils.Funcs import compute_fintess_trajectory
+from src.Utils.Funcs import compute_fintess_trajectories
 
 
 class AstarFitnessAnalyser(DataLoader):
@@ -46,21 +46,22 @@ class AstarFitnessAnalyser(DataLoader):
                                    "d_to_m_pt", "d_to_end_p", "direction",
                                    "no_overlapping"])
 
+        # all the trajectories in one ragged batch, the ones from the same starting point one after the other
+        number_behaviours = len(self._paths_generated)
+        all_the_trajectories = [self._paths_generated[j][i] for i in range(args.n_tra_generated)
+                                for j in range(number_behaviours)]
+        offsets = np.concatenate(([0], np.cumsum([len(tra) for tra in all_the_trajectories]))).astype(np.int64)
+        coordinates = np.array([[p.x, p.y] for tra in all_the_trajectories for p in tra]).reshape(-1, 2)
+        # get the fitness of all the trajectories
+        all_the_fitness, all_the_behaviours = compute_fintess_trajectories(coordinates=coordinates, offsets=offsets)
+        self._log.info("Fitness of {} trajectories computed".format(len(all_the_trajectories)))
+
         for i in range(args.n_tra_generated):
-            # make the trajectories readable
-            current_analysed = []
-            for j in range(len(self._paths_generated)):
-                tra_points = self._paths_generated[j][i]
-
-                current_analysed.append(tra_points)
-
-            # get the fitness of all the trajectories
-            fitness_trajectories = []
-            behaviours = []
-            for tra in tqdm(current_analysed, desc="computing fitness tra {}".format(i)):
-                out, behaviour = compute_fintess_trajectory(tra_moved_so_far=tra)
-                fitness_trajectories.append(out)
-                behaviours.append(np.array(behaviour))
+            first = i * number_behaviours
+            last = first + number_behaviours
+            current_analysed = all_the_trajectories[first:last]
+            fitness_trajectories = all_the_fitness[first:last]
+            behaviours = all_the_behaviours[first:last]
 
             # get more info from the trajectories generated
             values_of_same_elements = []
@@ -33,7 +33,7 @@ class PrintTrajectories(DataLoader):
         super().__init__(log)
 
         self._loader_apf = LoadAPF(path=args.data_path + args.apf_name, logger=self._log)
-        self._loader_apf.load_apf_only_routing_system()
+        self._loader_apf.load_raster()
 
     def print_paths(self, path=None, name=None, apf=False):
         """
@@ -82,7 +82,7 @@ class PrintTrajectories(DataLoader):
 
                     for j in range(real_min_x, real_max_x):
                         for q in range(real_min_y, real_max_y):
-                            value = self._loader_apf.apf.iloc[j, q]
+                            value = self._loader_apf.values.item(j, q)
                             matrix_pos_x = j - real_min_x
                             matrix_pos_y = q - real_min_y
                             if "{}-{}".format(j, q) in combinations:
@@ -15,57 +15,310 @@ GNU General Public License for more details.
 You should have received a copy of the GNU General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
-import heapq
+import time
 
-from haversine import haversine
+import numpy as np
 
-from src.Utils.Funcs import list_neighbours, compute_charge_points, compute_fintess_trajectory
+from src.Astar.OpenList import create_open_list, BUCKET_WIDTH, BEAM_KEEP
+from src.Utils.Funcs import list_neighbours, compute_charge_points, TrajectoryFeatures, list_neighbours_vectorised, \
+    compute_step_costs, get_step_cost
+from src.Utils.Point import Point
 
 
-class Node(object):
-    """A node class for A* Pathfinding"""
+class NodeStore(object):
+    """
+    Nodes of the A* stored as struct of arrays.
+    A node is an integer index in the arrays, which keep the flat index of its cell (x * width + y),
+    the index of the parent node (-1 for the start), g and f.
+    The arrays double their size when they are full. The nodes removed (remove) leave their slot to the next
+    nodes added
+    """
+    def __init__(self, width, capacity=1024):
+        self.width = width
+        self.size = 0
+        self.cell = np.empty(capacity, dtype=np.int64)
+        self.parent = np.empty(capacity, dtype=np.int32)
+        self.g = np.empty(capacity, dtype=np.float64)  # distance from start
+        self.f = np.empty(capacity, dtype=np.float64)  # total cost cell
+        # features of the path from the start, only for the fitness based A*
+        self.features = []
+        # slots of the nodes removed
+        self._free = []
+
+    def __len__(self):
+        return self.size
+
+    def _grow(self, needed):
+        capacity = len(self.cell)
+        while capacity < needed:
+            capacity *= 2
+        for name in ("cell", "parent", "g", "f"):
+            old = getattr(self, name)
+            new = np.empty(capacity, dtype=old.dtype)
+            new[:self.size] = old[:self.size]
+            setattr(self, name, new)
+
+    def add(self, cell, parent, g, f):
+        """
+        Add one node
+        :param cell: flat index of the cell
+        :param parent: index of the parent node, -1 for the start
+        :param g: distance from start
+        :param f: total cost
+        :return: index of the node
+        """
+        if len(self._free) > 0:
+            index = self._free.pop()
+        else:
+            if self.size == len(self.cell):
+                self._grow(needed=self.size + 1)
+            index = self.size
+            self.features.append(None)
+            self.size += 1
+        self.cell[index] = cell
+        self.parent[index] = parent
+        self.g[index] = g
+        self.f[index] = f
+        return index
+
+    def add_many(self, cells, parent, g, f):
+        """
+        Add the children of the same node
+        :param cells: array of flat indexes of the cells
+        :param parent: index of the parent node
+        :param g: array of distances from start
+        :param f: array of total costs
+        :return: range (or list, if slots of removed nodes are used) of the indexes of the nodes
+        """
+        number = len(cells)
+        if len(self._free) > 0:
+            reused = min(number, len(self._free))
+            indexes = self._free[len(self._free) - reused:][::-1]
+            del self._free[len(self._free) - reused:]
+            indexes.extend(self.add(cell=0, parent=parent, g=0, f=0) for _ in range(number - reused))
+            self.cell[indexes] = cells
+            self.parent[indexes] = parent
+            self.g[indexes] = g
+            self.f[indexes] = f
+            return indexes
+        if self.size + number > len(self.cell):
+            self._grow(needed=self.size + number)
+        start = self.size
+        self.cell[start:start + number] = cells
+        self.parent[start:start + number] = parent
+        self.g[start:start + number] = g
+        self.f[start:start + number] = f
+        self.features.extend([None] * number)
+        self.size += number
+        return range(start, start + number)
+
+    def remove(self, indexes):
+        """
+        Forget nodes without children (the cells pruned from the open list), their slots are used again by add
+        :param indexes: indexes of the nodes
+        :return:
+        """
+        for index in indexes:
+            self.features[index] = None
+        self._free.extend(indexes)
+
+    def get_position(self, index):
+        """
+        :param index: index of the node
+        :return: x and y of the cell of the node
+        """
+        return divmod(self.cell.item(index), self.width)
+
+    def get_path_cells(self, index):
+        """
+        Flat indexes of the cells from the start to the node, following the parent indexes
+        :param index: index of the last node
+        :return: array of flat indexes
+        """
+        indexes = []
+        parent = self.parent
+        while index >= 0:
+            indexes.append(index)
+            index = parent.item(index)
+        return self.cell[indexes[::-1]]
+
+    def get_path(self, index):
+        """
+        Cells from the start to the node, following the parent indexes
+        :param index: index of the last node
+        :return: int32 matrix N x 2 with x and y of the cells
+        """
+        cells = self.get_path_cells(index=index)
+        return np.stack(np.divmod(cells, self.width), axis=1).astype(np.int32)
+
+
+class FlatCellMap(object):
+    """
+    Replacement for the dictionaries used by the A* to keep track of the open and closed cells.
+    Cells are keyed by their flat index (x * width + y) and membership and values are stored in numpy arrays
+    sized to the APF.
+    The arrays are allocated with np.zeros, so only the memory pages touched by the search are actually used
+    """
+    def __init__(self, shape, with_values=True):
+        size = shape[0] * shape[1]
+        self._present = np.zeros(size, dtype=bool)
+        self._values = np.zeros(size, dtype=np.float64) if with_values else None
+
+    def get(self, key, default=None):
+        """
+        Same behaviour of dict.get
+        :param key: flat index of the cell
+        :param default: value returned if the cell is not present
+        :return: value stored (True if the map does not store values) or default
+        """
+        if self._present[key]:
+            return self._values[key] if self._values is not None else True
+        return default
+
+    def __setitem__(self, key, value):
+        self._present[key] = True
+        if self._values is not None:
+            self._values[key] = value
+
+    def __delitem__(self, key):
+        self._present[key] = False
+
+    def contains(self, keys):
+        """
+        Vectorised membership
+        :param keys: array of flat indexes
+        :return: boolean array
+        """
+        return self._present[keys]
+
+
+def _contains(cell_map, keys):
+    """
+    Vectorised membership for both FlatCellMap and dictionaries
+    :param cell_map: FlatCellMap or dict
+    :param keys: array of flat indexes or list of string keys
+    :return: boolean array
+    """
+    if isinstance(cell_map, FlatCellMap):
+        return cell_map.contains(keys=keys)
+    return np.array([cell_map.get(key, None) is not None for key in keys], dtype=bool)
 
-    def __init__(self, parent=None, position=None):
-        self.parent = parent
-        self.position = position
 
-        self.g = 0  # distance from start
-        self.h = 0  # estimate distance from end
-        self.f = 0  # total cost cell
-        self.id = self.position.to_key()
+def _update_report(report, **values):
+    """
+    Save the statistics of the search in the report, if the caller asked for it
+    :param report: dictionary or None
+    :param values: statistics
+    :return:
+    """
+    if report is not None:
+        report.update(values)
 
-    def __eq__(self, other):
-        return self.position == other.position
 
-    def __str__(self):
-        return "{}, {}. g={}; h={}; f={}, parent={},{}".format(self.position.x, self.position.y, self.g, self.h, self.f,
-                                                               self.parent.position.x if self.parent is not None else 0
-                                                               , self.parent.position.y if
-                                                               self.parent is not None else 0)
+def _cell_key(x, y, width):
+    """
+    Key of the cell in the open and closed lists
+    :param x: x value
+    :param y: y value
+    :param width: width of the APF if the flat index is used, None otherwise
+    :return: flat index or "x-y" string
+    """
+    return x * width + y if width is not None else "{}-{}".format(x, y)
 
-    def __lt__(self, other):
-        return self.f < other.f
 
+def _overlap(cells, other_cells):
+    """
+    Fraction of the cells of a path that are also in another path
+    :param cells: flat indexes of the cells of the path
+    :param other_cells: flat indexes of the cells of the other path
+    :return: overlap between 0 and 1
+    """
+    return np.count_nonzero(np.isin(cells, other_cells)) / len(cells)
 
-def return_best_path_so_far(current_node):
+
+def return_best_path_so_far(node_store, index):
     """
     As the name of the method say, return the best path so far
-    :param current_node: current node
+    :param node_store: nodes of the search
+    :param index: index of the current node
     :return: path beginning to now
     """
-    path = []
-    current = current_node
-    while current is not None:
-        path.append(current.position)
-        current = current.parent
-    # print(open_queue)
-    # print(closed_list)
-    # print(path)
-    return path[::-1]  # Return reversed path
+    return [Point(x, y) for x, y in node_store.get_path(index=index).tolist()]
+
+
+def _generate_children_batch(x, y, current_g, apf, width, closed_list, second_open_queue, distance_target, genome,
+                             step_costs, K, pre_matrix, x_value, type_astar, fitness_so_far, charge_field=None,
+                             corridor=None, neighbour_mask=None):
+    """
+    Generate and evaluate all the children of a node together.
+    Neighbours, road check, step distances, charges and heuristic are computed as numpy arrays
+    :param x: x of the cell expanded
+    :param y: y of the cell expanded
+    :param current_g: g of the node expanded
+    :param apf: shape of the APF
+    :param width: width of the APF if the flat index is used, None otherwise
+    :param closed_list: closed cells
+    :param second_open_queue: open cells
+    :param distance_target: distance from the target (total length trip)
+    :param genome: genome
+    :param step_costs: length of the steps per row and direction
+    :param K: constant for computing charge
+    :param pre_matrix: pre computation of distance from the cell to the objects
+    :param x_value: distance where the distance to the end starts to count
+    :param type_astar: typology of the astar wanted
+    :param fitness_so_far: fitness of the path moved so far
+    :param charge_field: charge field of the genome (ChargeField or ChargeMemo).
+    If None, the charges are computed on pre_matrix
+    :param corridor: only the children inside the corridor (Corridor) are generated, None for no limit
+    :param neighbour_mask: NeighbourMask to find the neighbours on a road, None to check them on pre_matrix
+    :return: x, y, keys in the open list, g and f of the children to add to the open list,
+    in the same order of the non batch version
+    """
+    if neighbour_mask is not None:
+        # the mask gives only the neighbours on a road
+        xs, ys, directions = neighbour_mask.get_neighbours(x=x, y=y)
+        on_the_street = np.ones(len(xs), dtype=bool)
+    else:
+        xs, ys, directions = list_neighbours_vectorised(x_value=x, y_value=y, apf=apf)
+        on_the_street = pre_matrix.check_if_on_a_road(xs=xs, ys=ys)
+    if corridor is not None:
+        on_the_street &= corridor.contains(xs=xs, ys=ys)
+    xs = xs[on_the_street]
+    ys = ys[on_the_street]
+    directions = directions[on_the_street]
+
+    if width is not None:
+        keys = xs * width + ys
+    else:
+        keys = ["{}-{}".format(x, y) for x, y in zip(xs, ys)]
+    new_cells = ~(_contains(cell_map=closed_list, keys=keys) | _contains(cell_map=second_open_queue, keys=keys))
+    xs = xs[new_cells]
+    ys = ys[new_cells]
+    directions = directions[new_cells]
+    if width is not None:
+        keys = keys[new_cells].tolist()
+    else:
+        keys = [key for key, new_cell in zip(keys, new_cells) if new_cell]
+
+    r = step_costs[x, directions]  # in metres
+    g = current_g + r
+    distance_to_end = distance_target - g
+    if charge_field is not None:
+        charges = charge_field.get_charges(xs=xs, ys=ys)
+    else:
+        charges = pre_matrix.return_charge_from_points(xs=xs, ys=ys, genome=genome, K=K)
+    h = np.abs(_compute_h_from_charge(distance_to_end=distance_to_end, charge=charges, x_value=x_value,
+                                      type_astar=type_astar, fitness_so_far=fitness_so_far))
+    total_g_normalised = _standard_normalisation(old_value=g, old_min=0, old_max=distance_target + 100,
+                                                 new_min=0, new_max=10)
+    f = -(total_g_normalised + h)
+    return xs, ys, keys, g, f
 
 
 def astar(apf, start, distance_target, genome, values_matrix, K, pre_matrix, x_value,
-          type_astar):
+          type_astar, index_type="flat", batch=True, step_costs=None, charge_field=None, open_list="heap",
+          bucket_width=BUCKET_WIDTH, max_open_size=None, max_expansions=None, max_time=None, k_paths=1,
+          max_overlap=1.0, corridor=None, neighbour_mask=None, report=None):
     """
     Returns a list of tuples as a path from the given start to the given end in the given maze
     This is a normal a star algorithm is supposed to work
@@ -73,154 +326,258 @@ def astar(apf, start, distance_target, genome, values_matrix, K, pre_matrix, x_v
     The current version does not know the destination point
     It only knows the distance from the destination point
 
+    If distance_target is a sorted list, one search returns one path per distance: the path of a distance is the
+    one to the first cell expanded with g over it. The whole search is guided by the heuristic of the longest
+    distance: only its path is the one of a separate search, the paths of the shorter distances are the ones found
+    under that heuristic and usually differ from the ones of separate searches for them
+
+    If k_paths > 1, the search does not stop at the first cell reaching the target: the cells reaching it are not
+    expanded and their paths are kept, in order of f, if they share at most max_overlap of their cells with every
+    path already kept, until k_paths paths are found
+
     :param apf: matrix representing the routing system of the area
     :param start: starting point
-    :param distance_target: distance from the target (total length trip)
+    :param distance_target: distance from the target (total length trip), or sorted list of distances
     :param genome: genome
     :param values_matrix: values to translate cells to coordinates
     :param K: constant for computing charge
     :param pre_matrix: pre computation of distance from the cell to the objects
     :param type_astar: typology of the astar wanted
+    :param index_type: "flat" keeps open and closed cells in arrays indexed by x * width + y,
+    "string" keeps them in dictionaries indexed by "x-y"
+    :param batch: evaluate all the children of a node together with numpy
+    :param step_costs: length of the steps per row and direction (compute_step_costs).
+    If None, it is computed from values_matrix
+    :param charge_field: charge field of the genome (ChargeField or ChargeMemo).
+    If None, the charges are computed on pre_matrix
+    :param open_list: typology of the open list ("heap" or "bucket", see OpenList) or an empty open list
+    :param bucket_width: width of the buckets of f for the "bucket" open list
+    :param max_open_size: maximum number of cells in the open list. When it is exceeded, only the
+    BEAM_KEEP * max_open_size cells with the best f are kept (beam search) and the nodes of the others are
+    forgotten. If the open list empties after pruning, the path to the cell expanded with the highest g is
+    returned. None for no limit
+    :param max_expansions: maximum number of cells expanded. None for no limit
+    :param max_time: maximum time of the search in seconds. None for no limit
+    When a budget is finished, the path to the cell expanded with the highest g is returned
+    :param k_paths: number of paths to return (only with one distance target)
+    :param max_overlap: maximum fraction of the cells of a path shared with any other path returned (only k_paths > 1)
+    :param corridor: the search moves only inside the corridor (Corridor, see plan_corridor), None for no limit
+    :param neighbour_mask: NeighbourMask built on the roads of pre_matrix to find the neighbours on a road,
+    None to check them on pre_matrix
+    :param report: dictionary filled with the statistics of the search ("pruned": number of cells pruned,
+    "expanded": number of cells expanded, "truncated": True if a budget finished, or the open list emptied after
+    pruning, before reaching the target)
+    :return: path, or list of paths if distance_target is a list (None for the targets not reached) or k_paths > 1
+    (fewer than k_paths if the search finishes before)
     """
+    multiple_targets = isinstance(distance_target, (list, tuple))
+    targets = list(distance_target) if multiple_targets else [distance_target]
+    if len(targets) == 0 or targets != sorted(targets):
+        raise ValueError("The distance targets must be a non empty sorted list")
+    if k_paths > 1 and multiple_targets:
+        raise ValueError("k_paths can be used only with one distance target")
+    if neighbour_mask is not None and neighbour_mask.fingerprint != pre_matrix.get_road_fingerprint():
+        raise ValueError("The neighbour mask is not built on the roads of pre_matrix")
+    distance_target = targets[-1]
+    paths = []
+    # cells of the paths kept, only for k_paths > 1
+    paths_cells = []
+
     # make x_value a percentege of the total distance target
     x_value = (distance_target * x_value) / 100
 
     # end_node = Node(parent=None, position=end_point)
     # if it takes too long, going to stop it
-    # start_time = time.time()
+    start_time = time.time()
     # Create start and end node
-    start_node = Node(parent=None, position=start)
-    start_node.g = start_node.h = start_node.f = 0
+    if index_type == "flat":
+        width = apf[1]
+    elif index_type == "string":
+        width = None
+    else:
+        raise ValueError("Index type requested not implemented")
+    if type_astar != 0 and type_astar != 1:
+        raise Exception("astar typology not implemented")
+    if step_costs is None:
+        step_costs = compute_step_costs(values_matrix=values_matrix)
+    node_store = NodeStore(width=apf[1])
+    start_index = node_store.add(cell=start.x * apf[1] + start.y, parent=-1, g=0, f=0)
+    if type_astar == 1:
+        node_store.features[start_index] = TrajectoryFeatures(start=start)
 
     # Initialize both open and closed list
     # open_list = []
-    open_queue = []
-    second_open_queue = {}
-    closed_list = {}
+    if isinstance(open_list, str):
+        open_queue = create_open_list(typology=open_list, bucket_width=bucket_width)
+    else:
+        open_queue = open_list
+    if width is not None:
+        second_open_queue = FlatCellMap(shape=apf)
+        closed_list = FlatCellMap(shape=apf, with_values=False)
+    else:
+        second_open_queue = {}
+        closed_list = {}
 
     # Add the start node
     # open_list.append(start_node)
-    heapq.heappush(open_queue, (start_node.f, start_node))
-    second_open_queue.update({start_node.id: 0})
+    open_queue.push(0, start_index)
+    second_open_queue[_cell_key(x=start.x, y=start.y, width=width)] = 0
+    pruned = 0
+    expanded = 0
+    # node with the highest g expanded so far, for the partial path when a budget finishes
+    best_index = start_index
+    best_g = 0
 
     # Loop until you find the end
     while len(open_queue) > 0:
+        if max_open_size is not None and len(open_queue) > max_open_size:
+            # the cells pruned are forgotten, they can be reached again later
+            removed = open_queue.prune(size=int(max_open_size * BEAM_KEEP))
+            for index in removed:
+                x, y = node_store.get_position(index=index)
+                del second_open_queue[_cell_key(x=x, y=y, width=width)]
+            # the nodes in the open list have no children yet
+            node_store.remove(indexes=removed)
+            pruned += len(removed)
 
         # Get the current node
-        # current_node = open_list[0]
-        # current_index = 0
-        # for index, item in enumerate(open_list):
-        #     if item.f < current_node.f:
-        #         current_node = item
-        #         current_index = index
-        current_node = heapq.heappop(open_queue)[1]
-        del second_open_queue[current_node.id]
-
-        # with open("a_star_{}.txt".format(LoadConfigs.configurations["name_exp"]), "a") as myfile:
-        #     myfile.write("current node -> {} \n".format(current_node))
+        current_index = open_queue.pop()
+        current_g = node_store.g.item(current_index)
+        x, y = node_store.get_position(index=current_index)
+        current_key = _cell_key(x=x, y=y, width=width)
+        del second_open_queue[current_key]
 
         # Pop current off open list, add to closed list
-        # open_list.pop(current_index)
-        # closed_list.add(current_node)
-        closed_list[current_node.id] = ""
-
-        # current_time = time.time()
-        # time_from_start = current_time - start_time  # time in seconds
-        # block execution astar after 10 minutes -> hardcoded function
-
-        # end = False
-        # if time_from_start >= 300:
-        #     end = True
-        # find the bigger node.g
-        # max_id = max(second_open_queue.items(), key=operator.itemgetter(1))[0]
-        #
-        # for el in open_queue:
-        #     if el[1].id == max_id:
-        #         current_node = el[1]
-        #         break
-        # distance_target = current_node.g - 10
+        closed_list[current_key] = ""
 
         # Found the goal
         # on the cuxrrent node, the distance from the start is saved as g
         # so if the distance from the start is equals to distance_target then I found the goal
-        # if current_node.id == end_node.id: # or end:
-        if current_node.g >= distance_target:
-            # with open("a_star_{}.txt".format(LoadConfigs.configurations["name_exp"]), "a") as myfile:
-            #     myfile.write("closed list {}, open list {} \n".format(len(closed_list), len(second_open_queue)))
-            #     myfile.write("------------------ \n")
-            #     myfile.write("------------------ \n")
-            #     myfile.write("------------------ \n")
-
-            return return_best_path_so_far(current_node=current_node)
+        if k_paths > 1 and current_g >= distance_target:
+            cells = node_store.get_path_cells(index=current_index)
+            if all(_overlap(cells=cells, other_cells=other_cells) <= max_overlap for other_cells in paths_cells):
+                paths_cells.append(cells)
+                paths.append(return_best_path_so_far(node_store=node_store, index=current_index))
+                if len(paths) == k_paths:
+                    _update_report(report=report, pruned=pruned, expanded=expanded, truncated=False)
+                    return paths
+            # the cells reaching the target are not expanded
+            continue
+        while k_paths == 1 and current_g >= targets[len(paths)]:
+            paths.append(return_best_path_so_far(node_store=node_store, index=current_index))
+            if len(paths) == len(targets):
+                _update_report(report=report, pruned=pruned, expanded=expanded, truncated=False)
+                return paths if multiple_targets else paths[0]
+
+        if current_g > best_g:
+            best_index = current_index
+            best_g = current_g
+        if (max_expansions is not None and expanded >= max_expansions) or \
+                (max_time is not None and time.time() - start_time >= max_time):
+            _update_report(report=report, pruned=pruned, expanded=expanded, truncated=True)
+            return _truncated_paths(node_store=node_store, best_index=best_index, paths=paths, targets=targets,
+                                    k_paths=k_paths, multiple_targets=multiple_targets)
+        expanded += 1
+
+        current_position = Point(x, y)
+        # the fitness of the path moved so far is the same for all the children
+        fitness_so_far = None
+        if type_astar == 1:
+            parent_index = node_store.parent.item(current_index)
+            if parent_index >= 0:
+                node_store.features[current_index] = node_store.features[parent_index].extend(
+                    point=current_position)
+            fitness_so_far = node_store.features[current_index].get_fitness()
+
+        if batch:
+            xs, ys, keys, g, f = _generate_children_batch(x=x, y=y, current_g=current_g, apf=apf, width=width,
+                                                          closed_list=closed_list,
+                                                          second_open_queue=second_open_queue,
+                                                          distance_target=distance_target, genome=genome,
+                                                          step_costs=step_costs, K=K, pre_matrix=pre_matrix,
+                                                          x_value=x_value, type_astar=type_astar,
+                                                          fitness_so_far=fitness_so_far, charge_field=charge_field,
+                                                          corridor=corridor, neighbour_mask=neighbour_mask)
+            indexes = node_store.add_many(cells=xs * apf[1] + ys, parent=current_index, g=g, f=f)
+            for index, key, child_g, child_f in zip(indexes, keys, g.tolist(), f.tolist()):
+                open_queue.push(child_f, index)
+                second_open_queue[key] = child_g
+            continue
 
         # Generate children
-        points = list_neighbours(x_value=current_node.position.x, y_value=current_node.position.y, apf=apf)
-        # points_on_the_street = keep_only_points_on_street(apf=pre_matrix.get_apf(), points=points)
-        points_on_the_street = pre_matrix.keep_only_points_on_street(points=points)
-
-        children = [Node(parent=current_node, position=node_position) for node_position in points_on_the_street]
-        # for node_position in points_on_the_street:  # Adjacent squares
-        #
-        #     # Create new node
-        #     new_node = Node(current_node, node_position)
-        #
-        #     # Append
-        #     children.append(new_node)
+        if neighbour_mask is not None:
+            points_on_the_street = neighbour_mask.get_points(x=x, y=y)
+        else:
+            points = list_neighbours(x_value=x, y_value=y, apf=apf)
+            # points_on_the_street = keep_only_points_on_street(apf=pre_matrix.get_apf(), points=points)
+            points_on_the_street = pre_matrix.keep_only_points_on_street(points=points)
+        if corridor is not None and len(points_on_the_street) > 0:
+            inside = corridor.contains(xs=np.array([p.x for p in points_on_the_street]),
+                                       ys=np.array([p.y for p in points_on_the_street]))
+            points_on_the_street = [p for p, p_inside in zip(points_on_the_street, inside) if p_inside]
 
         # Loop through children
-        for child in children:
+        for child_position in points_on_the_street:
+            child_key = _cell_key(x=child_position.x, y=child_position.y, width=width)
             # Child is on the closed list
-            if closed_list.get(child.id, None) is not None:
-                # if child in closed_list:
+            if closed_list.get(child_key, None) is not None:
                 continue
 
             # Child already computed
-            if second_open_queue.get(child.id, None) is not None:
-                # result = list(filter(lambda x: x[1] == child, open_queue))
-                # if len(result) > 0:
+            if second_open_queue.get(child_key, None) is not None:
                 continue
 
             # Create the f, g, and h values
-            r = haversine((values_matrix[0][child.position.x], values_matrix[1][child.position.y]),
-                          (values_matrix[0][current_node.position.x],
-                           values_matrix[1][current_node.position.y])) * 1000  # in metres
-            child.g = current_node.g + r
+            r = get_step_cost(step_costs=step_costs, current_point=current_position,
+                              next_point=child_position)  # in metres
+            child_g = current_g + r
 
             # distance to end is total distance - distance from start
-            distance_to_end = distance_target - child.g
-            # distance_to_end = haversine((values_matrix[0][child.position.x], values_matrix[1][child.position.y]),
-            #                             (values_matrix[0][end_node.position.x],
-            #                              values_matrix[1][end_node.position.y])) * 1000  # in metres
+            distance_to_end = distance_target - child_g
 
-            child.h = abs(_compute_h(distance_to_end=distance_to_end, genome=genome, type_astar=type_astar,
-                                     current_position=child.position, K=K, pre_matrix=pre_matrix, x_value=x_value,
-                                     tra_moved_so_far=return_best_path_so_far(current_node=current_node)
-                                     if type_astar == 1 else None))
+            child_h = abs(_compute_h(distance_to_end=distance_to_end, genome=genome, type_astar=type_astar,
+                                     current_position=child_position, K=K, pre_matrix=pre_matrix, x_value=x_value,
+                                     fitness_so_far=fitness_so_far, charge_field=charge_field))
 
-            total_g_normalised = _standard_normalisation(old_value=child.g, old_min=0, old_max=distance_target + 100,
+            total_g_normalised = _standard_normalisation(old_value=child_g, old_min=0, old_max=distance_target + 100,
                                                          new_min=0, new_max=10)
             # now higher is the most attractive
-            child.f = -(total_g_normalised + child.h)
-            # child.f = -child.h
-
-            # Child is already in the open list
-            # result = list(filter(lambda x: x[1] == child, open_queue))
-            # if len(result) > 0 and child.g > result[0].g:
-            #     continue
-            res = second_open_queue.get(child.id, None)
-            # if res is not None:
-            #     print("S")
-            if res is not None and child.g > res:
-                continue
+            child_f = -(total_g_normalised + child_h)
 
-            # print(child)
             # Add the child to the open list
-            # open_list.append(child)
-            heapq.heappush(open_queue, (child.f, child))
-            second_open_queue.update({child.id: child.g})
-            #
-            # with open("a_star_{}.txt".format(LoadConfigs.configurations["name_exp"]), "a") as myfile:
-            #     myfile.write("kid -> {} \n".format(child))
+            child_index = node_store.add(cell=child_position.x * apf[1] + child_position.y, parent=current_index,
+                                         g=child_g, f=child_f)
+            open_queue.push(child_f, child_index)
+            second_open_queue[child_key] = child_g
+    if pruned > 0:
+        # the cells leading further may have been pruned, the path to the furthest cell is used as for the budgets
+        _update_report(report=report, pruned=pruned, expanded=expanded, truncated=True)
+        return _truncated_paths(node_store=node_store, best_index=best_index, paths=paths, targets=targets,
+                                k_paths=k_paths, multiple_targets=multiple_targets)
+    _update_report(report=report, pruned=pruned, expanded=expanded, truncated=False)
+    if k_paths > 1:
+        return paths
+    if multiple_targets:
+        return paths + [None] * (len(targets) - len(paths))
+
+
+def _truncated_paths(node_store, best_index, paths, targets, k_paths, multiple_targets):
+    """
+    Result of a search stopped before reaching all the targets: the targets not reached get the path to the cell
+    expanded with the highest g
+    :param node_store: nodes of the search
+    :param best_index: node expanded with the highest g
+    :param paths: paths already found
+    :param targets: distance targets
+    :param k_paths: number of paths asked
+    :param multiple_targets: distance_target was a list
+    :return: same output of astar
+    """
+    if k_paths > 1:
+        return paths if len(paths) > 0 else [return_best_path_so_far(node_store=node_store, index=best_index)]
+    best_path = return_best_path_so_far(node_store=node_store, index=best_index)
+    paths.extend([best_path] * (len(targets) - len(paths)))
+    return paths if multiple_targets else paths[0]
 
 
 def _standard_normalisation(old_value, old_min, old_max, new_min, new_max):
@@ -237,7 +594,7 @@ def _standard_normalisation(old_value, old_min, old_max, new_min, new_max):
 
 
 def _compute_h(distance_to_end, genome, current_position, K,
-               pre_matrix, x_value, type_astar, tra_moved_so_far):
+               pre_matrix, x_value, type_astar, fitness_so_far, charge_field=None):
     """
     Custom way to compute the estimation for the distance to the target
     The idea is to have the heart distance to the target divided by the attraction of the cell
@@ -251,19 +608,38 @@ def _compute_h(distance_to_end, genome, current_position, K,
     :param K: constant for the computation of the charge
     :param pre_matrix: pre computation of distance from the cell to the objects
     :param type_astar: typology of the astar wanted
-    :param tra_moved_so_far: trajectory moved so far
+    :param fitness_so_far: fitness of the trajectory moved so far (only for type_astar 1)
+    :param charge_field: charge field of the genome (ChargeField or ChargeMemo).
+    If None, the charge is computed on pre_matrix
     :return: value h needed from the A* algorithm
     """
+    if type_astar != 0 and type_astar != 1:
+        raise Exception("astar typology not implemented")
+    charge = compute_charge_points(genome=genome, current_position=current_position, K=K, pre_matrix=pre_matrix,
+                                   charge_field=charge_field)
+    return _compute_h_from_charge(distance_to_end=distance_to_end, charge=charge, x_value=x_value,
+                                  type_astar=type_astar, fitness_so_far=fitness_so_far)
+
 
+def _compute_h_from_charge(distance_to_end, charge, x_value, type_astar, fitness_so_far):
+    """
+    Compute h once the charge of the cell is known
+    Works both with single values and with numpy arrays of distances and charges
+    :param distance_to_end: heart distance to the end
+    :param charge: attraction of the cell
+    :param x_value: percentage of the distance where the distance to the end starts to count
+    :param type_astar: typology of the astar wanted
+    :param fitness_so_far: fitness of the trajectory moved so far (only for type_astar 1)
+    :return: value h needed from the A* algorithm
+    """
     if type_astar == 0:  # balanced attraction and distance
-        total_charge = compute_charge_points(genome=genome,
-                                             current_position=current_position, K=K, pre_matrix=pre_matrix)
+        total_charge = charge
 
         # need to balance the distance and the attractiveness
         # distance to end vs total_charge point.
         # value = 100 / (max(0, (x_value * 100) - distance_to_end) + total_charge)
         # value = max(0, (x_value * 100) - distance_to_end) + total_charge
-        delta = (max(0, x_value - distance_to_end)) / (x_value + 0.000001)
+        delta = (np.maximum(0, x_value - distance_to_end)) / (x_value + 0.000001)
 
         # need to normalise the values
         # for the total_charge we apply the Z-score: (value - mean) / std
@@ -277,9 +653,8 @@ def _compute_h(distance_to_end, genome, current_position, K,
         # now higher it is, better it is
         # value = total_charge_normalised
     elif type_astar == 1:  # movement to the highest fitness achievable balanced attraction and distance
-        total_charge, _ = compute_fintess_trajectory(tra_moved_so_far=tra_moved_so_far)
-        total_charge_attraction = compute_charge_points(genome=genome, current_position=current_position, K=K,
-                                                        pre_matrix=pre_matrix)
+        total_charge = fitness_so_far
+        total_charge_attraction = charge
 
         if total_charge < -700:
             total_charge = -700
@@ -287,7 +662,7 @@ def _compute_h(distance_to_end, genome, current_position, K,
         # distance to end vs total_charge point.
         # value = 100 / (max(0, (x_value * 100) - distance_to_end) + total_charge)
         # value = max(0, (x_value * 100) - distance_to_end) + total_charge
-        delta = (max(0, x_value - distance_to_end)) / (x_value + 0.000001)
+        delta = (np.maximum(0, x_value - distance_to_end)) / (x_value + 0.000001)
 
         # need to normalise the values
         # for the total_charge we apply the Z-score: (value - mean) / std
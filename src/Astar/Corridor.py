@@ -0,0 +1,152 @@
+"""
+TrajectoriesAstar. Towards a human-like movements generator based on environmental features
+Copyright (C) 2020  Alessandro Zonta (a.zonta@vu.nl)
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import numpy as np
+
+from src.Astar.Astar import NodeStore, _compute_h_from_charge, _standard_normalisation
+from src.Astar.OpenList import HeapOpenList
+from src.Utils.Funcs import NEIGHBOURS_X, NEIGHBOURS_Y, haversine_vectorised
+
+
+class Corridor(object):
+    """
+    Cells of the grid of CollectionCells where the fine astar is allowed to move
+    """
+    def __init__(self, pre_matrix, allowed):
+        self._pre_matrix = pre_matrix
+        self.allowed = allowed
+
+    def __len__(self):
+        return int(np.count_nonzero(self.allowed))
+
+    def contains(self, xs, ys):
+        """
+        Vectorised check if the points are inside the corridor
+        :param xs: array of x values
+        :param ys: array of y values
+        :return: boolean array
+        """
+        positions = self._pre_matrix.get_cell_positions(xs=xs, ys=ys)
+        return self.allowed[positions[:, 0], positions[:, 1]]
+
+
+def _coarse_coordinates(coarse_grid, values_matrix):
+    """
+    Coordinates of the centres of the road cells of every cell, interpolated from the values of the matrix
+    :param coarse_grid: CoarseGrid
+    :param values_matrix: values to translate cells to coordinates
+    :return: matrix rows x columns with the first coordinates, matrix rows x columns with the second coordinates
+    """
+    x_values = np.asarray(values_matrix[0])
+    y_values = np.asarray(values_matrix[1])
+    return (np.interp(coarse_grid.centres[:, :, 0], np.arange(len(x_values)), x_values),
+            np.interp(coarse_grid.centres[:, :, 1], np.arange(len(y_values)), y_values))
+
+
+def search_coarse_path(coarse_grid, start, distance_target, genome, K, pre_matrix, values_matrix, x_value,
+                       charge_field=None):
+    """
+    Same search of the astar with type_astar 0 on the grid of cells: a step goes to a neighbour cell connected by a
+    road, its length is the distance between the centres of the road cells of the two cells and the charge of a
+    cell is the mean charge of its road cells
+    :param coarse_grid: CoarseGrid
+    :param start: starting point
+    :param distance_target: distance from the target (total length trip)
+    :param genome: genome
+    :param K: constant for computing charge
+    :param pre_matrix: pre computation of distance from the cell to the objects
+    :param values_matrix: values to translate cells to coordinates
+    :param x_value: distance where the distance to the end starts to count
+    :param charge_field: charge field of the genome, None to use pre_matrix (see CoarseGrid.get_attraction)
+    :return: list of (row, column) of the cells from the start, to the first one over distance_target
+    (or to the furthest one if the distance cannot be reached)
+    """
+    shape = coarse_grid.get_shape()
+    attraction = coarse_grid.get_attraction(genome=genome, K=K, pre_matrix=pre_matrix, charge_field=charge_field)
+    first_coordinates, second_coordinates = _coarse_coordinates(coarse_grid=coarse_grid, values_matrix=values_matrix)
+    # make x_value a percentege of the total distance target
+    x_value = (distance_target * x_value) / 100
+
+    start_position = pre_matrix.get_cell_positions(xs=np.array([start.x]), ys=np.array([start.y]))[0]
+    node_store = NodeStore(width=shape[1])
+    start_index = node_store.add(cell=start_position[0] * shape[1] + start_position[1], parent=-1, g=0, f=0)
+    open_queue = HeapOpenList()
+    open_queue.push(0, start_index)
+    open_cells = np.zeros(shape, dtype=bool)
+    closed_cells = np.zeros(shape, dtype=bool)
+    open_cells[start_position[0], start_position[1]] = True
+    best_index = start_index
+    best_g = 0
+
+    while len(open_queue) > 0:
+        current_index = open_queue.pop()
+        current_g = node_store.g.item(current_index)
+        x, y = node_store.get_position(index=current_index)
+        open_cells[x, y] = False
+        closed_cells[x, y] = True
+        if current_g >= distance_target:
+            best_index = current_index
+            break
+        if current_g > best_g:
+            best_index = current_index
+            best_g = current_g
+
+        for direction in range(len(NEIGHBOURS_X)):
+            child_x = x + NEIGHBOURS_X[direction]
+            child_y = y + NEIGHBOURS_Y[direction]
+            if not coarse_grid.connected[x, y, direction] or closed_cells[child_x, child_y] or \
+                    open_cells[child_x, child_y]:
+                continue
+            r = haversine_vectorised((first_coordinates[x, y], second_coordinates[x, y]),
+                                     (first_coordinates[child_x, child_y], second_coordinates[child_x, child_y]))
+            child_g = current_g + float(r) * 1000  # in metres
+            child_h = abs(_compute_h_from_charge(distance_to_end=distance_target - child_g,
+                                                 charge=attraction[child_x, child_y], x_value=x_value, type_astar=0,
+                                                 fitness_so_far=None))
+            total_g_normalised = _standard_normalisation(old_value=child_g, old_min=0, old_max=distance_target + 100,
+                                                         new_min=0, new_max=10)
+            child_f = -(total_g_normalised + child_h)
+            child_index = node_store.add(cell=child_x * shape[1] + child_y, parent=current_index, g=child_g,
+                                         f=child_f)
+            open_queue.push(child_f, child_index)
+            open_cells[child_x, child_y] = True
+    return [tuple(position) for position in node_store.get_path(index=best_index).tolist()]
+
+
+def plan_corridor(coarse_grid, start, distance_target, genome, K, pre_matrix, values_matrix, x_value, width,
+                  charge_field=None):
+    """
+    Corridor for the fine astar: the cells of the coarse path and the ones within width cells from them
+    :param coarse_grid: CoarseGrid
+    :param start: starting point
+    :param distance_target: distance from the target (total length trip)
+    :param genome: genome
+    :param K: constant for computing charge
+    :param pre_matrix: pre computation of distance from the cell to the objects
+    :param values_matrix: values to translate cells to coordinates
+    :param x_value: distance where the distance to the end starts to count
+    :param width: number of cells added around the coarse path
+    :param charge_field: charge field of the genome, None to use pre_matrix (see CoarseGrid.get_attraction)
+    :return: Corridor
+    """
+    coarse_path = search_coarse_path(coarse_grid=coarse_grid, start=start, distance_target=distance_target,
+                                     genome=genome, K=K, pre_matrix=pre_matrix, values_matrix=values_matrix,
+                                     x_value=x_value, charge_field=charge_field)
+    allowed = np.zeros(coarse_grid.get_shape(), dtype=bool)
+    for x, y in coarse_path:
+        allowed[max(x - width, 0):x + width + 1, max(y - width, 0):y + width + 1] = True
+    return Corridor(pre_matrix=pre_matrix, allowed=allowed)
@@ -0,0 +1,252 @@
+"""
+TrajectoriesAstar. Towards a human-like movements generator based on environmental features
+Copyright (C) 2020  Alessandro Zonta (a.zonta@vu.nl)
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import time
+
+import numpy as np
+
+from src.Astar.Astar import NodeStore, _update_report, _compute_h_from_charge, _standard_normalisation
+from src.Astar.OpenList import create_open_list, BUCKET_WIDTH
+from src.Helpers.Division.ChargeField import ChargeField
+from src.Utils.Funcs import TrajectoryFeatures
+from src.Utils.Point import Point
+
+
+def _segments_from(road_graph, vertex, road_cell):
+    """
+    Edges that can be followed from a node
+    :param road_graph: RoadGraph
+    :param vertex: vertex of the node, -1 if the node is inside a chain (only the start)
+    :param road_cell: road cell of the node
+    :return: list of (edge, position of the first cell of the edge to follow)
+    """
+    if vertex >= 0:
+        return [(edge, 0) for edge in range(road_graph.indptr.item(vertex), road_graph.indptr.item(vertex + 1))]
+    # the start is inside a chain, the two directions of the chain are followed from the start
+    edge = road_graph.cell_edge.item(road_cell)
+    position = road_graph.cell_position.item(road_cell)
+    number_cells = road_graph.cells_indptr.item(edge + 1) - road_graph.cells_indptr.item(edge)
+    return [(edge, position + 1), (road_graph.reverse.item(edge), number_cells - 1 - position)]
+
+
+def _segment_charge(road_graph, edge, begin, end, genome, K, pre_matrix, charge_field, full_charges, edge_charges):
+    """
+    Mean charge of the cells of a part of an edge
+    :param road_graph: RoadGraph
+    :param edge: edge
+    :param begin: position of the first cell
+    :param end: position after the last cell
+    :param genome: genome
+    :param K: constant for computing charge
+    :param pre_matrix: pre computation of distance from the cell to the objects
+    :param charge_field: charge field of the genome (ChargeField or ChargeMemo), None to use pre_matrix
+    :param full_charges: accumulated charge of all the edges (only with a ChargeField), None otherwise
+    :param edge_charges: dictionary with the accumulated charge of the edges already computed in the search
+    :return: mean charge
+    """
+    offset = road_graph.cells_indptr.item(edge)
+    whole_edge = begin == 0 and offset + end == road_graph.cells_indptr.item(edge + 1)
+    if whole_edge:
+        if full_charges is not None:
+            return full_charges.item(edge) / end
+        if edge in edge_charges:
+            return edge_charges[edge] / end
+    xs, ys = road_graph.get_positions(cells=road_graph.cells[offset + begin:offset + end])
+    if charge_field is not None:
+        charges = charge_field.get_charges(xs=xs, ys=ys)
+    else:
+        charges = pre_matrix.return_charge_from_points(xs=xs, ys=ys, genome=genome, K=K)
+    total = float(np.sum(charges))
+    if whole_edge:
+        edge_charges[edge] = total
+    return total / (end - begin)
+
+
+def _graph_path(road_graph, start, node_store, segments, index):
+    """
+    Cells from the start to the node, expanding the edges followed
+    :param road_graph: RoadGraph
+    :param start: starting point
+    :param node_store: nodes of the search
+    :param segments: list of (edge, begin, end) followed to reach every node
+    :param index: index of the last node
+    :return: path beginning to now
+    """
+    parts = []
+    while index >= 0:
+        segment = segments[index]
+        if segment is not None:
+            offset = road_graph.cells_indptr.item(segment[0])
+            parts.append(road_graph.cells[offset + segment[1]:offset + segment[2]])
+        index = node_store.parent.item(index)
+    path = [start]
+    if len(parts) > 0:
+        xs, ys = road_graph.get_positions(cells=np.concatenate(parts[::-1]))
+        path.extend(Point(x, y) for x, y in zip(xs.tolist(), ys.tolist()))
+    return path
+
+
+def astar_graph(road_graph, start, distance_target, genome, K, pre_matrix, x_value, type_astar, charge_field=None,
+                open_list="heap", bucket_width=BUCKET_WIDTH, max_expansions=None, max_time=None, report=None):
+    """
+    Same search of astar on the road graph: only the vertices (junctions and dead ends) are expanded and every
+    child is the vertex at the end of a chain of road cells.
+    g is the length of the chains followed, the charge in h is the mean charge of the cells of the chain.
+    The chain crossing distance_target is cut at the first cell over it, which is the goal.
+    The cells of the chains are put together only for the path returned
+    :param road_graph: RoadGraph
+    :param start: starting point
+    :param distance_target: distance from the target (total length trip)
+    :param genome: genome
+    :param K: constant for computing charge
+    :param pre_matrix: pre computation of distance from the cell to the objects
+    :param x_value: distance where the distance to the end starts to count
+    :param type_astar: typology of the astar wanted
+    :param charge_field: charge field of the genome (ChargeField or ChargeMemo).
+    If None, the charges are computed on pre_matrix
+    :param open_list: typology of the open list ("heap" or "bucket", see OpenList) or an empty open list
+    :param bucket_width: width of the buckets of f for the "bucket" open list
+    :param max_expansions: maximum number of vertices expanded. None for no limit
+    :param max_time: maximum time of the search in seconds. None for no limit
+    When a budget is finished, the path to the node expanded with the highest g is returned
+    :param report: dictionary filled with the statistics of the search ("pruned": always 0,
+    "expanded": number of vertices expanded, "truncated": True if a budget finished before reaching the target)
+    :return: path
+    """
+    if type_astar != 0 and type_astar != 1:
+        raise Exception("astar typology not implemented")
+    start_cell = road_graph.get_road_cell(x=start.x, y=start.y)
+    if start_cell < 0:
+        raise ValueError("The start is not on a road")
+    # make x_value a percentege of the total distance target
+    x_value = (distance_target * x_value) / 100
+    start_time = time.time()
+
+    full_charges = road_graph.get_edge_charges(charge_field=charge_field) \
+        if isinstance(charge_field, ChargeField) else None
+    edge_charges = {}
+
+    # the nodes keep the road cells in place of the flat indexes
+    node_store = NodeStore(width=1)
+    # vertex of every node (-1 for the start inside a chain and for the goals) and part of the edge followed
+    node_vertex = []
+    segments = []
+    start_vertex = road_graph.vertex_of_cell.item(start_cell)
+    start_index = node_store.add(cell=start_cell, parent=-1, g=0, f=0)
+    node_vertex.append(start_vertex)
+    segments.append(None)
+    if type_astar == 1:
+        node_store.features[start_index] = TrajectoryFeatures(start=start)
+
+    if isinstance(open_list, str):
+        open_queue = create_open_list(typology=open_list, bucket_width=bucket_width)
+    else:
+        open_queue = open_list
+    open_vertices = np.zeros(road_graph.number_of_vertices(), dtype=bool)
+    closed_vertices = np.zeros(road_graph.number_of_vertices(), dtype=bool)
+
+    open_queue.push(0, start_index)
+    if start_vertex >= 0:
+        open_vertices[start_vertex] = True
+        start_edges = ()
+    else:
+        # the chain of the start is already followed from the start, it is not followed again from its vertices
+        start_edges = (road_graph.cell_edge.item(start_cell),
+                       road_graph.reverse.item(road_graph.cell_edge.item(start_cell)))
+    expanded = 0
+    best_index = start_index
+    best_g = 0
+
+    while len(open_queue) > 0:
+        current_index = open_queue.pop()
+        current_g = node_store.g.item(current_index)
+        current_vertex = node_vertex[current_index]
+        if current_vertex >= 0:
+            open_vertices[current_vertex] = False
+            closed_vertices[current_vertex] = True
+
+        # Found the goal
+        if current_g >= distance_target:
+            _update_report(report=report, pruned=0, expanded=expanded, truncated=False)
+            return _graph_path(road_graph=road_graph, start=start, node_store=node_store, segments=segments,
+                               index=current_index)
+
+        if current_g > best_g:
+            best_index = current_index
+            best_g = current_g
+        if (max_expansions is not None and expanded >= max_expansions) or \
+                (max_time is not None and time.time() - start_time >= max_time):
+            _update_report(report=report, pruned=0, expanded=expanded, truncated=True)
+            return _graph_path(road_graph=road_graph, start=start, node_store=node_store, segments=segments,
+                               index=best_index)
+        expanded += 1
+
+        # the fitness of the path moved so far is the same for all the children
+        fitness_so_far = None
+        if type_astar == 1:
+            parent_index = node_store.parent.item(current_index)
+            if parent_index >= 0:
+                edge, begin, end = segments[current_index]
+                offset = road_graph.cells_indptr.item(edge)
+                xs, ys = road_graph.get_positions(cells=road_graph.cells[offset + begin:offset + end])
+                node_store.features[current_index] = node_store.features[parent_index].extend_many(xs=xs, ys=ys)
+            fitness_so_far = node_store.features[current_index].get_fitness()
+
+        current_cell = node_store.cell.item(current_index)
+        for edge, begin in _segments_from(road_graph=road_graph, vertex=current_vertex, road_cell=current_cell):
+            if current_index != start_index and edge in start_edges:
+                continue
+            offset = road_graph.cells_indptr.item(edge)
+            end = road_graph.cells_indptr.item(edge + 1) - offset
+            base = road_graph.distances.item(offset + begin - 1) if begin > 0 else 0.0
+            child_g = current_g + road_graph.distances.item(offset + end - 1) - base
+            target_vertex = road_graph.targets.item(edge)
+            # the cells of the chains from closed vertices have been already computed
+            if closed_vertices[target_vertex] and target_vertex != current_vertex:
+                continue
+            if child_g >= distance_target:
+                # the goal is the first cell of the chain over the distance
+                distances = road_graph.distances[offset + begin:offset + end] - base + current_g
+                end = begin + int(np.searchsorted(distances, distance_target)) + 1
+                child_g = distances.item(end - begin - 1)
+                child_vertex = -1
+            else:
+                child_vertex = target_vertex
+                # Child is already computed
+                if open_vertices[child_vertex] or child_vertex == current_vertex:
+                    continue
+
+            # distance to end is total distance - distance from start
+            distance_to_end = distance_target - child_g
+            charge = _segment_charge(road_graph=road_graph, edge=edge, begin=begin, end=end, genome=genome, K=K,
+                                     pre_matrix=pre_matrix, charge_field=charge_field, full_charges=full_charges,
+                                     edge_charges=edge_charges)
+            child_h = abs(_compute_h_from_charge(distance_to_end=distance_to_end, charge=charge, x_value=x_value,
+                                                 type_astar=type_astar, fitness_so_far=fitness_so_far))
+            total_g_normalised = _standard_normalisation(old_value=child_g, old_min=0, old_max=distance_target + 100,
+                                                         new_min=0, new_max=10)
+            # now higher is the most attractive
+            child_f = -(total_g_normalised + child_h)
+
+            child_index = node_store.add(cell=road_graph.cells.item(offset + end - 1), parent=current_index,
+                                         g=child_g, f=child_f)
+            node_vertex.append(child_vertex)
+            segments.append((edge, begin, end))
+            open_queue.push(child_f, child_index)
+            if child_vertex >= 0:
+                open_vertices[child_vertex] = True
+    _update_report(report=report, pruned=0, expanded=expanded, truncated=False)
@@ -15,21 +15,25 @@ GNU General Public License for more details.
 You should have received a copy of the GNU General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
+import numpy as np
 
-from haversine import haversine
-
-from src.Utils.Funcs import list_neighbours, keep_only_points_on_street, compute_charge_points
+from src.Utils.Funcs import list_neighbours, keep_only_points_on_street, compute_charge_points, compute_step_costs, \
+    get_step_cost
+from src.Utils.Point import Point
 
 
 def chain_of_neighbours(total_distance, genome, genome_meaning, values_matrix, K, distances,
-                        current_node, apf, pre_matrix):
+                        current_node, apf, pre_matrix, step_costs=None, charge_field=None, neighbour_mask=None,
+                        road_mask=None):
     """
     From current position check the neighbours for the most attractive one and move there.
     Loop till reach maximum length
 
     -> check neighbours nodes in order to find the one with the strongest attraction
-    -> check only neighbours that have charge != 0 (in order to stay on routes)
+    -> check only neighbours on a road of road_mask (the APF), read from neighbour_mask if given (in order to stay
+    on routes)
     -> compute attraction points using coulomb law: |E| = k(|q|/r^2). r is computed using haversine measure
+    -> the length of the step is read from the step costs table (haversine per row and direction)
     -> move to the location with strongest attraction
     -> save the point as next point of the path
     -> increase counter of distance travelled
@@ -42,16 +46,31 @@ def chain_of_neighbours(total_distance, genome, genome_meaning, values_matrix, K
     :param K: constant for the computation of the charge
     :param distances: vector with distances positions
     :param current_node: current node
-    :param apf: apf
+    :param apf: shape of the apf
     :param pre_matrix: pre computation of distance from the cell to the objects
+    :param step_costs: length of the steps per row and direction. If None, it is computed from values_matrix
+    :param charge_field: charge field of the genome (ChargeField or ChargeMemo).
+    If None, the charges are computed on pre_matrix
+    :param neighbour_mask: NeighbourMask built on road_mask to find the neighbours on a road, None to check them on
+    road_mask
+    :param road_mask: RoadMask of the routing system
     :return: path
     """
+    if road_mask is None:
+        raise ValueError("The road mask of the routing system is needed")
+    if neighbour_mask is not None and neighbour_mask.fingerprint != road_mask.get_road_fingerprint():
+        raise ValueError("The neighbour mask is not built on the roads of the road mask")
+    if step_costs is None:
+        step_costs = compute_step_costs(values_matrix=values_matrix)
     path = []
     distance_travelled = 0
     while distance_travelled < total_distance:
         # return neighbours of current node
-        points = list_neighbours(x_value=current_node.x, y_value=current_node.y, apf=apf)
-        points_on_the_street = keep_only_points_on_street(apf=apf, points=points)
+        if neighbour_mask is not None:
+            points_on_the_street = neighbour_mask.get_points(x=current_node.x, y=current_node.y)
+        else:
+            points = list_neighbours(x_value=current_node.x, y_value=current_node.y, apf=apf)
+            points_on_the_street = keep_only_points_on_street(road_mask=road_mask, points=points)
 
         if len(points_on_the_street) == 0:
             # I cannot move in a street around me
@@ -60,7 +79,8 @@ def chain_of_neighbours(total_distance, genome, genome_meaning, values_matrix, K
 
         # compute charge close points
         charges = [compute_charge_points(genome=genome,
-                                         current_position=current_position, K=K, pre_matrix=pre_matrix) for
+                                         current_position=current_position, K=K, pre_matrix=pre_matrix,
+                                         charge_field=charge_field) for
                    current_position in points_on_the_street]
 
         # find most attractive point
@@ -70,11 +90,41 @@ def chain_of_neighbours(total_distance, genome, genome_meaning, values_matrix, K
         path.append(most_attractive_point)
         # compute distance
 
-        dis = haversine((values_matrix[0][current_node.x], values_matrix[1][current_node.y]),
-                        (values_matrix[0][most_attractive_point.x],
-                         values_matrix[1][most_attractive_point.y])) * 1000  # in metres
+        dis = get_step_cost(step_costs=step_costs, current_point=current_node,
+                            next_point=most_attractive_point)  # in metres
         distances.append(dis)
         distance_travelled += dis
 
         current_node = most_attractive_point
     return path
+
+
+def chain_of_successors(total_distance, distances, current_node, successor_field):
+    """
+    Same path of chain_of_neighbours, read from the successor field of the genome
+    :param total_distance: total distance to travel
+    :param distances: vector with distances positions
+    :param current_node: current node, on a road
+    :param successor_field: SuccessorField of the genome
+    :return: path
+    """
+    start = successor_field.get_road_cell(x=current_node.x, y=current_node.y)
+    if start < 0:
+        raise ValueError("The start is not on a road")
+    # one path, the scalar reads are faster than SuccessorField.walk
+    cells = []
+    current_cell = start
+    distance_travelled = 0
+    while distance_travelled < total_distance:
+        next_cell = successor_field.successor.item(current_cell)
+        if next_cell < 0:
+            # I cannot move in a street around me
+            cells.append(current_cell)
+            break
+        dis = successor_field.step.item(current_cell)
+        distances.append(dis)
+        distance_travelled += dis
+        cells.append(next_cell)
+        current_cell = next_cell
+    xs, ys = successor_field.get_positions(cells=np.array(cells, dtype=np.int64))
+    return [Point(x, y) for x, y in zip(xs.tolist(), ys.tolist())]
@@ -0,0 +1,234 @@
+"""
+TrajectoriesAstar. Towards a human-like movements generator based on environmental features
+Copyright (C) 2020  Alessandro Zonta (a.zonta@vu.nl)
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import heapq
+import logging
+import math
+import time
+from collections import deque
+
+from src.Settings.args import args
+
+# default width of the buckets of BucketOpenList, in units of f
+BUCKET_WIDTH = 0.0001
+# fraction of the maximum size kept when a bounded open list is pruned, so it is not pruned at every expansion
+BEAM_KEEP = 0.9
+
+
+class HeapOpenList(object):
+    """
+    Open list of the A* as binary heap of (f, order, node), where node is the index of the node in the NodeStore.
+    Nodes with the same f are popped in the order they have been pushed: order is a counter, not the index of the
+    node, since the NodeStore reuses the indexes of the nodes pruned (max_open_size)
+    """
+    def __init__(self):
+        self._heap = []
+        self._pushed = 0
+
+    def __len__(self):
+        return len(self._heap)
+
+    def push(self, f, node):
+        heapq.heappush(self._heap, (f, self._pushed, node))
+        self._pushed += 1
+
+    def pop(self):
+        return heapq.heappop(self._heap)[2]
+
+    def prune(self, size):
+        """
+        Keep only the size nodes with the lowest f
+        :param size: number of nodes to keep
+        :return: list of the nodes removed
+        """
+        self._heap.sort()
+        removed = [node for _, _, node in self._heap[size:]]
+        # a sorted list is a valid heap
+        del self._heap[size:]
+        return removed
+
+
+class BucketOpenList(object):
+    """
+    Open list of the A* as bucket queue.
+    f is quantised in buckets of width bucket_width, the nodes of a bucket are popped in FIFO order.
+    Only the ids of the non empty buckets are kept in a heap, so the range of f does not need to be known and
+    pushing in a bucket already present costs O(1)
+    """
+    def __init__(self, bucket_width=BUCKET_WIDTH):
+        self._bucket_width = bucket_width
+        self._buckets = {}
+        self._ids = []
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def push(self, f, node):
+        bucket_id = math.floor(f / self._bucket_width)
+        bucket = self._buckets.get(bucket_id)
+        if bucket is None:
+            bucket = deque()
+            self._buckets[bucket_id] = bucket
+            heapq.heappush(self._ids, bucket_id)
+        bucket.append(node)
+        self._size += 1
+
+    def pop(self):
+        bucket_id = self._ids[0]
+        bucket = self._buckets[bucket_id]
+        node = bucket.popleft()
+        if len(bucket) == 0:
+            del self._buckets[bucket_id]
+            heapq.heappop(self._ids)
+        self._size -= 1
+        return node
+
+    def prune(self, size):
+        """
+        Keep only the size nodes in the buckets with the lowest f, the first ones pushed in the last bucket kept
+        :param size: number of nodes to keep
+        :return: list of the nodes removed
+        """
+        removed = []
+        kept = 0
+        for bucket_id in sorted(self._ids):
+            bucket = self._buckets[bucket_id]
+            if kept >= size:
+                removed.extend(bucket)
+                del self._buckets[bucket_id]
+            elif kept + len(bucket) > size:
+                while len(bucket) > size - kept:
+                    removed.append(bucket.pop())
+                kept = size
+            else:
+                kept += len(bucket)
+        # a sorted list is a valid heap
+        self._ids = sorted(self._buckets.keys())
+        self._size = kept
+        return removed
+
+
+class RecordingOpenList(object):
+    """
+    Open list that records all the operations done on another open list, used by the benchmark
+    """
+    def __init__(self, open_list):
+        self._open_list = open_list
+        self.operations = []
+
+    def __len__(self):
+        return len(self._open_list)
+
+    def push(self, f, node):
+        self.operations.append((f, node))
+        self._open_list.push(f, node)
+
+    def pop(self):
+        self.operations.append(None)
+        return self._open_list.pop()
+
+    def prune(self, size):
+        return self._open_list.prune(size)
+
+
+def create_open_list(typology, bucket_width=BUCKET_WIDTH):
+    """
+    Return an empty open list
+    :param typology: "heap" or "bucket"
+    :param bucket_width: width of the buckets, only for "bucket"
+    :return: open list
+    """
+    if typology == "heap":
+        return HeapOpenList()
+    elif typology == "bucket":
+        return BucketOpenList(bucket_width=bucket_width)
+    else:
+        raise ValueError("Open list requested not implemented")
+
+
+def replay_operations(operations, typology, bucket_width=BUCKET_WIDTH):
+    """
+    Execute the operations recorded by RecordingOpenList on a new open list
+    :param operations: list of (f, node index) for the pushes and None for the pops
+    :param typology: typology of the open list
+    :param bucket_width: width of the buckets, only for "bucket"
+    :return: time needed in seconds
+    """
+    open_list = create_open_list(typology=typology, bucket_width=bucket_width)
+    push = open_list.push
+    pop = open_list.pop
+    start_time = time.perf_counter()
+    for operation in operations:
+        if operation is None:
+            pop()
+        else:
+            push(operation[0], operation[1])
+    return time.perf_counter() - start_time
+
+
+def benchmark_open_lists(list_operations, typologies=("heap", "bucket"), bucket_width=BUCKET_WIDTH, repeat=5):
+    """
+    Compare the open lists on the operations recorded during real searches
+    :param list_operations: list of operations, one per search (RecordingOpenList.operations)
+    :param typologies: open lists to compare
+    :param bucket_width: width of the buckets, only for "bucket"
+    :param repeat: the best time of repeat executions is used
+    :return: dict typology -> operations (pushes + pops) per second
+    """
+    total_operations = sum(len(operations) for operations in list_operations)
+    results = {}
+    for typology in typologies:
+        total_time = 0
+        for operations in list_operations:
+            total_time += min(replay_operations(operations=operations, typology=typology, bucket_width=bucket_width)
+                              for _ in range(repeat))
+        results[typology] = total_operations / total_time
+    return results
+
+
+if __name__ == '__main__':
+    # benchmark of the open lists on the operations of real searches
+    # python -m src.Astar.OpenList --data_path ... --apf_name ... --n_tra_generated 10
+    from src.Astar.Astar import astar
+    from src.Experiment.Controller import Controller
+    from src.Individual.GenerativeIndividual import K
+    from src.Utils.Point import Point
+
+    logger = logging.getLogger("OpenList")
+    logger.setLevel(logging.DEBUG)
+    ch = logging.StreamHandler()
+    ch.setLevel(logging.DEBUG)
+    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    ch.setFormatter(formatter)
+    logger.addHandler(ch)
+
+    controller = Controller(path_apf=args.data_path + args.apf_name, name_exp=args.name_exp, log=logger)
+    loader_apf = controller._loader_apf
+    recorded = []
+    for idx in range(args.n_tra_generated):
+        point = controller._pre_loaded_points.get_point(idx_tra=idx)
+        recording = RecordingOpenList(open_list=HeapOpenList())
+        astar(apf=loader_apf.get_shape(), start=Point(x=point[0], y=point[1]),
+              distance_target=args.total_distance_to_travel, genome=[1, 1, 1, 1, 50, 100],
+              values_matrix=(loader_apf.x_values, loader_apf.y_values), K=K, pre_matrix=controller._sub_matrix,
+              x_value=args.x_value, type_astar=args.type_astar, step_costs=loader_apf.step_costs,
+              open_list=recording)
+        recorded.append(recording.operations)
+        logger.debug("Search {} recorded, {} operations".format(idx, len(recording.operations)))
+    for typology, speed in benchmark_open_lists(list_operations=recorded, bucket_width=args.bucket_width).items():
+        logger.info("{}: {:.0f} pushes/pops per second".format(typology, speed))
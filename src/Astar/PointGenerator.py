@@ -15,29 +15,60 @@ GNU General Public License for more details.
 You should have received a copy of the GNU General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
+import time
+
 from src.Astar.Astar import astar
-from src.Astar.Neighbours import chain_of_neighbours
+from src.Astar.Corridor import plan_corridor
+from src.Astar.GraphAstar import astar_graph
+from src.Astar.Neighbours import chain_of_neighbours, chain_of_successors
+from src.Astar.OpenList import BUCKET_WIDTH
 
 
 class PointGenerator(object):
     """
     Proxy class for the method used to generate the path
     """
-    def __init__(self, typology_needed, pre_matrix, type_astar):
+    def __init__(self, typology_needed, pre_matrix, type_astar, index_astar="flat", batch_astar=True,
+                 open_list="heap", bucket_width=BUCKET_WIDTH, max_open_size=None, paths_per_search=1, max_overlap=1.0,
+                 road_graph=None, coarse_grid=None, corridor_width=1, neighbour_mask=None):
         if typology_needed == "astar":
             self._type = 1
         elif typology_needed == "default":
             self._type = 0
         else:
             raise ValueError("Type requested not implemented")
+        if self._type == 0 and paths_per_search > 1:
+            raise ValueError("Multiple paths per search are implemented only for the astar")
+        if road_graph is not None and (self._type == 0 or paths_per_search > 1 or max_open_size is not None):
+            raise ValueError("The road graph is implemented only for the astar with one path and no open list limit")
+        if coarse_grid is not None and (self._type == 0 or road_graph is not None):
+            raise ValueError("The corridor is implemented only for the astar on the road cells")
         self.type_astar = type_astar
+        self.index_astar = index_astar
+        self.batch_astar = batch_astar
+        self.open_list = open_list
+        self.bucket_width = bucket_width
+        self.max_open_size = max_open_size
+        # number of paths per search and maximum fraction of cells they can share
+        self.paths_per_search = paths_per_search
+        self.max_overlap = max_overlap
+        # road graph for the astar on the chains of road cells, None for the astar on the cells
+        self.road_graph = road_graph
+        # grid of cells for the coarse search of the corridor of the astar, None to search on all the map
+        self.coarse_grid = coarse_grid
+        self.corridor_width = corridor_width
+        # neighbours on a road read from the NeighbourMask (on the roads of the APF for the default generator, of
+        # indexing_fast for the astar), None to check them one by one
+        self.neighbour_mask = neighbour_mask
         self.pre_matrix = pre_matrix
 
     def get_path(self, total_distance, genome, genome_meaning, values_matrix, K, distances,
-                 current_node, apf, x_value):
+                 current_node, apf, x_value, step_costs=None, charge_field=None, max_expansions=None, max_time=None,
+                 report=None, road_mask=None, successor_field=None):
         """
         Return the path with the method chosen to use
-        :param total_distance:  total distance to travel
+        :param total_distance:  total distance to travel, or sorted list of distances (only astar, one path per
+        distance is returned, searched with the heuristic of the longest distance)
         :param genome: genome
         :param genome_meaning: meaning if every pos of the genome
         :param values_matrix: values to translate cells to coordinates
@@ -45,15 +76,75 @@ class PointGenerator(object):
         :param distances: vector with distances positions
         :param current_node: current node
         :param apf: apf
-        :return: path generated
+        :param step_costs: length of the steps per row and direction
+        :param charge_field: charge field of the genome (ChargeField or ChargeMemo),
+        None to compute the charges on pre_matrix
+        :param max_expansions: maximum number of cells expanded by the astar, None for no limit
+        :param max_time: maximum time of the astar in seconds, None for no limit
+        :param report: dictionary filled with the statistics of the search (only astar). With a corridor fallback,
+        "expanded" and "pruned" count both searches
+        :param road_mask: RoadMask of the routing system, the roads of the default generator (only default)
+        :param successor_field: SuccessorField of the genome, the default generator reads the path from it when the
+        start is on a road. None to look for the most attractive neighbour at every step
+        :return: path generated (list of paths if paths_per_search > 1 or with a list of distances) and True if a
+        budget or the beam stopped the search before reaching the distance (the path is the best partial one)
         """
+        if report is None:
+            report = {}
         if self._type == 0:
+            if isinstance(total_distance, (list, tuple)):
+                raise ValueError("Multiple distances are implemented only for the astar")
+            if successor_field is not None and \
+                    successor_field.get_road_cell(x=current_node.x, y=current_node.y) >= 0:
+                return chain_of_successors(total_distance=total_distance, distances=distances,
+                                           current_node=current_node, successor_field=successor_field), False
             return chain_of_neighbours(total_distance=total_distance,
                                        genome=genome, genome_meaning=genome_meaning, values_matrix=values_matrix, K=K,
                                        distances=distances, current_node=current_node, apf=apf,
-                                       pre_matrix=self.pre_matrix)
-        else:
-            return astar(apf=apf, start=current_node, distance_target=total_distance,
+                                       pre_matrix=self.pre_matrix, step_costs=step_costs,
+                                       charge_field=charge_field, neighbour_mask=self.neighbour_mask,
+                                       road_mask=road_mask), False
+        elif self.road_graph is not None:
+            if isinstance(total_distance, (list, tuple)):
+                raise ValueError("Multiple distances are not implemented for the road graph")
+            path = astar_graph(road_graph=self.road_graph, start=current_node, distance_target=total_distance,
+                               genome=genome, K=K, pre_matrix=self.pre_matrix, x_value=x_value,
+                               type_astar=self.type_astar, charge_field=charge_field, open_list=self.open_list,
+                               bucket_width=self.bucket_width, max_expansions=max_expansions, max_time=max_time,
+                               report=report)
+            return path, report["truncated"]
+        corridor = None
+        if self.coarse_grid is not None:
+            longest_distance = max(total_distance) if isinstance(total_distance, (list, tuple)) else total_distance
+            corridor = plan_corridor(coarse_grid=self.coarse_grid, start=current_node, distance_target=longest_distance,
+                                     genome=genome, K=K, pre_matrix=self.pre_matrix, values_matrix=values_matrix,
+                                     x_value=x_value, width=self.corridor_width, charge_field=charge_field)
+            report["corridor_cells"] = len(corridor)
+        start_time = time.time()
+        # expansions and cells pruned by the search in the corridor, when it is done again
+        expanded = 0
+        pruned = 0
+        while True:
+            path = astar(apf=apf, start=current_node, distance_target=total_distance,
                          genome=genome,
                          values_matrix=values_matrix, K=K, pre_matrix=self.pre_matrix, x_value=x_value,
-                         type_astar=self.type_astar)
+                         type_astar=self.type_astar, index_type=self.index_astar, batch=self.batch_astar,
+                         step_costs=step_costs, charge_field=charge_field, open_list=self.open_list,
+                         bucket_width=self.bucket_width, max_open_size=self.max_open_size,
+                         max_expansions=max_expansions, max_time=max_time, k_paths=self.paths_per_search,
+                         max_overlap=self.max_overlap, corridor=corridor, neighbour_mask=self.neighbour_mask,
+                         report=report)
+            if corridor is None or (path is not None and len(path) > 0 and all(p is not None for p in path)):
+                report["expanded"] += expanded
+                report["pruned"] += pruned
+                return path, report["truncated"]
+            # the corridor is too narrow for the trip, the search is done again on all the map with what is left of
+            # the budgets
+            corridor = None
+            report["corridor_fallback"] = True
+            expanded = report["expanded"]
+            pruned = report["pruned"]
+            if max_expansions is not None:
+                max_expansions = max(max_expansions - expanded, 0)
+            if max_time is not None:
+                max_time = max(max_time - (time.time() - start_time), 0.0)
@@ -18,10 +18,17 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 import multiprocessing
 import pickle
 
+import numpy as np
 from joblib import Parallel, delayed
 
+from src.Helpers.Division.ChargeField import load_charge_field
+from src.Helpers.Division.CoarseGrid import load_coarse_grid
 from src.Helpers.Division.ComputeDivision import SubMatrix
-from src.Individual.GenerativeIndividual import TrajectoryGeneration
+from src.Helpers.Division.NeighbourMask import load_neighbour_mask
+from src.Helpers.Division.RoadGraph import load_road_graph
+from src.Helpers.Division.SuccessorField import load_successor_field
+from src.Helpers.Fitness.FitnessRaster import load_fitness_raster
+from src.Individual.GenerativeIndividual import TrajectoryGeneration, K
 from src.Loaders.GenomePhenome import GenomeMeaning
 from src.Loaders.LoadAPF import LoadAPF
 from src.Loaders.PlacesOnRoute import FindPlacesOnRoutes
@@ -29,8 +36,14 @@ from src.Settings.args import args
 
 
 def worker_job_lib(individual, idx):
-    distances, tra, real_tra, path = individual.create_trajectory(random_seed=10, idx=idx)
-    return (distances, tra, real_tra, path)
+    trajectories = individual.create_trajectories(random_seed=10, idx=idx)
+    return [(distances, tra, real_tra, path, individual.search_report)
+            for distances, tra, real_tra, path in trajectories]
+
+
+def worker_job_batch(individual, idxs):
+    trajectories = individual.create_trajectories_batch(random_seed=10, idxs=idxs)
+    return [(distances, tra, real_tra, path, {}) for distances, tra, real_tra, path in trajectories]
 
 
 def save_data(vector_data, save_path, name, version):
@@ -65,7 +78,7 @@ class Controller(object):
         self._list_genome = None
 
         self._loader_apf = LoadAPF(path=self._path_apf, logger=self._logger)
-        self._loader_apf.load_apf_only_routing_system()
+        self._loader_apf.load_road_mask(packed=args.road_mask == "packed")
         self._loader_apf.match_index_with_coordinates()
         self._loader_genome_meaning = GenomeMeaning(logger=self._logger)
         self._loader_genome_meaning.load_data(test=False)
@@ -74,10 +87,16 @@ class Controller(object):
                                      list_points=self._loader_genome_meaning.name_typologies,
                                      values_matrix=(self._loader_apf.x_values, self._loader_apf.y_values))
         self._sub_matrix.divide_into_cells()
+        self._sub_matrix.load_road_mask(packed=args.road_mask == "packed")
 
         self._pre_loaded_points = FindPlacesOnRoutes(logger=self._logger)
         self._pre_loaded_points.load_preloaded_position()
 
+        if args.fitness_raster_resolution is not None:
+            # built before the workers start, they only open it
+            load_fitness_raster(resolution=args.fitness_raster_resolution,
+                                bilinear=args.fitness_raster_bilinear == 1, logger=self._logger)
+
     def set_vector_data(self, vector_data):
         """
         Read data from file and load the controller
@@ -95,15 +114,68 @@ class Controller(object):
         :param debug: serial execution or not
         :return:
         """
+        total_distance_to_travel = args.total_distance_to_travel
+        if isinstance(total_distance_to_travel, list):
+            # several distances are searched together, one trajectory each
+            if len(total_distance_to_travel) == 1:
+                total_distance_to_travel = total_distance_to_travel[0]
+            elif args.type_generator != "astar":
+                raise ValueError("Multiple distances are implemented only for the astar")
+        charge_field = None
+        if args.charge_field != 0:
+            charge_field = load_charge_field(pre_matrix=self._sub_matrix, genome=self._list_genome, K=K,
+                                             logger=self._logger, superposition=args.charge_field == 2)
+        road_graph = None
+        if args.road_graph == 1:
+            road_graph = load_road_graph(pre_matrix=self._sub_matrix, step_costs=self._loader_apf.step_costs,
+                                         logger=self._logger)
+        coarse_grid = None
+        if args.corridor_width is not None:
+            coarse_grid = load_coarse_grid(pre_matrix=self._sub_matrix, logger=self._logger)
+            # the attraction of the genome is computed once here and sent to the workers with the grid
+            coarse_grid.get_attraction(genome=self._list_genome, K=K, pre_matrix=self._sub_matrix,
+                                       charge_field=charge_field)
+        neighbour_mask = None
+        if args.neighbour_mask == 1:
+            # same roads of the road checks it replaces: the APF for the default generator, indexing_fast for the A*
+            road_mask = self._loader_apf.road_mask if args.type_generator == "default" else None
+            neighbour_mask = load_neighbour_mask(pre_matrix=self._sub_matrix, logger=self._logger,
+                                                 road_mask=road_mask)
+        successor_field = None
+        if args.successor_field == 1:
+            if args.type_generator != "default":
+                raise ValueError("The successor field is implemented only for the default generator")
+            successor_field = load_successor_field(pre_matrix=self._sub_matrix, road_mask=self._loader_apf.road_mask,
+                                                   genome=self._list_genome, K=K,
+                                                   step_costs=self._loader_apf.step_costs, charge_field=charge_field,
+                                                   logger=self._logger)
         individual = TrajectoryGeneration(x_value=args.x_value,
                                           genotype=self._list_genome,
                                           values_matrix=(self._loader_apf.x_values, self._loader_apf.y_values),
-                                          apf=self._loader_apf.apf, genome_meaning=self._loader_genome_meaning,
+                                          apf=self._loader_apf.road_mask, genome_meaning=self._loader_genome_meaning,
                                           pre_matrix=self._sub_matrix,
                                           type_of_generator=args.type_generator,
                                           type_astar=args.type_astar,
                                           pre_loaded_points=self._pre_loaded_points,
-                                          total_distance_to_travel=args.total_distance_to_travel)
+                                          total_distance_to_travel=total_distance_to_travel,
+                                          index_astar=args.index_astar,
+                                          batch_astar=args.batch_astar == 1,
+                                          step_costs=self._loader_apf.step_costs,
+                                          charge_field=charge_field,
+                                          open_list=args.open_list,
+                                          bucket_width=args.bucket_width,
+                                          max_open_size=args.max_open_size,
+                                          max_expansions=args.max_expansions,
+                                          max_search_time=args.max_search_time,
+                                          charge_memo=args.charge_memo == 1,
+                                          charge_memo_size=args.charge_memo_size,
+                                          paths_per_search=args.paths_per_search,
+                                          max_overlap=args.max_overlap,
+                                          road_graph=road_graph,
+                                          coarse_grid=coarse_grid,
+                                          corridor_width=args.corridor_width,
+                                          neighbour_mask=neighbour_mask,
+                                          successor_field=successor_field)
 
         self._logger.debug("Generating Trajectories")
         results = []
@@ -114,7 +186,12 @@ class Controller(object):
             # serial execution
             number_of_processes = 1
         with Parallel(n_jobs=number_of_processes, verbose=30) as parallel:
-            res = parallel(delayed(worker_job_lib)(individual, i) for i in range(how_many))
+            if successor_field is not None:
+                # the paths of every worker are walked together on the successor field
+                chunks = np.array_split(np.arange(how_many), number_of_processes)
+                res = parallel(delayed(worker_job_batch)(individual, chunk.tolist()) for chunk in chunks)
+            else:
+                res = parallel(delayed(worker_job_lib)(individual, i) for i in range(how_many))
             results.append(res)
 
         # distances, tra, real_tra, path, preloaded_points
@@ -122,11 +199,32 @@ class Controller(object):
         # total_vector_distances = []
         total_real_tra = []
         total_paths = []
-        for trial in results[0]:
+        total_reports = []
+        # every search returns args.paths_per_search trajectories, or one per distance reached
+        for trial in (trial for trials in results[0] for trial in trials):
             total_tra.append(trial[1])
             # total_vector_distances.append(trial[0])
             total_real_tra.append(trial[2])
             total_paths.append(trial[3])
+            total_reports.append(trial[4])
+
+        if args.max_open_size is not None:
+            pruned = [report.get("pruned", 0) for report in total_reports]
+            self._logger.info("Cells pruned from the open list: {} in total, {} at most in one trajectory".format(
+                sum(pruned), max(pruned) if len(pruned) > 0 else 0))
+        # the trajectories of a search share its report, the charges are counted once per search
+        search_reports = [trials[0][4] for trials in results[0] if len(trials) > 0]
+        lookups = sum(report.get("charge_memo_lookups", 0) for report in search_reports)
+        if lookups > 0:
+            hits = sum(report.get("charge_memo_hits", 0) for report in search_reports)
+            self._logger.info("Charge memo hit rate {:.3f} ({} of {} charges read from the memos)".format(
+                hits / lookups, hits, lookups))
+        fallbacks = sum(1 for report in total_reports if report.get("corridor_fallback", False))
+        if fallbacks > 0:
+            self._logger.info("{} searches repeated on all the map, the corridor was too narrow".format(fallbacks))
+        truncated = sum(1 for report in total_reports if report.get("truncated", False))
+        if truncated > 0:
+            self._logger.info("{} trajectories truncated by the search budgets or the beam".format(truncated))
 
         save_data(vector_data=total_real_tra, save_path=save_path, name="real_tra", version=version)
         save_data(vector_data=total_tra, save_path=save_path, name="tra", version=version)
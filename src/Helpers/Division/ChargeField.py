@@ -0,0 +1,550 @@
+"""
+TrajectoriesAstar. Towards a human-like movements generator based on environmental features
+Copyright (C) 2020  Alessandro Zonta (a.zonta@vu.nl)
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import hashlib
+import json
+import os
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from src.Settings.args import args
+from src.Utils.Point import Point
+
+# rows of the map checked together while numbering the road cells
+ROWS_CHUNK = 512
+# road cells whose charge is computed together while building a charge field
+CELLS_CHUNK = 1 << 20
+
+# road cells, base stacks, charge fields and charge memos already opened in this process
+_ROAD_CELLS = {}
+_BASE_STACKS = {}
+_CHARGE_FIELDS = {}
+_CHARGE_MEMOS = {}
+
+
+def _folder(data_path):
+    return "{}/charge_field".format(data_path)
+
+
+def read_road_fingerprint(file_name):
+    """
+    Fingerprint of the roads (SubMatrix.get_road_fingerprint) a file was built on
+    :param file_name: file with the fingerprint
+    :return: string, None if the file does not exist
+    """
+    if not os.path.isfile(file_name):
+        return None
+    with open(file_name, "r") as handle:
+        return handle.read()
+
+
+def write_road_fingerprint(file_name, fingerprint):
+    """
+    Save the fingerprint of the roads a file was built on. It is written after the file, so a file without it
+    is built again
+    :param file_name: file with the fingerprint
+    :param fingerprint: fingerprint of the roads
+    :return:
+    """
+    with open(file_name, "w") as handle:
+        handle.write(fingerprint)
+
+
+def genome_hash(genome, K):
+    """
+    Key of the charge field of a genome
+    :param genome: genome
+    :param K: constant for the computation of the charge
+    :return: hex string
+    """
+    description = json.dumps([[float(value) for value in genome], float(K)])
+    return hashlib.sha1(description.encode("utf-8")).hexdigest()
+
+
+class RoadCells(object):
+    """
+    Numbering of the cells on a road: the cells with indexing_fast != 0 (SubMatrix.get_road_mask), or the cells on
+    a road of the APF (RoadMask.get_road_mask) for the default generator, each saved in its own files (name).
+    road_index[x, y] is the position of the cell among the road cells, -1 if the cell is not on a road.
+    cells[i] is the (x, y) of the i-th road cell.
+    fingerprint identifies the roads numbered, the files computed on the road cells keep it to know if they are
+    still valid
+    """
+    def __init__(self, data_path=None, logger=None, fingerprint=None, name="road"):
+        self._data_path = data_path if data_path is not None else args.data_path
+        self._log = logger
+        self.name = name
+        self.fingerprint = fingerprint
+        self.road_index = None
+        self.cells = None
+
+    def _file_index(self):
+        return "{}/{}_index.npy".format(_folder(self._data_path), self.name)
+
+    def _file_cells(self):
+        return "{}/{}_cells.npy".format(_folder(self._data_path), self.name)
+
+    def _file_fingerprint(self):
+        return "{}/{}_cells.fingerprint".format(_folder(self._data_path), self.name)
+
+    def exists(self):
+        return os.path.isfile(self._file_index()) and os.path.isfile(self._file_cells()) and \
+            read_road_fingerprint(self._file_fingerprint()) == self.fingerprint
+
+    def __len__(self):
+        return len(self.cells)
+
+    def build(self, roads):
+        """
+        Number the road cells row by row and save the numbering on file
+        :param roads: SubMatrix with the mmap data loaded or RoadMask
+        :return:
+        """
+        if not os.path.isdir(_folder(self._data_path)):
+            os.makedirs(_folder(self._data_path))
+        shape = roads.get_shape()
+        road_index = np.lib.format.open_memmap(self._file_index(), mode="w+", dtype=np.int32, shape=shape)
+        cells = []
+        total = 0
+        for start in range(0, shape[0], ROWS_CHUNK):
+            mask = roads.get_road_mask(start=start, end=min(start + ROWS_CHUNK, shape[0]))
+            numbering = np.cumsum(mask, dtype=np.int64).reshape(mask.shape) - 1 + total
+            road_index[start:start + mask.shape[0]] = np.where(mask, numbering, -1)
+            xs, ys = np.nonzero(mask)
+            cells.append(np.stack((xs + start, ys), axis=1).astype(np.int32))
+            total += len(xs)
+        road_index.flush()
+        np.save(self._file_cells(), np.concatenate(cells) if len(cells) > 0 else np.zeros((0, 2), dtype=np.int32))
+        del road_index
+        self.fingerprint = roads.get_road_fingerprint()
+        write_road_fingerprint(self._file_fingerprint(), self.fingerprint)
+        if self._log is not None:
+            self._log.debug("{} road cells numbered".format(total))
+        self.load()
+
+    def load(self):
+        """
+        Open the numbering saved on file
+        :return:
+        """
+        # indexing a np.memmap goes through its python __getitem__, the ndarray view does not
+        self.road_index = np.load(self._file_index(), mmap_mode="r").view(np.ndarray)
+        self.cells = np.load(self._file_cells(), mmap_mode="r").view(np.ndarray)
+        self.fingerprint = read_road_fingerprint(self._file_fingerprint())
+
+    def __getstate__(self):
+        # the arrays are opened again from file, they are not copied to the workers
+        return {"_data_path": self._data_path, "_log": None, "name": self.name}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.load()
+
+
+def load_road_cells(pre_matrix, data_path=None, logger=None, road_mask=None):
+    """
+    Return the numbering of the road cells.
+    It is opened only the first time, then it is kept for the entire process.
+    If it does not exist on file yet, or it was built on different roads, it is built
+    :param pre_matrix: SubMatrix with the mmap data loaded
+    :param data_path: folder for the files. If None, args.data_path is used
+    :param logger: logger
+    :param road_mask: RoadMask of the APF to number its roads (default generator), None for the roads of
+    pre_matrix
+    :return: RoadCells
+    """
+    if data_path is None:
+        data_path = args.data_path
+    roads = pre_matrix if road_mask is None else road_mask
+    name = "road" if road_mask is None else "apf_road"
+    road_cells = _ROAD_CELLS.get((data_path, name))
+    if road_cells is None:
+        road_cells = RoadCells(data_path=data_path, logger=logger, fingerprint=roads.get_road_fingerprint(),
+                               name=name)
+        if road_cells.exists():
+            road_cells.load()
+        else:
+            road_cells.build(roads=roads)
+        _ROAD_CELLS[(data_path, name)] = road_cells
+    return road_cells
+
+
+class BaseStack(object):
+    """
+    Distance of every road cell from the objects of every typology, one row per typology.
+    The charge is linear in the genome (sum(distance_tag * genome_tag * K)), so the charge field of any genome is
+    the weighted sum of the rows
+    """
+    def __init__(self, road_cells, data_path=None, logger=None):
+        self._road_cells = road_cells
+        self._data_path = data_path if data_path is not None else args.data_path
+        self._log = logger
+        self.stack = None
+
+    def _file_stack(self):
+        return "{}/base_stack.npy".format(_folder(self._data_path))
+
+    def _file_fingerprint(self):
+        return "{}/base_stack.fingerprint".format(_folder(self._data_path))
+
+    def exists(self):
+        return os.path.isfile(self._file_stack()) and \
+            read_road_fingerprint(self._file_fingerprint()) == self._road_cells.fingerprint
+
+    def nbytes(self):
+        return self.stack.nbytes
+
+    def build(self, pre_matrix):
+        """
+        Read the distances of all the road cells and save them on file
+        :param pre_matrix: SubMatrix with the mmap data loaded
+        :return:
+        """
+        cells = self._road_cells.cells
+        stack = None
+        for start in range(0, len(cells), CELLS_CHUNK):
+            chunk = cells[start:start + CELLS_CHUNK]
+            distances = pre_matrix.return_distance_from_points(xs=chunk[:, 0], ys=chunk[:, 1])
+            if stack is None:
+                stack = np.lib.format.open_memmap(self._file_stack(), mode="w+", dtype=distances.dtype,
+                                                  shape=(distances.shape[1], len(cells)))
+            stack[:, start:start + len(chunk)] = distances.T
+        if stack is not None:
+            stack.flush()
+            del stack
+        write_road_fingerprint(self._file_fingerprint(), self._road_cells.fingerprint)
+        self.load()
+
+    def load(self):
+        """
+        Open the stack saved on file
+        :return:
+        """
+        self.stack = np.load(self._file_stack(), mmap_mode="r").view(np.ndarray)
+
+    def weighted_sum(self, genome, K):
+        """
+        Charge of all the road cells for the genome.
+        The rows are added one by one in the order of the tags, so the values are exactly the ones of
+        SubMatrix.return_charge_from_points (a tensordot would change the last digits)
+        :param genome: genome
+        :param K: constant for the computation of the charge
+        :return: array of charges
+        """
+        weights = np.array(genome)
+        values = np.zeros(self.stack.shape[1], dtype=np.float64)
+        for start in range(0, self.stack.shape[1], CELLS_CHUNK):
+            chunk = values[start:start + CELLS_CHUNK]
+            for tag in range(self.stack.shape[0]):
+                chunk += self.stack[tag, start:start + CELLS_CHUNK].astype(np.float64) * weights[tag] * K
+        return values
+
+    def get_charge_field(self, genome, K):
+        """
+        Charge field of any genome, computed from the stack
+        :param genome: genome
+        :param K: constant for the computation of the charge
+        :return: ChargeField
+        """
+        return ChargeField(road_cells=self._road_cells, genome=genome, K=K, data_path=self._data_path,
+                           base_stack=self)
+
+    def __getstate__(self):
+        # the stack is opened again from file, it is not copied to the workers
+        return {"_road_cells": self._road_cells, "_data_path": self._data_path, "_log": None}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.load()
+
+
+def load_base_stack(pre_matrix, data_path=None, logger=None):
+    """
+    Return the stack of the distances per typology.
+    It is opened only the first time, then it is kept for the entire process.
+    If it does not exist on file yet, or it was built on different roads, it is built
+    :param pre_matrix: SubMatrix with the mmap data loaded
+    :param data_path: folder for the files. If None, args.data_path is used
+    :param logger: logger
+    :return: BaseStack
+    """
+    if data_path is None:
+        data_path = args.data_path
+    base_stack = _BASE_STACKS.get(data_path)
+    if base_stack is None:
+        road_cells = load_road_cells(pre_matrix=pre_matrix, data_path=data_path, logger=logger)
+        base_stack = BaseStack(road_cells=road_cells, data_path=data_path, logger=logger)
+        if base_stack.exists():
+            base_stack.load()
+        else:
+            start_time = time.time()
+            base_stack.build(pre_matrix=pre_matrix)
+            if logger is not None:
+                logger.info("Base stack of the charge fields built in {:.2f}s, {} road cells, {:.1f} MB".format(
+                    time.time() - start_time, len(road_cells), base_stack.nbytes() / 1024 / 1024))
+        _BASE_STACKS[data_path] = base_stack
+    return base_stack
+
+
+class ChargeField(object):
+    """
+    Charge of every road cell for one genome.
+    The values are the same returned by SubMatrix.return_charge_from_point, computed once for all the road cells
+    (from the base stack if one is given) and saved on file, the workers only open the file
+    """
+    def __init__(self, road_cells, genome, K, data_path=None, base_stack=None):
+        self._road_cells = road_cells
+        self._data_path = data_path if data_path is not None else args.data_path
+        self._base_stack = base_stack
+        self.genome = tuple(genome)
+        self.K = K
+        self.key = genome_hash(genome=genome, K=K)
+        self.values = None
+
+    def _file_values(self):
+        return "{}/charge_{}.npy".format(_folder(self._data_path), self.key)
+
+    def _file_fingerprint(self):
+        return "{}/charge_{}.fingerprint".format(_folder(self._data_path), self.key)
+
+    def exists(self):
+        return os.path.isfile(self._file_values()) and \
+            read_road_fingerprint(self._file_fingerprint()) == self._road_cells.fingerprint
+
+    def nbytes(self):
+        """
+        Memory used by the charge field, numbering of the road cells included
+        :return: bytes
+        """
+        return self.values.nbytes + self._road_cells.road_index.nbytes + self._road_cells.cells.nbytes
+
+    def build(self, pre_matrix):
+        """
+        Compute the charge of all the road cells and save it on file
+        :param pre_matrix: SubMatrix with the mmap data loaded
+        :return:
+        """
+        cells = self._road_cells.cells
+        values = np.lib.format.open_memmap(self._file_values(), mode="w+", dtype=np.float64, shape=(len(cells),))
+        if self._base_stack is not None:
+            values[:] = self._base_stack.weighted_sum(genome=self.genome, K=self.K)
+        else:
+            for start in range(0, len(cells), CELLS_CHUNK):
+                chunk = cells[start:start + CELLS_CHUNK]
+                values[start:start + len(chunk)] = pre_matrix.return_charge_from_points(
+                    xs=chunk[:, 0], ys=chunk[:, 1], genome=self.genome, K=self.K)
+        values.flush()
+        del values
+        write_road_fingerprint(self._file_fingerprint(), self._road_cells.fingerprint)
+        self.load()
+
+    def load(self):
+        """
+        Open the charge field saved on file
+        :return:
+        """
+        self.values = np.load(self._file_values(), mmap_mode="r").view(np.ndarray)
+
+    def get_charge(self, x, y):
+        """
+        Charge of one cell
+        :param x: x value
+        :param y: y value
+        :return: charge, None if the cell is not on a road
+        """
+        index = self._road_cells.road_index.item(x, y)
+        if index < 0:
+            return None
+        return self.values.item(index)
+
+    def get_road_cells(self, xs, ys):
+        """
+        Road cells of many points
+        :param xs: array of x values
+        :param ys: array of y values
+        :return: array with the position of the points in the numbering of the road cells, -1 if not on a road
+        """
+        return self._road_cells.road_index[xs, ys]
+
+    def get_charges(self, xs, ys):
+        """
+        Charge of many road cells
+        :param xs: array of x values
+        :param ys: array of y values
+        :return: array of charges
+        """
+        indexes = self.get_road_cells(xs=xs, ys=ys)
+        if (indexes < 0).any():
+            raise KeyError("Some of the points are not on a road")
+        return self.values[indexes]
+
+    def __getstate__(self):
+        # the values are opened again from file, they are not copied to the workers
+        state = self.__dict__.copy()
+        state["values"] = None
+        state["_base_stack"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.load()
+
+
+def load_charge_field(pre_matrix, genome, K, data_path=None, logger=None, superposition=False):
+    """
+    Return the charge field of the genome.
+    It is opened only the first time, then it is kept for the entire process.
+    If it is not on file yet, or it was built on different roads, it is built.
+    With superposition the field is built as the weighted sum of the base stack (no distance read for the genome),
+    then it is saved as the other fields
+    :param pre_matrix: SubMatrix with the mmap data loaded
+    :param genome: genome
+    :param K: constant for the computation of the charge
+    :param data_path: folder for the files. If None, args.data_path is used
+    :param logger: logger
+    :param superposition: compute the field from the base stack
+    :return: ChargeField
+    """
+    if data_path is None:
+        data_path = args.data_path
+    key = (data_path, genome_hash(genome=genome, K=K))
+    charge_field = _CHARGE_FIELDS.get(key)
+    if charge_field is None:
+        road_cells = load_road_cells(pre_matrix=pre_matrix, data_path=data_path, logger=logger)
+        if superposition:
+            base_stack = load_base_stack(pre_matrix=pre_matrix, data_path=data_path, logger=logger)
+            charge_field = base_stack.get_charge_field(genome=genome, K=K)
+        else:
+            charge_field = ChargeField(road_cells=road_cells, genome=genome, K=K, data_path=data_path)
+        if charge_field.exists():
+            charge_field.load()
+            if logger is not None:
+                logger.debug("Charge field {} loaded".format(charge_field.key))
+        else:
+            start_time = time.time()
+            charge_field.build(pre_matrix=pre_matrix)
+            if logger is not None:
+                logger.info("Charge field {} for genome {} built{} in {:.2f}s, {} road cells, {:.1f} MB".format(
+                    charge_field.key, charge_field.genome, " from the base stack" if superposition else "",
+                    time.time() - start_time, len(road_cells), charge_field.nbytes() / 1024 / 1024))
+        _CHARGE_FIELDS[key] = charge_field
+    return charge_field
+
+
+class ChargeMemo(object):
+    """
+    Charge of the cells computed the first time they are needed and remembered for the following searches.
+    Same interface of ChargeField. The cells are keyed by their flat index (x * width + y) and the charges are
+    kept in dense arrays sized to the map (only the memory pages touched are actually used) or, if max_size is
+    given, in a LRU dictionary with at most max_size cells
+    """
+    def __init__(self, pre_matrix, genome, K, max_size=None):
+        self._pre_matrix = pre_matrix
+        self.genome = tuple(genome)
+        self.K = K
+        self._max_size = max_size
+        self._width = pre_matrix.get_shape()[1]
+        if max_size is None:
+            size = pre_matrix.get_shape()[0] * self._width
+            self._known = np.zeros(size, dtype=bool)
+            self._values = np.zeros(size, dtype=np.float64)
+        else:
+            self._lru = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get_hit_rate(self):
+        """
+        :return: fraction of the charges read from the memo, None if nothing has been asked yet
+        """
+        total = self.hits + self.misses
+        return self.hits / total if total > 0 else None
+
+    def _remember(self, cell, value):
+        self._lru[cell] = value
+        if len(self._lru) > self._max_size:
+            self._lru.popitem(last=False)
+
+    def get_charge(self, x, y):
+        """
+        Charge of one cell
+        :param x: x value
+        :param y: y value
+        :return: charge
+        """
+        cell = x * self._width + y
+        if self._max_size is None:
+            if self._known[cell]:
+                self.hits += 1
+                return self._values.item(cell)
+        else:
+            value = self._lru.get(cell)
+            if value is not None:
+                self.hits += 1
+                self._lru.move_to_end(cell)
+                return value
+        self.misses += 1
+        value = float(self._pre_matrix.return_charge_from_point(current_position=Point(x, y), genome=self.genome,
+                                                                K=self.K))
+        if self._max_size is None:
+            self._known[cell] = True
+            self._values[cell] = value
+        else:
+            self._remember(cell=cell, value=value)
+        return value
+
+    def get_charges(self, xs, ys):
+        """
+        Charge of many cells
+        :param xs: array of x values
+        :param ys: array of y values
+        :return: array of charges
+        """
+        if self._max_size is not None:
+            return np.array([self.get_charge(x=x, y=y) for x, y in zip(xs.tolist(), ys.tolist())],
+                            dtype=np.float64)
+        cells = xs * self._width + ys
+        missing = ~self._known[cells]
+        number_missing = int(np.count_nonzero(missing))
+        self.hits += len(cells) - number_missing
+        self.misses += number_missing
+        if number_missing > 0:
+            self._values[cells[missing]] = self._pre_matrix.return_charge_from_points(
+                xs=xs[missing], ys=ys[missing], genome=self.genome, K=self.K)
+            self._known[cells[missing]] = True
+        return self._values[cells]
+
+
+def get_charge_memo(pre_matrix, genome, K, max_size=None):
+    """
+    Return the charge memo of the genome for this process, shared by all the searches.
+    Only the memo of the last genome asked is kept
+    :param pre_matrix: SubMatrix with the mmap data loaded
+    :param genome: genome
+    :param K: constant for the computation of the charge
+    :param max_size: maximum number of cells remembered, None for dense arrays without limit
+    :return: ChargeMemo
+    """
+    key = (genome_hash(genome=genome, K=K), max_size)
+    charge_memo = _CHARGE_MEMOS.get(key)
+    if charge_memo is None:
+        _CHARGE_MEMOS.clear()
+        charge_memo = ChargeMemo(pre_matrix=pre_matrix, genome=genome, K=K, max_size=max_size)
+        _CHARGE_MEMOS[key] = charge_memo
+    return charge_memo
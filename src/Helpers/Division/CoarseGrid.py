@@ -0,0 +1,200 @@
+"""
+TrajectoriesAstar. Towards a human-like movements generator based on environmental features
+Copyright (C) 2020  Alessandro Zonta (a.zonta@vu.nl)
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import os
+import time
+
+import numpy as np
+
+from src.Helpers.Division.ChargeField import load_road_cells, genome_hash, read_road_fingerprint, \
+    write_road_fingerprint, ChargeField, CELLS_CHUNK
+from src.Settings.args import args
+from src.Utils.Funcs import NEIGHBOURS_X, NEIGHBOURS_Y
+
+# coarse grids already opened in this process
+_COARSE_GRIDS = {}
+
+# arrays of the grid, one file each
+_ARRAYS = ("cell_of_road", "road_count", "centres", "connected")
+
+
+def _folder(data_path):
+    return "{}/coarse_grid".format(data_path)
+
+
+class CoarseGrid(object):
+    """
+    Cells of CollectionCells seen as a grid, with what the hierarchical search needs to know about them:
+    - cell_of_road[c]: flat position (row * columns + column) of the cell containing the road cell c (RoadCells)
+    - road_count[i, j]: number of road cells in the cell
+    - centres[i, j]: mean x and y of the road cells in the cell
+    - connected[i, j, direction]: a road crosses from the cell to its neighbour in the direction
+    (NEIGHBOURS_X / NEIGHBOURS_Y)
+    """
+    def __init__(self, road_cells, data_path=None, logger=None):
+        self._road_cells = road_cells
+        self._data_path = data_path if data_path is not None else args.data_path
+        self._log = logger
+        for name in _ARRAYS:
+            setattr(self, name, None)
+        # attraction of the cells for the last genome asked
+        self._attraction_key = None
+        self._attraction = None
+
+    def _file(self, name):
+        return "{}/{}.npy".format(_folder(self._data_path), name)
+
+    def _file_fingerprint(self):
+        return "{}/coarse_grid.fingerprint".format(_folder(self._data_path))
+
+    def exists(self):
+        return all(os.path.isfile(self._file(name=name)) for name in _ARRAYS) and \
+            read_road_fingerprint(self._file_fingerprint()) == self._road_cells.fingerprint
+
+    def get_shape(self):
+        return self.road_count.shape
+
+    def build(self, pre_matrix):
+        """
+        Count the road cells of every cell and find which cells are connected by a road
+        :param pre_matrix: SubMatrix with the mmap data loaded
+        :return:
+        """
+        shape = pre_matrix.get_grid_shape()
+        road_index = self._road_cells.road_index
+        cells = np.asarray(self._road_cells.cells).astype(np.int64)
+        positions = np.zeros((len(cells), 2), dtype=np.int64)
+        for start in range(0, len(cells), CELLS_CHUNK):
+            chunk = cells[start:start + CELLS_CHUNK]
+            positions[start:start + len(chunk)] = pre_matrix.get_cell_positions(xs=chunk[:, 0], ys=chunk[:, 1])
+        cell_of_road = (positions[:, 0] * shape[1] + positions[:, 1]).astype(np.int32)
+        road_count = np.bincount(cell_of_road, minlength=shape[0] * shape[1])
+        centres = np.zeros((shape[0] * shape[1], 2), dtype=np.float64)
+        for axis in range(2):
+            centres[:, axis] = np.bincount(cell_of_road, weights=cells[:, axis], minlength=shape[0] * shape[1])
+        centres[road_count > 0] /= road_count[road_count > 0, None]
+
+        # direction in the grid from the difference of row and column
+        directions = np.full((3, 3), -1, dtype=np.int64)
+        for direction in range(len(NEIGHBOURS_X)):
+            directions[NEIGHBOURS_X[direction] + 1, NEIGHBOURS_Y[direction] + 1] = direction
+        connected = np.zeros((shape[0], shape[1], len(NEIGHBOURS_X)), dtype=bool)
+        for direction in range(len(NEIGHBOURS_X)):
+            next_xs = cells[:, 0] + NEIGHBOURS_X[direction]
+            next_ys = cells[:, 1] + NEIGHBOURS_Y[direction]
+            inside = (next_xs >= 0) & (next_xs < road_index.shape[0]) & (next_ys >= 0) & \
+                     (next_ys < road_index.shape[1])
+            neighbours = np.full(len(cells), -1, dtype=np.int64)
+            neighbours[inside] = road_index[next_xs[inside], next_ys[inside]]
+            crossing = neighbours >= 0
+            crossing[crossing] = cell_of_road[neighbours[crossing]] != cell_of_road[crossing]
+            from_positions = positions[crossing]
+            to_positions = positions[neighbours[crossing]]
+            difference = to_positions - from_positions + 1
+            connected[from_positions[:, 0], from_positions[:, 1],
+                      directions[difference[:, 0], difference[:, 1]]] = True
+
+        if not os.path.isdir(_folder(self._data_path)):
+            os.makedirs(_folder(self._data_path))
+        values = {"cell_of_road": cell_of_road, "road_count": road_count.reshape(shape),
+                  "centres": centres.reshape(shape[0], shape[1], 2), "connected": connected}
+        for name in _ARRAYS:
+            np.save(self._file(name=name), values[name])
+        write_road_fingerprint(self._file_fingerprint(), self._road_cells.fingerprint)
+        if self._log is not None:
+            self._log.debug("Coarse grid: {} cells, {} with roads".format(shape[0] * shape[1],
+                                                                          np.count_nonzero(road_count)))
+        self.load()
+
+    def load(self):
+        """
+        Open the grid saved on file
+        :return:
+        """
+        for name in _ARRAYS:
+            setattr(self, name, np.load(self._file(name=name), mmap_mode="r").view(np.ndarray))
+
+    def get_attraction(self, genome, K, pre_matrix, charge_field=None):
+        """
+        Mean charge of the road cells of every cell, 0 for the cells without roads.
+        Only the attraction of the last genome asked is kept, and it is sent to the workers with the grid
+        (the Controller computes it before starting them)
+        :param genome: genome
+        :param K: constant for the computation of the charge
+        :param pre_matrix: SubMatrix with the mmap data loaded
+        :param charge_field: ChargeField of the genome, None to use pre_matrix. A ChargeMemo is not used: all the
+        road cells would go through it
+        :return: matrix rows x columns
+        """
+        key = genome_hash(genome=genome, K=K)
+        if self._attraction_key != key:
+            if not isinstance(charge_field, ChargeField):
+                charge_field = None
+            cells = self._road_cells.cells
+            charges = np.zeros(len(cells), dtype=np.float64)
+            for start in range(0, len(cells), CELLS_CHUNK):
+                chunk = cells[start:start + CELLS_CHUNK]
+                if charge_field is not None:
+                    charges[start:start + len(chunk)] = charge_field.get_charges(xs=chunk[:, 0], ys=chunk[:, 1])
+                else:
+                    charges[start:start + len(chunk)] = pre_matrix.return_charge_from_points(
+                        xs=chunk[:, 0], ys=chunk[:, 1], genome=genome, K=K)
+            road_count = self.road_count.ravel()
+            totals = np.bincount(self.cell_of_road, weights=charges, minlength=len(road_count))
+            attraction = np.zeros(len(road_count), dtype=np.float64)
+            attraction[road_count > 0] = totals[road_count > 0] / road_count[road_count > 0]
+            self._attraction = attraction.reshape(self.road_count.shape)
+            self._attraction_key = key
+        return self._attraction
+
+    def __getstate__(self):
+        # the arrays are opened again from file, they are not copied to the workers.
+        # The attraction is small (one value per cell of the grid) and it is sent, so the workers do not compute it
+        return {"_road_cells": self._road_cells, "_data_path": self._data_path, "_log": None,
+                "_attraction_key": self._attraction_key, "_attraction": self._attraction}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.load()
+
+
+def load_coarse_grid(pre_matrix, data_path=None, logger=None):
+    """
+    Return the coarse grid.
+    It is opened only the first time, then it is kept for the entire process.
+    If it does not exist on file yet, or it was built on different roads, it is built
+    :param pre_matrix: SubMatrix with the mmap data loaded
+    :param data_path: folder for the files. If None, args.data_path is used
+    :param logger: logger
+    :return: CoarseGrid
+    """
+    if data_path is None:
+        data_path = args.data_path
+    coarse_grid = _COARSE_GRIDS.get(data_path)
+    if coarse_grid is None:
+        road_cells = load_road_cells(pre_matrix=pre_matrix, data_path=data_path, logger=logger)
+        coarse_grid = CoarseGrid(road_cells=road_cells, data_path=data_path, logger=logger)
+        if coarse_grid.exists():
+            coarse_grid.load()
+        else:
+            start_time = time.time()
+            coarse_grid.build(pre_matrix=pre_matrix)
+            if logger is not None:
+                logger.info("Coarse grid {}x{} built in {:.2f}s".format(
+                    coarse_grid.get_shape()[0], coarse_grid.get_shape()[1], time.time() - start_time))
+        _COARSE_GRIDS[data_path] = coarse_grid
+    return coarse_grid
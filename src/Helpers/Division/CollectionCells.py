@@ -32,6 +32,9 @@ class CollectionCells(object):
         self._save_and_store = save_and_store
         self.max_values = None
         self.min_values = None
+        # mmap data shared by all the cells
+        self.matrix = None
+        self.indexing = None
 
     def store_current_list_cells(self, name="division_cell_list"):
         """
@@ -129,3 +132,5 @@ class CollectionCells(object):
         ndexing = np.memmap(name_file, dtype='int16', mode='r', shape=(6159, 6083, 2))
         for k, cell in self._list_cells.items():
             cell._indexing = ndexing
+        self.matrix = data_input
+        self.indexing = ndexing
@@ -20,6 +20,7 @@ import sys
 from haversine import haversine
 import numpy as np
 from src.Helpers.Division.CollectionCells import CollectionCells
+from src.Loaders.LoadAPF import RoadMask, get_source_signature, compute_road_fingerprint
 from src.Settings.args import args
 
 
@@ -29,8 +30,17 @@ class SubMatrix(object):
         self._list_points = list_points
         self._list_of_cells = None
         self._match_key_index = None
+        self._cell_index_lookup = None
+        # plain ndarray views of the mmap data, for the vectorised methods
+        self._coordinate_index_array = None
+        self._indexing_array = None
+        self._distances_array = None
+        self._tags = None
         self._save_and_store = save_and_store
         self._values_matrix = values_matrix
+        # RoadMask of indexing_fast for the road checks (load_road_mask), None to check indexing_fast
+        self._road_mask = None
+        self._road_fingerprint = None
 
         name_file = "{}/matrix_id_matrix_mmap.dat".format(args.data_path)
         self._coordinate_index = np.memmap(name_file, dtype='int8', mode='r', shape=(6159, 6201, 2))
@@ -65,11 +75,45 @@ class SubMatrix(object):
             self._log.debug("Point division loaded from file")
 
         self._list_of_cells.load_mmap_data()
+        self._load_cell_index_lookup()
         #
         # # for performance support
         self._log = None
         self._list_points = None
 
+    def _load_cell_index_lookup(self):
+        """
+        Matrix from the raw id of the cell stored in self._coordinate_index to the index of the cell in the mmap data
+        Raw ids are int8, so they are shifted by 128. Ids without a cell are -1
+        :return:
+        """
+        self._cell_index_lookup = np.full((256, 256), -1, dtype=np.int32)
+        for key, cell in self._list_of_cells.get_all_cells().items():
+            id_i, id_j = (int(value) for value in key.split("-"))
+            if -128 <= id_i < 128 and -128 <= id_j < 128:
+                self._cell_index_lookup[id_i + 128, id_j + 128] = cell.index
+        # indexing a np.memmap goes through its python __getitem__, the ndarray view does not
+        self._coordinate_index_array = self._coordinate_index.view(np.ndarray)
+        self._indexing_array = self._list_of_cells.indexing.view(np.ndarray)
+        self._distances_array = self._list_of_cells.matrix.view(np.ndarray)
+        self._tags = np.arange(len(self._match_key_index.keys()))
+
+    def load_road_mask(self, packed=False):
+        """
+        Memory map the cells with indexing_fast != 0 as a RoadMask, used by the road checks in place of
+        indexing_fast. The first time, or if indexing_fast changed, the mask is computed and saved next to it.
+        The cells on a road of the APF can be different, so the mask of the APF is not used here
+        :param packed: bitpacked mask (8 cells per byte)
+        :return:
+        """
+        source = get_source_signature(file_name="{}/indexing_fast.dat".format(args.data_path),
+                                      shape=self.get_shape())
+        self._road_mask = RoadMask(path="{}/indexing_fast".format(args.data_path), packed=packed, source=source)
+        if self._road_mask.exists():
+            self._road_mask.load()
+        else:
+            self._road_mask.build(apf=self._indexing_array[:, :, 0])
+
     def get_max_min_matrix(self):
         return self._list_of_cells.max_values, self._list_of_cells.min_values
 
@@ -152,6 +196,88 @@ class SubMatrix(object):
         total_charge = vector_distances * np.array(genome) * K
         return np.sum(total_charge)
 
+    def return_distance_from_points(self, xs, ys):
+        """
+        Vectorised version of return_distance_from_point
+        :param xs: array of x values
+        :param ys: array of y values
+        :return: matrix len(xs) x number of tags with the distances
+        """
+        raw_id_cells = self._coordinate_index_array[xs, ys].astype(np.int32) + 128
+        cell_indexes = self._cell_index_lookup[raw_id_cells[:, 0], raw_id_cells[:, 1]]
+        if (cell_indexes < 0).any():
+            raise KeyError("Cell not present for some of the points")
+        values = self._indexing_array[xs, ys]
+        return self._distances_array[values[:, 0, None], values[:, 1, None], self._tags[None, :], 0,
+                                     cell_indexes[:, None]]
+
+    def return_charge_from_points(self, xs, ys, genome, K):
+        """
+        Vectorised version of return_charge_from_point
+        :param xs: array of x values
+        :param ys: array of y values
+        :param genome: multiplier for the attraction
+        :param K: constant for the computation of the charge
+        :return: array of charges
+        """
+        vector_distances = self.return_distance_from_points(xs=xs, ys=ys)
+        total_charge = vector_distances * np.array(genome) * K
+        return np.sum(total_charge, axis=1)
+
+    def check_if_on_a_road(self, xs, ys):
+        """
+        Vectorised check if the points are on a road
+        :param xs: array of x values
+        :param ys: array of y values
+        :return: boolean array
+        """
+        if self._road_mask is not None:
+            return self._road_mask.contains(xs=xs, ys=ys)
+        return self._indexing_array[xs, ys, 0] != 0
+
+    def get_shape(self):
+        """
+        :return: number of rows and columns of the map
+        """
+        return self._indexing_array.shape[:2]
+
+    def get_road_mask(self, start, end):
+        """
+        Boolean mask of the cells on a road for the rows from start to end
+        :param start: first row
+        :param end: last row (excluded)
+        :return: boolean matrix
+        """
+        if self._road_mask is not None:
+            return self._road_mask.get_road_mask(start=start, end=end)
+        return self._indexing_array[start:end, :, 0] != 0
+
+    def get_road_fingerprint(self):
+        """
+        Fingerprint of the cells on a road (compute_road_fingerprint). It is saved next to the files computed on
+        the roads (ChargeField, NeighbourMask, ...), that are built again when the roads change
+        :return: string
+        """
+        if self._road_fingerprint is None:
+            self._road_fingerprint = compute_road_fingerprint(roads=self)
+        return self._road_fingerprint
+
+    def get_grid_shape(self):
+        """
+        :return: number of rows and columns of the grid of cells (the cell with id i-j is in row i and column j)
+        """
+        positions = np.array([[int(value) for value in key.split("-")] for key in self._list_of_cells.get_all_cells()])
+        return tuple(int(value) + 1 for value in positions.max(axis=0))
+
+    def get_cell_positions(self, xs, ys):
+        """
+        Vectorised position in the grid of the cells containing the points
+        :param xs: array of x values
+        :param ys: array of y values
+        :return: matrix len(xs) x 2 with row and column of the cells
+        """
+        return self._coordinate_index_array[xs, ys].astype(np.int32)
+
     def keep_only_points_on_street(self, points):
         """
         Check if the points provided are on a route
@@ -159,6 +285,8 @@ class SubMatrix(object):
         :param points: list of points to check
         :return: list of points from the input list that are actually on a route
         """
+        if self._road_mask is not None:
+            return [p for p in points if self._road_mask.is_road(p.x, p.y)]
         points_on_street = []
         for p in points:
             # id_current_cell = self._list_of_cells.find_current_cell_from_matrix_coord(point=p)
@@ -0,0 +1,167 @@
+"""
+TrajectoriesAstar. Towards a human-like movements generator based on environmental features
+Copyright (C) 2020  Alessandro Zonta (a.zonta@vu.nl)
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import os
+import time
+
+import numpy as np
+
+from src.Helpers.Division.ChargeField import read_road_fingerprint, write_road_fingerprint
+from src.Settings.args import args
+from src.Utils.Funcs import NEIGHBOURS_X, NEIGHBOURS_Y
+from src.Utils.Point import Point
+
+# rows of the map computed together while building the mask
+ROWS_CHUNK = 512
+# directions of the neighbours on a road for every value of the mask, in the order of NEIGHBOURS_X / NEIGHBOURS_Y
+MASK_DIRECTIONS = [np.array([direction for direction in range(len(NEIGHBOURS_X)) if value & (1 << direction)],
+                            dtype=np.int64) for value in range(1 << len(NEIGHBOURS_X))]
+MASK_OFFSETS = [[(int(NEIGHBOURS_X[direction]), int(NEIGHBOURS_Y[direction])) for direction in directions]
+                for directions in MASK_DIRECTIONS]
+
+# neighbour masks already opened in this process
+_NEIGHBOUR_MASKS = {}
+
+
+def _folder(data_path):
+    return "{}/neighbour_mask".format(data_path)
+
+
+class NeighbourMask(object):
+    """
+    One byte per cell of the map: bit d of mask[x, y] is set if the neighbour in the direction d
+    (NEIGHBOURS_X / NEIGHBOURS_Y) is inside the map and on a road.
+    The neighbours on a road of a cell are found reading one byte, without checking the bounds and the road of
+    every neighbour.
+    The roads are the ones of indexing_fast (SubMatrix) for the astar, or the ones of the APF (RoadMask) for the
+    default generator, each saved in its own file (name)
+    """
+    def __init__(self, data_path=None, logger=None, fingerprint=None, name="neighbour_mask"):
+        self._data_path = data_path if data_path is not None else args.data_path
+        self._log = logger
+        self.name = name
+        # fingerprint of the roads (get_road_fingerprint of the SubMatrix or of the RoadMask)
+        self.fingerprint = fingerprint
+        self.mask = None
+
+    def _file_mask(self):
+        return "{}/{}.npy".format(_folder(self._data_path), self.name)
+
+    def _file_fingerprint(self):
+        return "{}/{}.fingerprint".format(_folder(self._data_path), self.name)
+
+    def exists(self):
+        return os.path.isfile(self._file_mask()) and read_road_fingerprint(self._file_fingerprint()) == self.fingerprint
+
+    def build(self, roads):
+        """
+        Compute the mask row by row and save it on file
+        :param roads: SubMatrix with the mmap data loaded or RoadMask
+        :return:
+        """
+        if not os.path.isdir(_folder(self._data_path)):
+            os.makedirs(_folder(self._data_path))
+        shape = roads.get_shape()
+        mask = np.lib.format.open_memmap(self._file_mask(), mode="w+", dtype=np.uint8, shape=shape)
+        for start in range(0, shape[0], ROWS_CHUNK):
+            end = min(start + ROWS_CHUNK, shape[0])
+            # one row more on both sides, and one column of cells off the road on both sides
+            first = max(start - 1, 0)
+            last = min(end + 1, shape[0])
+            road = np.zeros((end - start + 2, shape[1] + 2), dtype=bool)
+            road[first - start + 1:last - start + 1, 1:-1] = roads.get_road_mask(start=first, end=last)
+            chunk = np.zeros((end - start, shape[1]), dtype=np.uint8)
+            for direction in range(len(NEIGHBOURS_X)):
+                neighbours = road[1 + NEIGHBOURS_X[direction]:end - start + 1 + NEIGHBOURS_X[direction],
+                                  1 + NEIGHBOURS_Y[direction]:shape[1] + 1 + NEIGHBOURS_Y[direction]]
+                chunk |= neighbours.astype(np.uint8) << direction
+            mask[start:end] = chunk
+        mask.flush()
+        del mask
+        self.fingerprint = roads.get_road_fingerprint()
+        write_road_fingerprint(self._file_fingerprint(), self.fingerprint)
+        self.load()
+
+    def load(self):
+        """
+        Open the mask saved on file
+        :return:
+        """
+        # indexing a np.memmap goes through its python __getitem__, the ndarray view does not
+        self.mask = np.load(self._file_mask(), mmap_mode="r").view(np.ndarray)
+
+    def get_neighbours(self, x, y):
+        """
+        Neighbours on a road of a cell, same values and order of list_neighbours_vectorised followed by
+        SubMatrix.check_if_on_a_road
+        :param x: x value
+        :param y: y value
+        :return: array with the x values, array with the y values and array with the directions of the neighbours
+        """
+        directions = MASK_DIRECTIONS[self.mask.item(x, y)]
+        return x + NEIGHBOURS_X[directions], y + NEIGHBOURS_Y[directions], directions
+
+    def get_points(self, x, y):
+        """
+        Neighbours on a road of a cell, same points and order of list_neighbours followed by the road check of the
+        roads of the mask (keep_only_points_on_street on the RoadMask of the APF for a mask of the APF,
+        SubMatrix.keep_only_points_on_street for a mask of indexing_fast)
+        :param x: x value
+        :param y: y value
+        :return: list of points
+        """
+        return [Point(x + diff_x, y + diff_y) for diff_x, diff_y in MASK_OFFSETS[self.mask.item(x, y)]]
+
+    def __getstate__(self):
+        # the mask is opened again from file, it is not copied to the workers
+        return {"_data_path": self._data_path, "_log": None, "name": self.name, "fingerprint": self.fingerprint}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.load()
+
+
+def load_neighbour_mask(pre_matrix, data_path=None, logger=None, road_mask=None):
+    """
+    Return the neighbour mask.
+    It is opened only the first time, then it is kept for the entire process.
+    If it does not exist on file yet, or it was built on different roads, it is built
+    :param pre_matrix: SubMatrix with the mmap data loaded
+    :param data_path: folder for the files. If None, args.data_path is used
+    :param logger: logger
+    :param road_mask: RoadMask of the APF to build the mask on its roads (default generator), None for the roads
+    of pre_matrix (astar)
+    :return: NeighbourMask
+    """
+    if data_path is None:
+        data_path = args.data_path
+    roads = pre_matrix if road_mask is None else road_mask
+    name = "neighbour_mask" if road_mask is None else "apf_neighbour_mask"
+    neighbour_mask = _NEIGHBOUR_MASKS.get((data_path, name))
+    if neighbour_mask is None:
+        neighbour_mask = NeighbourMask(data_path=data_path, logger=logger,
+                                       fingerprint=roads.get_road_fingerprint(), name=name)
+        if neighbour_mask.exists():
+            neighbour_mask.load()
+        else:
+            start_time = time.time()
+            neighbour_mask.build(roads=roads)
+            if logger is not None:
+                logger.info("Neighbour mask built in {:.2f}s, {:.1f} MB".format(
+                    time.time() - start_time, neighbour_mask.mask.nbytes / 1024 / 1024))
+        _NEIGHBOUR_MASKS[(data_path, name)] = neighbour_mask
+    return neighbour_mask
@@ -0,0 +1,299 @@
+"""
+TrajectoriesAstar. Towards a human-like movements generator based on environmental features
+Copyright (C) 2020  Alessandro Zonta (a.zonta@vu.nl)
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import os
+import time
+
+import numpy as np
+
+from src.Helpers.Division.ChargeField import load_road_cells, read_road_fingerprint, write_road_fingerprint
+from src.Settings.args import args
+from src.Utils.Funcs import NEIGHBOURS_X, NEIGHBOURS_Y
+
+# road graphs already opened in this process
+_ROAD_GRAPHS = {}
+
+# arrays of the graph, one file each
+_ARRAYS = ("vertex_cells", "vertex_of_cell", "indptr", "targets", "reverse", "cells_indptr", "cells", "distances",
+           "cell_edge", "cell_position")
+
+
+def _folder(data_path):
+    return "{}/road_graph".format(data_path)
+
+
+class RoadGraph(object):
+    """
+    Road cells compressed in a graph.
+    Most of the road cells have exactly two road neighbours, so they form chains. The cells with a different number
+    of neighbours (junctions and dead ends) are the vertices and every chain between two vertices is an edge.
+    A cycle without vertices gets one of its cells as vertex.
+    All the cells are numbered as in RoadCells.
+
+    The edges are directed (every chain is stored in both directions) and kept in CSR form:
+    - vertex_cells[v]: road cell of the vertex v
+    - vertex_of_cell[c]: vertex of the road cell c, -1 if the cell is inside a chain
+    - indptr[v]:indptr[v + 1]: edges leaving the vertex v
+    - targets[e]: vertex reached by the edge e
+    - reverse[e]: edge of the same chain in the opposite direction
+    - cells[cells_indptr[e]:cells_indptr[e + 1]]: cells of the edge in order, target vertex included
+    - distances[...]: metres from the source vertex to the cells of the edge, the last one is the length of the edge
+    - cell_edge[c], cell_position[c]: for the cells inside a chain, one edge passing through the cell and the position
+    of the cell in it, -1 for the vertices
+    """
+    def __init__(self, road_cells, data_path=None, logger=None):
+        self._road_cells = road_cells
+        self._data_path = data_path if data_path is not None else args.data_path
+        self._log = logger
+        for name in _ARRAYS:
+            setattr(self, name, None)
+        # accumulated charge of the edges for the last charge field asked
+        self._edge_charges_key = None
+        self._edge_charges = None
+
+    def _file(self, name):
+        return "{}/{}.npy".format(_folder(self._data_path), name)
+
+    def _file_fingerprint(self):
+        return "{}/road_graph.fingerprint".format(_folder(self._data_path))
+
+    def exists(self):
+        return all(os.path.isfile(self._file(name=name)) for name in _ARRAYS) and \
+            read_road_fingerprint(self._file_fingerprint()) == self._road_cells.fingerprint
+
+    def number_of_vertices(self):
+        return len(self.vertex_cells)
+
+    def number_of_edges(self):
+        return len(self.targets)
+
+    def nbytes(self):
+        return sum(getattr(self, name).nbytes for name in _ARRAYS)
+
+    def build(self, step_costs):
+        """
+        Find the vertices, walk all the chains and save the graph on file
+        :param step_costs: length of the steps per row and direction
+        :return:
+        """
+        road_index = self._road_cells.road_index
+        road_cells = np.asarray(self._road_cells.cells)
+        number_cells = len(road_cells)
+        xs = road_cells[:, 0].astype(np.int64)
+        ys = road_cells[:, 1].astype(np.int64)
+
+        # road neighbours of every road cell and length of the step to them, in the order of NEIGHBOURS_X
+        neighbours = np.full((number_cells, len(NEIGHBOURS_X)), -1, dtype=np.int64)
+        steps = np.zeros((number_cells, len(NEIGHBOURS_X)), dtype=np.float64)
+        for direction in range(len(NEIGHBOURS_X)):
+            next_xs = xs + NEIGHBOURS_X[direction]
+            next_ys = ys + NEIGHBOURS_Y[direction]
+            inside = (next_xs >= 0) & (next_xs < road_index.shape[0]) & (next_ys >= 0) & \
+                     (next_ys < road_index.shape[1])
+            neighbours[inside, direction] = road_index[next_xs[inside], next_ys[inside]]
+            steps[:, direction] = step_costs[xs, direction]
+        present = neighbours >= 0
+        degree = np.count_nonzero(present, axis=1)
+
+        # the two neighbours of the cells inside the chains
+        is_vertex = degree != 2
+        chain_rows = np.flatnonzero(~is_vertex)
+        directions = np.argsort(~present[chain_rows], axis=1, kind="stable")[:, :2]
+        first = np.full(number_cells, -1, dtype=np.int64)
+        second = np.full(number_cells, -1, dtype=np.int64)
+        first_step = np.zeros(number_cells, dtype=np.float64)
+        second_step = np.zeros(number_cells, dtype=np.float64)
+        first[chain_rows] = neighbours[chain_rows, directions[:, 0]]
+        second[chain_rows] = neighbours[chain_rows, directions[:, 1]]
+        first_step[chain_rows] = steps[chain_rows, directions[:, 0]]
+        second_step[chain_rows] = steps[chain_rows, directions[:, 1]]
+        first = first.tolist()
+        second = second.tolist()
+        first_step = first_step.tolist()
+        second_step = second_step.tolist()
+        is_vertex = is_vertex.tolist()
+        visited = [False] * number_cells
+
+        sources = []
+        edge_cells = []
+        edge_distances = []
+
+        def walk_from(source):
+            """
+            Walk all the chains leaving the vertex
+            :param source: road cell of the vertex
+            :return:
+            """
+            for direction in np.flatnonzero(neighbours[source] >= 0).tolist():
+                previous = source
+                current = int(neighbours[source, direction])
+                total = float(steps[source, direction])
+                cells = [current]
+                distances = [total]
+                while not is_vertex[current]:
+                    visited[current] = True
+                    if first[current] != previous:
+                        previous, current, step = current, first[current], first_step[current]
+                    else:
+                        previous, current, step = current, second[current], second_step[current]
+                    total += step
+                    cells.append(current)
+                    distances.append(total)
+                sources.append(source)
+                edge_cells.append(cells)
+                edge_distances.append(distances)
+
+        for cell in np.flatnonzero(degree != 2).tolist():
+            walk_from(source=cell)
+        # the cells not visited are in cycles without vertices
+        for cell in range(number_cells):
+            if not is_vertex[cell] and not visited[cell]:
+                is_vertex[cell] = True
+                walk_from(source=cell)
+
+        vertex_cells = np.flatnonzero(np.array(is_vertex, dtype=bool)).astype(np.int32)
+        vertex_of_cell = np.full(number_cells, -1, dtype=np.int32)
+        vertex_of_cell[vertex_cells] = np.arange(len(vertex_cells), dtype=np.int32)
+
+        # CSR: edges sorted by source vertex, in the order they have been walked
+        sources = vertex_of_cell[np.array(sources, dtype=np.int64)] if len(sources) > 0 else \
+            np.zeros(0, dtype=np.int32)
+        order = np.argsort(sources, kind="stable")
+        indptr = np.zeros(len(vertex_cells) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(sources, minlength=len(vertex_cells)), out=indptr[1:])
+        edge_cells = [edge_cells[edge] for edge in order.tolist()]
+        edge_distances = [edge_distances[edge] for edge in order.tolist()]
+        sources = sources[order]
+        lengths = np.array([len(cells) for cells in edge_cells], dtype=np.int64)
+        cells_indptr = np.zeros(len(edge_cells) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=cells_indptr[1:])
+        cells = np.array([cell for cells_edge in edge_cells for cell in cells_edge], dtype=np.int32)
+        distances = np.array([value for distances_edge in edge_distances for value in distances_edge],
+                             dtype=np.float64)
+        targets = vertex_of_cell[cells[cells_indptr[1:] - 1]] if len(edge_cells) > 0 else \
+            np.zeros(0, dtype=np.int32)
+
+        # an edge is identified by its source and its first cell, the reverse edge starts from the target with the
+        # cell before the target (or the source if the two vertices are neighbours)
+        first_cells = {(int(source), int(cells_edge[0])): edge for edge, (source, cells_edge) in
+                       enumerate(zip(sources.tolist(), edge_cells))}
+        reverse = np.array([first_cells[(int(targets[edge]),
+                                         cells_edge[-2] if len(cells_edge) > 1 else int(vertex_cells[source]))]
+                            for edge, (source, cells_edge) in enumerate(zip(sources.tolist(), edge_cells))],
+                           dtype=np.int32)
+
+        # one edge for every cell inside a chain
+        edge_of_cells = np.repeat(np.arange(len(edge_cells), dtype=np.int32), lengths)
+        position_of_cells = (np.arange(len(cells), dtype=np.int64) - np.repeat(cells_indptr[:-1], lengths))
+        inside_chain = vertex_of_cell[cells] < 0
+        unique_cells, first_positions = np.unique(cells[inside_chain], return_index=True)
+        cell_edge = np.full(number_cells, -1, dtype=np.int32)
+        cell_position = np.full(number_cells, -1, dtype=np.int32)
+        cell_edge[unique_cells] = edge_of_cells[inside_chain][first_positions]
+        cell_position[unique_cells] = position_of_cells[inside_chain][first_positions]
+
+        if not os.path.isdir(_folder(self._data_path)):
+            os.makedirs(_folder(self._data_path))
+        values = {"vertex_cells": vertex_cells, "vertex_of_cell": vertex_of_cell, "indptr": indptr,
+                  "targets": targets.astype(np.int32), "reverse": reverse, "cells_indptr": cells_indptr,
+                  "cells": cells, "distances": distances, "cell_edge": cell_edge, "cell_position": cell_position}
+        for name in _ARRAYS:
+            np.save(self._file(name=name), values[name])
+        write_road_fingerprint(self._file_fingerprint(), self._road_cells.fingerprint)
+        if self._log is not None:
+            self._log.debug("Road graph: {} road cells, {} vertices, {} edges".format(
+                number_cells, len(vertex_cells), len(edge_cells)))
+        self.load()
+
+    def load(self):
+        """
+        Open the graph saved on file
+        :return:
+        """
+        for name in _ARRAYS:
+            setattr(self, name, np.load(self._file(name=name), mmap_mode="r").view(np.ndarray))
+
+    def get_road_cell(self, x, y):
+        """
+        :param x: x value
+        :param y: y value
+        :return: road cell of the point, -1 if it is not on a road
+        """
+        return self._road_cells.road_index.item(x, y)
+
+    def get_positions(self, cells):
+        """
+        :param cells: array of road cells
+        :return: array of x values and array of y values
+        """
+        positions = self._road_cells.cells[cells]
+        return positions[:, 0], positions[:, 1]
+
+    def get_edge_charges(self, charge_field):
+        """
+        Accumulated charge of the cells of every edge (target vertex included).
+        Only the charges of the last charge field asked are kept
+        :param charge_field: ChargeField of the genome
+        :return: array of charges, one per edge
+        """
+        if self._edge_charges_key != charge_field.key:
+            if len(self.cells) > 0:
+                self._edge_charges = np.add.reduceat(charge_field.values[self.cells], self.cells_indptr[:-1])
+            else:
+                self._edge_charges = np.zeros(0, dtype=np.float64)
+            self._edge_charges_key = charge_field.key
+        return self._edge_charges
+
+    def __getstate__(self):
+        # the arrays are opened again from file, they are not copied to the workers
+        return {"_road_cells": self._road_cells, "_data_path": self._data_path, "_log": None}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._edge_charges_key = None
+        self._edge_charges = None
+        self.load()
+
+
+def load_road_graph(pre_matrix, step_costs, data_path=None, logger=None):
+    """
+    Return the road graph.
+    It is opened only the first time, then it is kept for the entire process.
+    If it does not exist on file yet, or it was built on different roads, it is built
+    :param pre_matrix: SubMatrix with the mmap data loaded
+    :param step_costs: length of the steps per row and direction
+    :param data_path: folder for the files. If None, args.data_path is used
+    :param logger: logger
+    :return: RoadGraph
+    """
+    if data_path is None:
+        data_path = args.data_path
+    road_graph = _ROAD_GRAPHS.get(data_path)
+    if road_graph is None:
+        road_cells = load_road_cells(pre_matrix=pre_matrix, data_path=data_path, logger=logger)
+        road_graph = RoadGraph(road_cells=road_cells, data_path=data_path, logger=logger)
+        if road_graph.exists():
+            road_graph.load()
+        else:
+            start_time = time.time()
+            road_graph.build(step_costs=step_costs)
+            if logger is not None:
+                logger.info("Road graph built in {:.2f}s, {} road cells in {} vertices and {} edges, {:.1f} MB".format(
+                    time.time() - start_time, len(road_cells), road_graph.number_of_vertices(),
+                    road_graph.number_of_edges(), road_graph.nbytes() / 1024 / 1024))
+        _ROAD_GRAPHS[data_path] = road_graph
+    return road_graph
@@ -0,0 +1,246 @@
+"""
+TrajectoriesAstar. Towards a human-like movements generator based on environmental features
+Copyright (C) 2020  Alessandro Zonta (a.zonta@vu.nl)
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import os
+import time
+
+import numpy as np
+
+from src.Helpers.Division.ChargeField import load_road_cells, genome_hash, read_road_fingerprint, \
+    write_road_fingerprint, ChargeField, CELLS_CHUNK
+from src.Settings.args import args
+from src.Utils.Funcs import NEIGHBOURS_X, NEIGHBOURS_Y
+
+# successor fields already opened in this process
+_SUCCESSOR_FIELDS = {}
+
+
+def _folder(data_path):
+    return "{}/successor_field".format(data_path)
+
+
+class SuccessorField(object):
+    """
+    Move of the greedy generator (chain_of_neighbours) from every road cell for one genome.
+    The road cells are the ones of the road mask of the APF, the roads chain_of_neighbours moves on:
+    - successor[c]: road cell (RoadCells numbering) of the neighbour on a road with the highest charge,
+    -1 if the cell has no neighbours on a road
+    - step[c]: length in metres of the step to the successor
+    The move only depends on the cell and on the genome, so a path is a sequence of reads of the two arrays
+    """
+    def __init__(self, road_cells, genome, K, data_path=None, logger=None):
+        self._road_cells = road_cells
+        self._data_path = data_path if data_path is not None else args.data_path
+        self._log = logger
+        self.genome = tuple(genome)
+        self.K = K
+        self.key = genome_hash(genome=genome, K=K)
+        self.successor = None
+        self.step = None
+
+    def _file_successor(self):
+        return "{}/successor_{}.npy".format(_folder(self._data_path), self.key)
+
+    def _file_step(self):
+        return "{}/step_{}.npy".format(_folder(self._data_path), self.key)
+
+    def _file_fingerprint(self):
+        return "{}/successor_{}.fingerprint".format(_folder(self._data_path), self.key)
+
+    def exists(self):
+        return os.path.isfile(self._file_successor()) and os.path.isfile(self._file_step()) and \
+            read_road_fingerprint(self._file_fingerprint()) == self._road_cells.fingerprint
+
+    def build(self, pre_matrix, step_costs, charge_field=None):
+        """
+        Find the successor of all the road cells and save the field on file.
+        As in chain_of_neighbours, with the same charge the first neighbour in the order of NEIGHBOURS_X /
+        NEIGHBOURS_Y is chosen
+        :param pre_matrix: SubMatrix with the mmap data loaded
+        :param step_costs: length of the steps per row and direction
+        :param charge_field: ChargeField of the genome, None to compute the charges on pre_matrix. As in
+        compute_charge_points, the cells outside its road cells (indexing_fast) are computed on pre_matrix
+        :return:
+        """
+        road_index = self._road_cells.road_index
+        cells = self._road_cells.cells
+        charges = np.zeros(len(cells), dtype=np.float64)
+        for start in range(0, len(cells), CELLS_CHUNK):
+            chunk = cells[start:start + CELLS_CHUNK].astype(np.int64)
+            missing = np.ones(len(chunk), dtype=bool)
+            if isinstance(charge_field, ChargeField):
+                indexes = charge_field.get_road_cells(xs=chunk[:, 0], ys=chunk[:, 1])
+                missing = indexes < 0
+                charges[start:start + len(chunk)][~missing] = charge_field.values[indexes[~missing]]
+            if missing.any():
+                charges[start:start + len(chunk)][missing] = pre_matrix.return_charge_from_points(
+                    xs=chunk[missing, 0], ys=chunk[missing, 1], genome=self.genome, K=self.K)
+
+        if not os.path.isdir(_folder(self._data_path)):
+            os.makedirs(_folder(self._data_path))
+        successor = np.lib.format.open_memmap(self._file_successor(), mode="w+", dtype=np.int32, shape=(len(cells),))
+        step = np.lib.format.open_memmap(self._file_step(), mode="w+", dtype=np.float64, shape=(len(cells),))
+        for start in range(0, len(cells), CELLS_CHUNK):
+            chunk = cells[start:start + CELLS_CHUNK].astype(np.int64)
+            best_charges = np.full(len(chunk), -np.inf)
+            best = np.full(len(chunk), -1, dtype=np.int64)
+            best_direction = np.zeros(len(chunk), dtype=np.int64)
+            for direction in range(len(NEIGHBOURS_X)):
+                next_xs = chunk[:, 0] + NEIGHBOURS_X[direction]
+                next_ys = chunk[:, 1] + NEIGHBOURS_Y[direction]
+                inside = (next_xs >= 0) & (next_xs < road_index.shape[0]) & (next_ys >= 0) & \
+                         (next_ys < road_index.shape[1])
+                neighbours = np.full(len(chunk), -1, dtype=np.int64)
+                neighbours[inside] = road_index[next_xs[inside], next_ys[inside]]
+                on_road = neighbours >= 0
+                # strictly higher, the first neighbour wins the ties
+                better = on_road.copy()
+                better[on_road] = charges[neighbours[on_road]] > best_charges[on_road]
+                best_charges[better] = charges[neighbours[better]]
+                best[better] = neighbours[better]
+                best_direction[better] = direction
+            successor[start:start + len(chunk)] = best
+            step[start:start + len(chunk)] = np.where(best >= 0, step_costs[chunk[:, 0], best_direction], 0.0)
+        successor.flush()
+        step.flush()
+        del successor, step
+        write_road_fingerprint(self._file_fingerprint(), self._road_cells.fingerprint)
+        self.load()
+
+    def load(self):
+        """
+        Open the field saved on file
+        :return:
+        """
+        # indexing a np.memmap goes through its python __getitem__, the ndarray view does not
+        self.successor = np.load(self._file_successor(), mmap_mode="r").view(np.ndarray)
+        self.step = np.load(self._file_step(), mmap_mode="r").view(np.ndarray)
+
+    def get_road_cell(self, x, y):
+        """
+        Road cell of a point
+        :param x: x value
+        :param y: y value
+        :return: position in the numbering of the road cells, -1 if the point is not on a road
+        """
+        return self._road_cells.road_index.item(x, y)
+
+    def get_positions(self, cells):
+        """
+        Coordinates of road cells
+        :param cells: array of road cells
+        :return: array with the x values, array with the y values
+        """
+        positions = self._road_cells.cells[cells]
+        return positions[:, 0], positions[:, 1]
+
+    def walk(self, starts, total_distances):
+        """
+        Greedy paths from many road cells at once, moving all of them one step per iteration.
+        A path stops at the first step reaching its distance, or on a cell without neighbours on a road: that
+        cell is repeated at the end of the path, as in chain_of_neighbours
+        :param starts: array of road cells
+        :param total_distances: distance to travel, one for all the paths or one per path
+        :return: list of arrays with the road cells of every path (start excluded), list of arrays with the length
+        of their steps
+        """
+        starts = np.asarray(starts, dtype=np.int64)
+        if len(starts) == 0:
+            return [], []
+        total_distances = np.broadcast_to(np.asarray(total_distances, dtype=np.float64), starts.shape)
+        current = starts.copy()
+        travelled = np.zeros(len(starts), dtype=np.float64)
+        active = np.flatnonzero(travelled < total_distances)
+        walks, moves, lengths = [], [], []
+        stuck = []
+        while len(active) > 0:
+            successors = self.successor[current[active]]
+            blocked = successors < 0
+            if blocked.any():
+                stuck.append(active[blocked])
+                active = active[~blocked]
+                successors = successors[~blocked]
+            steps = self.step[current[active]]
+            # added one step at the time, the same sums of chain_of_neighbours
+            travelled[active] += steps
+            current[active] = successors
+            walks.append(active)
+            moves.append(successors)
+            lengths.append(steps)
+            active = active[travelled[active] < total_distances[active]]
+        stuck = np.concatenate(stuck) if len(stuck) > 0 else np.zeros(0, dtype=np.int64)
+        walks.append(stuck)
+        moves.append(current[stuck])
+        lengths.append(np.full(len(stuck), np.nan))
+
+        walks = np.concatenate(walks)
+        # the steps of every path keep the order they were made
+        order = np.argsort(walks, kind="stable")
+        bounds = np.cumsum(np.bincount(walks, minlength=len(starts)))[:-1]
+        moves = np.split(np.concatenate(moves)[order], bounds)
+        lengths = np.split(np.concatenate(lengths)[order], bounds)
+        # the cell repeated on a dead end has no step
+        return moves, [steps[~np.isnan(steps)] for steps in lengths]
+
+    def __getstate__(self):
+        # the arrays are opened again from file, they are not copied to the workers
+        state = self.__dict__.copy()
+        state["_log"] = None
+        state["successor"] = None
+        state["step"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.load()
+
+
+def load_successor_field(pre_matrix, road_mask, genome, K, step_costs, charge_field=None, data_path=None,
+                         logger=None):
+    """
+    Return the successor field of the genome.
+    It is opened only the first time, then it is kept for the entire process.
+    If it is not on file yet, or it was built on different roads, it is built
+    :param pre_matrix: SubMatrix with the mmap data loaded
+    :param road_mask: RoadMask of the APF, the roads of the default generator
+    :param genome: genome
+    :param K: constant for the computation of the charge
+    :param step_costs: length of the steps per row and direction
+    :param charge_field: ChargeField of the genome used to build the field, None to compute the charges on
+    pre_matrix
+    :param data_path: folder for the files. If None, args.data_path is used
+    :param logger: logger
+    :return: SuccessorField
+    """
+    if data_path is None:
+        data_path = args.data_path
+    key = (data_path, genome_hash(genome=genome, K=K))
+    successor_field = _SUCCESSOR_FIELDS.get(key)
+    if successor_field is None:
+        road_cells = load_road_cells(pre_matrix=pre_matrix, data_path=data_path, logger=logger, road_mask=road_mask)
+        successor_field = SuccessorField(road_cells=road_cells, genome=genome, K=K, data_path=data_path,
+                                         logger=logger)
+        if successor_field.exists():
+            successor_field.load()
+        else:
+            start_time = time.time()
+            successor_field.build(pre_matrix=pre_matrix, step_costs=step_costs, charge_field=charge_field)
+            if logger is not None:
+                logger.info("Successor field {} for genome {} built in {:.2f}s, {} road cells".format(
+                    successor_field.key, successor_field.genome, time.time() - start_time, len(road_cells)))
+        _SUCCESSOR_FIELDS[key] = successor_field
+    return successor_field
@@ -0,0 +1,357 @@
+"""
+TrajectoriesAstar. Towards a human-like movements generator based on environmental features
+Copyright (C) 2020  Alessandro Zonta (a.zonta@vu.nl)
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import pickle
+
+import numpy as np
+import shapely
+from scipy.spatial import distance
+from shapely.geometry import Point
+from shapely.prepared import prep
+
+from src.Settings.args import args
+
+LIMIT_TIMESTEPS = 5000
+MAX_FITNESS = 200
+MAX_TOTAL_FITNESS = MAX_FITNESS * 3
+# positions of the hulls used by get_fitness_value in the fitness landscape file
+HULLS_USED = [0, 1, 2, 3, 4, 5, 6, 8, 10]
+# (external, internal, special internal) hulls of the three 2D landscapes, in the order of args.point_distance:
+# (curliness * 100, length), (curliness * 100, further distance), (further distance, length)
+LANDSCAPE_HULLS = [(0, 1, 6), (2, 3, 8), (4, 5, 10)]
+
+# fitness landscapes already loaded in this process, keyed by data path
+_FITNESS_LANDSCAPES = {}
+
+
+class PreparedHull(object):
+    """
+    Hull of the fitness landscape.
+    contains runs against the shapely prepared version of the geometry, distance against the geometry itself
+    (prepared geometries only support predicates)
+    """
+    def __init__(self, geometry):
+        self.geometry = geometry
+        self.centroid = geometry.centroid
+        self._prepared = prep(geometry)
+        if hasattr(shapely, "prepare"):
+            # the vectorised predicates of shapely >= 2 use the geometry prepared in place
+            shapely.prepare(geometry)
+
+    def contains(self, point):
+        return self._prepared.contains(point)
+
+    def distance(self, point):
+        return self.geometry.distance(point)
+
+
+def load_fitness_landscape(data_path=None):
+    """
+    Return the fitness landscape.
+    The file is read only the first time, then the landscape is kept in memory for the entire process
+    :param data_path: folder containing the fitness landscape. If None, args.data_path is used
+    :return: dict position -> PreparedHull
+    """
+    if data_path is None:
+        data_path = args.data_path
+    fitness_landscape = _FITNESS_LANDSCAPES.get(data_path)
+    if fitness_landscape is None:
+        with open("{}/3d_fitness_in_2d_with_limitation.pickle".format(data_path), 'rb') as handle:
+            raw_landscape = pickle.load(handle)
+        fitness_landscape = {idx: PreparedHull(geometry=raw_landscape[idx]) for idx in HULLS_USED}
+        _FITNESS_LANDSCAPES[data_path] = fitness_landscape
+    return fitness_landscape
+
+
+def invalidate_fitness_landscape(data_path=None):
+    """
+    Remove the fitness landscape from memory. It will be read again from file the next time it is needed
+    :param data_path: folder of the landscape to remove. If None, all the landscapes are removed
+    :return:
+    """
+    if data_path is None:
+        _FITNESS_LANDSCAPES.clear()
+    else:
+        _FITNESS_LANDSCAPES.pop(data_path, None)
+
+
+def reload_fitness_landscape(data_path=None):
+    """
+    Read the fitness landscape again from file
+    :param data_path: folder containing the fitness landscape. If None, args.data_path is used
+    :return: dict position -> PreparedHull
+    """
+    if data_path is None:
+        data_path = args.data_path
+    invalidate_fitness_landscape(data_path=data_path)
+    return load_fitness_landscape(data_path=data_path)
+
+
+def _get_fitness_length_curliness(point, external, internal):
+    """
+    Get fitness value
+    :param point: current features
+    :param external: external hull fitness function
+    :param internal: internal hull fitness function
+    :return: distance
+    """
+    if internal.contains(point):
+        actual_distance = 0
+    elif external.contains(point):
+        actual_distance = internal.distance(point)
+    else:
+        actual_distance = -external.distance(point)
+    # if actual_distance < -150:
+    #     actual_distance = -150
+    return actual_distance
+
+
+def _get_distance_to_center(point, internal, new_min=-300):
+    """
+    Return distance to center of the hull
+    :param point: current features
+    :param internal: hull of the fitness landscape
+    :param new_min: min value to normalise the distance to
+    :return: fitness value normalised and raw
+    """
+    centroid = internal.centroid
+    d = -distance.euclidean([centroid.x, centroid.y], [point.x, point.y])
+    max_value = -5000
+    if d < max_value:
+        d = max_value
+    fitness_value = convert(old_max=0, old_min=max_value, new_max=MAX_FITNESS, new_min=new_min, old_value=d)
+    return fitness_value, d
+
+
+def _get_combination_two_fitness_curliness_length(point, internal_normal, internal_special, external):
+    """
+    return fitness from two features (curliness and length).
+    Depending on the result, it returns the value from the center or the normalised value
+    :param point: current features
+    :param internal_normal: internal hull of the fitness landascape
+    :param internal_special: internal hull of the fitness landascape
+    :param external: external hull of the fitness landscape
+    :return:  fitness value current combination of fitness
+    """
+    value_from_curliness_length = _get_fitness_length_curliness(point=point,
+                                                                external=external,
+                                                                internal=internal_normal)
+    if value_from_curliness_length == 0:
+        value_from_curliness_length, _ = _get_distance_to_center(point=point,
+                                                                 internal=internal_special, new_min=100)
+    else:
+        value_from_curliness_length = convert(old_max=0, old_min=-150, new_max=100, new_min=-300,
+                                              old_value=value_from_curliness_length)
+    return value_from_curliness_length
+
+
+def _get_combination_two_fitness_curliness_distance(point, internal_normal, internal_special, external):
+    """
+        return fitness from two features (curliness and distance).
+        Depending on the result, it returns the value from the center or the normalised value
+        :param point: current features
+        :param internal_normal: internal hull of the fitness landascape
+        :param internal_special: internal hull of the fitness landascape
+        :param external: external hull of the fitness landscape
+        :return:  fitness value current combination of fitness
+        """
+    value_from_curliness_distance = _get_fitness_length_curliness(point=point,
+                                                                  external=external,
+                                                                  internal=internal_normal)
+    if value_from_curliness_distance == 0:
+        value_from_curliness_distance, _ = _get_distance_to_center(point=point,
+                                                                   internal=internal_special, new_min=100)
+    else:
+        value_from_curliness_distance = convert(old_max=0, old_min=-150, new_max=100, new_min=-300,
+                                                old_value=value_from_curliness_distance)
+    return value_from_curliness_distance
+
+
+def _get_combination_two_fitness_length_distance(point, internal_normal, internal_special, external):
+    """
+        return fitness from two features (distance and length).
+        Depending on the result, it returns the value from the center or the normalised value
+        :param point: current features
+        :param internal_normal: internal hull of the fitness landascape
+        :param internal_special: internal hull of the fitness landascape
+        :param external: external hull of the fitness landscape
+        :return:  fitness value current combination of fitness
+        """
+    value_from_distance_length = _get_fitness_length_curliness(point=point, external=external,
+                                                               internal=internal_normal)
+    if value_from_distance_length == 0:
+        value_from_distance_length, _ = _get_distance_to_center(point=point, internal=internal_special,
+                                                                new_min=100)
+    else:
+        value_from_distance_length = convert(old_max=0, old_min=-150, new_max=100, new_min=-300,
+                                             old_value=value_from_distance_length)
+    return value_from_distance_length
+
+
+def _get_fitness_length_curliness_vectorised(xs, ys, external, internal):
+    """
+    Vectorised version of _get_fitness_length_curliness
+    :param xs: array of first features
+    :param ys: array of second features
+    :param external: external hull fitness function
+    :param internal: internal hull fitness function
+    :return: array of distances
+    """
+    points = shapely.points(xs, ys)
+    in_internal = shapely.contains_xy(internal.geometry, xs, ys)
+    in_external = shapely.contains_xy(external.geometry, xs, ys)
+    actual_distances = -shapely.distance(external.geometry, points)
+    actual_distances[in_external] = shapely.distance(internal.geometry, points[in_external])
+    actual_distances[in_internal] = 0
+    return actual_distances
+
+
+def _get_distance_to_center_vectorised(xs, ys, internal, new_min=-300):
+    """
+    Vectorised version of _get_distance_to_center, the distance is computed as in the fitness raster
+    (it can differ from scipy euclidean in the last digit)
+    :param xs: array of first features
+    :param ys: array of second features
+    :param internal: hull of the fitness landscape
+    :param new_min: min value to normalise the distance to
+    :return: array of fitness values
+    """
+    centroid = internal.centroid
+    d = -np.sqrt((xs - centroid.x) ** 2 + (ys - centroid.y) ** 2)
+    max_value = -5000
+    d = np.maximum(d, max_value)
+    return convert(old_max=0, old_min=max_value, new_max=MAX_FITNESS, new_min=new_min, old_value=d)
+
+
+def _get_landscape_fitness_values(xs, ys, landscape, distance_to_center):
+    """
+    Fitness from two features on one of the three landscapes, for arrays of features.
+    Same computation of the _get_combination_two_fitness_* functions with distance_to_center, of the converted
+    _get_fitness_length_curliness otherwise
+    :param xs: array of first features
+    :param ys: array of second features
+    :param landscape: position of the landscape in LANDSCAPE_HULLS
+    :param distance_to_center: True if the landscape is in point_distance
+    :return: array of fitness values
+    """
+    fitness_landscape = load_fitness_landscape()
+    external, internal, special = (fitness_landscape[idx] for idx in LANDSCAPE_HULLS[landscape])
+    values = _get_fitness_length_curliness_vectorised(xs=xs, ys=ys, external=external, internal=internal)
+    if not distance_to_center:
+        return convert(old_max=0, old_min=-150, new_max=MAX_FITNESS, new_min=-300, old_value=values)
+    inside = values == 0
+    values = convert(old_max=0, old_min=-150, new_max=100, new_min=-300, old_value=values)
+    values[inside] = _get_distance_to_center_vectorised(xs=xs[inside], ys=ys[inside], internal=special, new_min=100)
+    return values
+
+
+def get_exact_fitness_values(lengths, curliness, further_distances, point_distance):
+    """
+    Vectorised version of get_exact_fitness_value, with the shapely vectorised predicates and distances
+    (shapely >= 2, the older versions compute one value at a time)
+    :param lengths: array of lengths of the paths
+    :param curliness: array of curliness of the paths
+    :param further_distances: array of further distances to start of the paths
+    :param point_distance: terms using the distance to the central point
+    :return: array of fitness values and arrays of the three components
+    """
+    if not hasattr(shapely, "contains_xy"):
+        values = [get_exact_fitness_value(length=length, curliness=curliness_value, further_distance=further_distance,
+                                          point_distance=point_distance)
+                  for length, curliness_value, further_distance in zip(lengths.tolist(), curliness.tolist(),
+                                                                       further_distances.tolist())]
+        return tuple(np.array([value[position] for value in values], dtype=np.float64) for position in range(4))
+
+    value_from_curliness_length = _get_landscape_fitness_values(xs=curliness * 100, ys=lengths, landscape=0,
+                                                                distance_to_center=0 in point_distance)
+    value_from_curliness_distance = _get_landscape_fitness_values(xs=curliness * 100, ys=further_distances,
+                                                                  landscape=1, distance_to_center=1 in point_distance)
+    value_from_distance_length = _get_landscape_fitness_values(xs=further_distances, ys=lengths, landscape=2,
+                                                               distance_to_center=2 in point_distance)
+    return value_from_distance_length + value_from_curliness_length + value_from_curliness_distance, \
+        value_from_distance_length, value_from_curliness_length, value_from_curliness_distance
+
+
+def get_exact_fitness_value(length, curliness, further_distance, point_distance):
+    """
+    Return the fitness value based on the features, computed on the hulls of the fitness landscape
+    :param length: length of the current path
+    :param curliness: curliness of the path
+    :param further_distance: further distance to start of the current path
+    :param point_distance: terms using the distance to the central point
+    :return: fitness value
+    """
+    fitness_landscape = load_fitness_landscape()
+
+    point = Point(curliness * 100, length)
+
+    if 0 in point_distance:
+        value_from_curliness_length = \
+            _get_combination_two_fitness_curliness_length(point=point, internal_normal=fitness_landscape[1],
+                                                          external=fitness_landscape[0],
+                                                          internal_special=fitness_landscape[6])
+        # value_from_curliness_length, _ = _get_distance_to_center(point=point, internal=fitness_landscape[6])
+    else:
+        value_from_curliness_length = _get_fitness_length_curliness(point=point, external=fitness_landscape[0],
+                                                                    internal=fitness_landscape[1])
+        value_from_curliness_length = convert(old_max=0, old_min=-150, new_max=MAX_FITNESS, new_min=-300,
+                                              old_value=value_from_curliness_length)
+
+    point = Point(curliness * 100, further_distance)
+    if 1 in point_distance:
+        value_from_curliness_distance = \
+            _get_combination_two_fitness_curliness_distance(point=point, internal_normal=fitness_landscape[3],
+                                                            external=fitness_landscape[2],
+                                                            internal_special=fitness_landscape[8])
+        # value_from_curliness_distance, _ = _get_distance_to_center(point=point, internal=fitness_landscape[8])
+    else:
+        value_from_curliness_distance = _get_fitness_length_curliness(point=point, external=fitness_landscape[2],
+                                                                      internal=fitness_landscape[3])
+        value_from_curliness_distance = convert(old_max=0, old_min=-150, new_max=MAX_FITNESS, new_min=-300,
+                                              old_value=value_from_curliness_distance)
+
+    point = Point(further_distance, length)
+    if 2 in point_distance:
+        value_from_distance_length = \
+            _get_combination_two_fitness_length_distance(point=point, internal_normal=fitness_landscape[5],
+                                                         external=fitness_landscape[4],
+                                                         internal_special=fitness_landscape[10])
+        # value_from_distance_length, _ = _get_distance_to_center(point=point, internal=fitness_landscape[10])
+    else:
+        value_from_distance_length = _get_fitness_length_curliness(point=point, external=fitness_landscape[4],
+                                                                   internal=fitness_landscape[5])
+        value_from_distance_length = convert(old_max=0, old_min=-150, new_max=MAX_FITNESS, new_min=-300,
+                                              old_value=value_from_distance_length)
+
+    return value_from_distance_length + value_from_curliness_length + value_from_curliness_distance, \
+           value_from_distance_length, value_from_curliness_length, value_from_curliness_distance
+
+
+def convert(old_max, old_min, new_max, new_min, old_value):
+    """
+    Convert one value to another scale
+    :param old_max: old max
+    :param old_min: old min
+    :param new_max: new max
+    :param new_min: new min
+    :param old_value: value to convert
+    :return:
+    """
+    old_range = (old_max - old_min)
+    new_range = (new_max - new_min)
+    new_value = (((old_value - old_min) * new_range) / old_range) + new_min
+    return new_value
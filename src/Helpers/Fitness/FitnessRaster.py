@@ -0,0 +1,384 @@
+"""
+TrajectoriesAstar. Towards a human-like movements generator based on environmental features
+Copyright (C) 2020  Alessandro Zonta (a.zonta@vu.nl)
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import json
+import logging
+import math
+import os
+
+import numpy as np
+import shapely
+from shapely.geometry import Point
+
+from src.Helpers.Fitness.FitnessLandscape import load_fitness_landscape, get_exact_fitness_value, convert, \
+    LANDSCAPE_HULLS, LIMIT_TIMESTEPS, MAX_FITNESS
+from src.Settings.args import args
+
+# names of the three 2D landscapes, in the order of args.point_distance
+LANDSCAPE_NAMES = ["curliness_length", "curliness_distance", "distance_length"]
+# "plain" is the converted signed distance, "centre" the version using the distance to the central point
+VARIANTS = ["plain", "centre"]
+# maximum value of curliness * 100 (the curliness is at most sqrt(2))
+CURLINESS_LIMIT = 150
+# rows of the raster computed together while building it
+BUILD_CHUNK = 256
+# maximum error against the exact fitness (per landscape and variant) accepted without a warning
+MAX_ERROR = 5.0
+
+# fitness rasters already loaded in this process, keyed by (data path, resolution, bilinear)
+_FITNESS_RASTERS = {}
+
+
+def _signed_distance_grid(external, internal, xs, ys):
+    """
+    Signed distance used by _get_fitness_length_curliness for all the points of the grid xs x ys:
+    0 inside the internal hull, distance to the internal hull inside the external one,
+    minus the distance to the external hull outside
+    :param external: external hull (PreparedHull)
+    :param internal: internal hull (PreparedHull)
+    :param xs: x coordinates of the grid
+    :param ys: y coordinates of the grid
+    :return: matrix len(xs) x len(ys) with the signed distance and matrix with the region of every point
+    (0 internal hull or signed distance 0, 1 external hull, 2 outside)
+    """
+    grid_x, grid_y = np.meshgrid(xs, ys, indexing="ij")
+    grid_x = grid_x.ravel()
+    grid_y = grid_y.ravel()
+    if hasattr(shapely, "contains_xy"):
+        # shapely >= 2 vectorised predicates
+        points = shapely.points(grid_x, grid_y)
+        in_internal = shapely.contains_xy(internal.geometry, grid_x, grid_y)
+        in_external = shapely.contains_xy(external.geometry, grid_x, grid_y)
+        to_internal = shapely.distance(internal.geometry, points)
+        to_external = shapely.distance(external.geometry, points)
+        values = np.where(in_internal, 0.0, np.where(in_external, to_internal, -to_external))
+        regions = np.where(in_internal, 0, np.where(in_external, 1, 2))
+        # the points on a border have signed distance 0 and get the fitness of the internal hull
+        regions[values == 0] = 0
+    else:
+        values = np.zeros(grid_x.shape[0], dtype=np.float64)
+        regions = np.zeros(grid_x.shape[0], dtype=np.uint8)
+        for i in range(grid_x.shape[0]):
+            point = Point(grid_x[i], grid_y[i])
+            if internal.contains(point):
+                values[i] = 0
+            elif external.contains(point):
+                values[i] = internal.distance(point)
+                regions[i] = 1
+            else:
+                values[i] = -external.distance(point)
+                regions[i] = 2
+            if values[i] == 0:
+                regions[i] = 0
+    return values.reshape((len(xs), len(ys))), regions.reshape((len(xs), len(ys)))
+
+
+class FitnessRaster(object):
+    """
+    Precompiled version of the fitness landscape.
+
+    Every 2D landscape is sampled on a regular grid over its bounded feature domain
+    (curliness * 100 in [0, CURLINESS_LIMIT], length and further distance in [0, LIMIT_TIMESTEPS])
+    and the component fitness is stored for both variants of args.point_distance.
+    The rasters are saved as .npy files and opened as memmap, so get_fitness_value becomes a few array
+    reads (plus the bilinear interpolation) instead of the shapely point-in-polygon and distance computations.
+
+    The fitness is discontinuous on the border of the hulls, so every raster comes with a region raster
+    (internal hull, external hull, outside) and the cells crossing a border are not used.
+    Features in those cells or outside the domain are not covered and have to be computed on the hulls
+    """
+    def __init__(self, resolution, data_path=None, bilinear=True, logger=None):
+        self.resolution = resolution
+        self.bilinear = bilinear
+        self._data_path = data_path if data_path is not None else args.data_path
+        self._log = logger
+        # upper bound of (x, y) domain for every landscape
+        self.limits = [(CURLINESS_LIMIT, LIMIT_TIMESTEPS), (CURLINESS_LIMIT, LIMIT_TIMESTEPS),
+                       (LIMIT_TIMESTEPS, LIMIT_TIMESTEPS)]
+        self.shapes = [(int(math.ceil(x_limit / resolution)) + 1, int(math.ceil(y_limit / resolution)) + 1)
+                       for x_limit, y_limit in self.limits]
+        self.max_errors = None
+        # rasters[landscape][variant]
+        self.rasters = None
+        # regions[landscape]
+        self.regions = None
+
+    def _folder(self):
+        return "{}/fitness_raster_{}".format(self._data_path, self.resolution)
+
+    def _file_raster(self, landscape, variant):
+        return "{}/{}_{}.npy".format(self._folder(), LANDSCAPE_NAMES[landscape], VARIANTS[variant])
+
+    def _file_region(self, landscape):
+        return "{}/{}_region.npy".format(self._folder(), LANDSCAPE_NAMES[landscape])
+
+    def _file_info(self):
+        return "{}/info.json".format(self._folder())
+
+    def exists(self):
+        return os.path.isfile(self._file_info())
+
+    def build(self, samples=10000):
+        """
+        Sample the fitness landscape on the grid, save the rasters on file and compute the maximum error
+        against the exact values
+        :param samples: number of random features used to compute the maximum error
+        :return:
+        """
+        fitness_landscape = load_fitness_landscape(data_path=self._data_path)
+        if not os.path.isdir(self._folder()):
+            os.makedirs(self._folder())
+        self.rasters = []
+        self.regions = []
+        for landscape in range(len(LANDSCAPE_NAMES)):
+            if self._log is not None:
+                self._log.debug("Building fitness raster {} {}".format(LANDSCAPE_NAMES[landscape],
+                                                                       self.shapes[landscape]))
+            external, internal, special = (fitness_landscape[idx] for idx in LANDSCAPE_HULLS[landscape])
+            centroid = special.centroid
+            plain = np.lib.format.open_memmap(self._file_raster(landscape=landscape, variant=0), mode="w+",
+                                              dtype=np.float32, shape=self.shapes[landscape])
+            centre = np.lib.format.open_memmap(self._file_raster(landscape=landscape, variant=1), mode="w+",
+                                               dtype=np.float32, shape=self.shapes[landscape])
+            regions = np.lib.format.open_memmap(self._file_region(landscape=landscape), mode="w+",
+                                                dtype=np.uint8, shape=self.shapes[landscape])
+            ys = np.arange(self.shapes[landscape][1]) * self.resolution
+            for start in range(0, self.shapes[landscape][0], BUILD_CHUNK):
+                xs = np.arange(start, min(start + BUILD_CHUNK, self.shapes[landscape][0])) * self.resolution
+                signed_distance, regions[start:start + len(xs)] = _signed_distance_grid(external=external,
+                                                                                        internal=internal,
+                                                                                        xs=xs, ys=ys)
+                plain[start:start + len(xs)] = convert(old_max=0, old_min=-150, new_max=MAX_FITNESS, new_min=-300,
+                                                       old_value=signed_distance)
+                # same computation of _get_distance_to_center inside the internal hull
+                to_centre = -np.sqrt((xs[:, None] - centroid.x) ** 2 + (ys[None, :] - centroid.y) ** 2)
+                to_centre = np.maximum(to_centre, -5000)
+                centre[start:start + len(xs)] = np.where(
+                    signed_distance == 0,
+                    convert(old_max=0, old_min=-5000, new_max=MAX_FITNESS, new_min=100, old_value=to_centre),
+                    convert(old_max=0, old_min=-150, new_max=100, new_min=-300, old_value=signed_distance))
+            plain.flush()
+            centre.flush()
+            regions.flush()
+            self.rasters.append([plain, centre])
+            self.regions.append(regions)
+
+        self.max_errors = self.compute_max_errors(samples=samples)
+        with open(self._file_info(), "w") as handle:
+            json.dump({"resolution": self.resolution, "shapes": self.shapes, "limits": self.limits,
+                       "max_errors": self.max_errors}, handle)
+        if self._log is not None:
+            self._log.info("Fitness raster saved, max errors {}".format(self.max_errors))
+            too_large = ["{} {}".format(name, variant) for name, errors in self.max_errors.items()
+                         for variant, error in errors.items() if error > MAX_ERROR]
+            if len(too_large) > 0:
+                self._log.warning("Fitness raster with resolution {}: max error over {} for {}, use a smaller "
+                                  "resolution".format(self.resolution, MAX_ERROR, ", ".join(too_large)))
+
+    def load(self):
+        """
+        Open the rasters saved on file
+        :return:
+        """
+        with open(self._file_info(), "r") as handle:
+            info = json.load(handle)
+        self.max_errors = info["max_errors"]
+        self.rasters = [[np.load(self._file_raster(landscape=landscape, variant=variant), mmap_mode="r")
+                         for variant in range(len(VARIANTS))] for landscape in range(len(LANDSCAPE_NAMES))]
+        self.regions = [np.load(self._file_region(landscape=landscape), mmap_mode="r")
+                        for landscape in range(len(LANDSCAPE_NAMES))]
+        if self._log is not None:
+            self._log.info("Fitness raster with resolution {} loaded, max errors {}".format(self.resolution,
+                                                                                            self.max_errors))
+
+    def compute_max_errors(self, samples=10000, seed=42):
+        """
+        Maximum absolute difference between the raster and the exact fitness computed on the hulls,
+        on random features inside the domain not falling on the border of the hulls
+        :param samples: number of random features to test
+        :param seed: seed of the random features
+        :return: dict landscape -> variant -> max error
+        """
+        random_state = np.random.RandomState(seed)
+        lengths = random_state.uniform(0, LIMIT_TIMESTEPS, samples)
+        curliness = random_state.uniform(0, CURLINESS_LIMIT / 100, samples)
+        further_distances = random_state.uniform(0, LIMIT_TIMESTEPS, samples)
+        max_errors = {name: {variant: 0.0 for variant in VARIANTS} for name in LANDSCAPE_NAMES}
+        for variant, point_distance in enumerate([[], [0, 1, 2]]):
+            for i in range(samples):
+                exact = get_exact_fitness_value(length=lengths[i], curliness=curliness[i],
+                                                further_distance=further_distances[i],
+                                                point_distance=point_distance)
+                from_raster = self.get_fitness_value(length=lengths[i], curliness=curliness[i],
+                                                     further_distance=further_distances[i],
+                                                     point_distance=point_distance)
+                if from_raster is None:
+                    continue
+                # outputs are total, distance_length, curliness_length, curliness_distance
+                for landscape, position in zip(range(len(LANDSCAPE_NAMES)), [2, 3, 1]):
+                    error = float(abs(exact[position] - from_raster[position]))
+                    name = LANDSCAPE_NAMES[landscape]
+                    max_errors[name][VARIANTS[variant]] = max(max_errors[name][VARIANTS[variant]], error)
+        return max_errors
+
+    def _read(self, landscape, variant, x_value, y_value):
+        """
+        Read the value of the raster in the given features
+        :param landscape: index of the landscape
+        :param variant: index of the variant
+        :param x_value: first feature
+        :param y_value: second feature
+        :return: value, None if the features are outside the raster or on the border of a hull
+        """
+        shape = self.shapes[landscape]
+        u = x_value / self.resolution
+        v = y_value / self.resolution
+        if not (0 <= u <= shape[0] - 1 and 0 <= v <= shape[1] - 1):
+            return None
+        i = min(int(u), shape[0] - 2)
+        j = min(int(v), shape[1] - 2)
+        regions = self.regions[landscape]
+        region = regions.item(i, j)
+        if region != regions.item(i + 1, j) or region != regions.item(i, j + 1) or \
+                region != regions.item(i + 1, j + 1):
+            return None
+        raster = self.rasters[landscape][variant]
+        if not self.bilinear:
+            return raster.item(int(round(u)), int(round(v)))
+        du = u - i
+        dv = v - j
+        return (raster.item(i, j) * (1 - dv) + raster.item(i, j + 1) * dv) * (1 - du) + \
+            (raster.item(i + 1, j) * (1 - dv) + raster.item(i + 1, j + 1) * dv) * du
+
+    def _read_many(self, landscape, variant, x_values, y_values):
+        """
+        Vectorised version of _read
+        :param landscape: index of the landscape
+        :param variant: index of the variant
+        :param x_values: array of first features
+        :param y_values: array of second features
+        :return: array of values, boolean array True where the raster covers the features
+        """
+        shape = self.shapes[landscape]
+        u = x_values / self.resolution
+        v = y_values / self.resolution
+        covered = (0 <= u) & (u <= shape[0] - 1) & (0 <= v) & (v <= shape[1] - 1)
+        values = np.zeros(len(u), dtype=np.float64)
+        u = u[covered]
+        v = v[covered]
+        i = np.minimum(u.astype(np.int64), shape[0] - 2)
+        j = np.minimum(v.astype(np.int64), shape[1] - 2)
+        regions = self.regions[landscape]
+        region = regions[i, j]
+        same_region = (region == regions[i + 1, j]) & (region == regions[i, j + 1]) & \
+            (region == regions[i + 1, j + 1])
+        raster = self.rasters[landscape][variant]
+        if not self.bilinear:
+            # np.round rounds half to even as round
+            read = raster[np.round(u).astype(np.int64), np.round(v).astype(np.int64)].astype(np.float64)
+        else:
+            du = u - i
+            dv = v - j
+            read = (raster[i, j].astype(np.float64) * (1 - dv) + raster[i, j + 1] * dv) * (1 - du) + \
+                (raster[i + 1, j].astype(np.float64) * (1 - dv) + raster[i + 1, j + 1] * dv) * du
+        values[covered] = read
+        covered[covered] = same_region
+        return values, covered
+
+    def get_fitness_values(self, lengths, curliness, further_distances, point_distance):
+        """
+        Vectorised version of get_fitness_value
+        :param lengths: array of lengths of the paths
+        :param curliness: array of curliness of the paths
+        :param further_distances: array of further distances to start of the paths
+        :param point_distance: terms using the distance to the central point
+        :return: (array of fitness values and arrays of the three components), boolean array True where the
+        raster covers the features (the values of the other features are not valid)
+        """
+        value_from_curliness_length, covered_curliness_length = self._read_many(
+            landscape=0, variant=1 if 0 in point_distance else 0, x_values=curliness * 100, y_values=lengths)
+        value_from_curliness_distance, covered_curliness_distance = self._read_many(
+            landscape=1, variant=1 if 1 in point_distance else 0, x_values=curliness * 100,
+            y_values=further_distances)
+        value_from_distance_length, covered_distance_length = self._read_many(
+            landscape=2, variant=1 if 2 in point_distance else 0, x_values=further_distances, y_values=lengths)
+        covered = covered_curliness_length & covered_curliness_distance & covered_distance_length
+        return (value_from_distance_length + value_from_curliness_length + value_from_curliness_distance,
+                value_from_distance_length, value_from_curliness_length, value_from_curliness_distance), covered
+
+    def get_fitness_value(self, length, curliness, further_distance, point_distance):
+        """
+        Same output of get_fitness_value, read from the rasters
+        :param length: length of the current path
+        :param curliness: curliness of the path
+        :param further_distance: further distance to start of the current path
+        :param point_distance: terms using the distance to the central point
+        :return: fitness value and the three components, None if the raster does not cover the features
+        """
+        value_from_curliness_length = self._read(landscape=0, variant=1 if 0 in point_distance else 0,
+                                                 x_value=curliness * 100, y_value=length)
+        value_from_curliness_distance = self._read(landscape=1, variant=1 if 1 in point_distance else 0,
+                                                   x_value=curliness * 100, y_value=further_distance)
+        value_from_distance_length = self._read(landscape=2, variant=1 if 2 in point_distance else 0,
+                                                x_value=further_distance, y_value=length)
+        if value_from_curliness_length is None or value_from_curliness_distance is None or \
+                value_from_distance_length is None:
+            return None
+        return value_from_distance_length + value_from_curliness_length + value_from_curliness_distance, \
+            value_from_distance_length, value_from_curliness_length, value_from_curliness_distance
+
+
+def load_fitness_raster(resolution, bilinear=True, data_path=None, logger=None):
+    """
+    Return the fitness raster with the given resolution.
+    It is opened only the first time, then it is kept for the entire process.
+    If it does not exist on file yet, it is built: the Controller loads it before starting the workers, so that
+    they do not build it all together on the same files
+    :param resolution: resolution of the raster (feature units per cell)
+    :param bilinear: True for bilinear interpolation, False for the nearest cell
+    :param data_path: folder containing the fitness landscape. If None, args.data_path is used
+    :param logger: logger
+    :return: FitnessRaster
+    """
+    if data_path is None:
+        data_path = args.data_path
+    key = (data_path, resolution, bilinear)
+    fitness_raster = _FITNESS_RASTERS.get(key)
+    if fitness_raster is None:
+        fitness_raster = FitnessRaster(resolution=resolution, data_path=data_path, bilinear=bilinear, logger=logger)
+        if fitness_raster.exists():
+            fitness_raster.load()
+        else:
+            fitness_raster.build()
+        _FITNESS_RASTERS[key] = fitness_raster
+    return fitness_raster
+
+
+if __name__ == '__main__':
+    # build the fitness raster in advance
+    # python -m src.Helpers.Fitness.FitnessRaster --data_path ... --fitness_raster_resolution 1
+    logger = logging.getLogger("FitnessRaster")
+    logger.setLevel(logging.DEBUG)
+    ch = logging.StreamHandler()
+    ch.setLevel(logging.DEBUG)
+    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    ch.setFormatter(formatter)
+    logger.addHandler(ch)
+
+    raster = FitnessRaster(resolution=args.fitness_raster_resolution if args.fitness_raster_resolution else 1.0,
+                           bilinear=args.fitness_raster_bilinear == 1, logger=logger)
+    raster.build()
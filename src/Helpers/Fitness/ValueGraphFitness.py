@@ -15,191 +15,78 @@ GNU General Public License for more details.
 You should have received a copy of the GNU General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
-import pickle
-
-from scipy.spatial import distance
-from shapely.geometry import Point
+import numpy as np
 
+from src.Helpers.Fitness.FitnessLandscape import get_exact_fitness_value, get_exact_fitness_values
+from src.Helpers.Fitness.FitnessRaster import load_fitness_raster
 from src.Settings.args import args
 
 VAL_NO_DATA = -1
-LIMIT_TIMESTEPS = 5000
-MAX_FITNESS = 200
-MAX_TOTAL_FITNESS = MAX_FITNESS * 3
-
-
-def _get_fitness_length_curliness(point, external, internal):
-    """
-    Get fitness value
-    :param point: current features
-    :param external: external hull fitness function
-    :param internal: internal hull fitness function
-    :return: distance
-    """
-    if internal.contains(point):
-        actual_distance = 0
-    elif external.contains(point):
-        actual_distance = point.distance(internal)
-    else:
-        actual_distance = -point.distance(external)
-    # if actual_distance < -150:
-    #     actual_distance = -150
-    return actual_distance
-
-
-def _get_distance_to_center(point, internal, new_min=-300):
-    """
-    Return distance to center of the hull
-    :param point: current features
-    :param internal: polygon
-    :param new_min: min value to normalise the distance to
-    :return: fitness value normalised and raw
-    """
-    centroid = internal.centroid
-    d = -distance.euclidean([centroid.x, centroid.y], [point.x, point.y])
-    max_value = -5000
-    if d < max_value:
-        d = max_value
-    fitness_value = convert(old_max=0, old_min=max_value, new_max=MAX_FITNESS, new_min=new_min, old_value=d)
-    return fitness_value, d
-
-
-def _get_combination_two_fitness_curliness_length(point, internal_normal, internal_special, external):
-    """
-    return fitness from two features (curliness and length).
-    Depending on the result, it returns the value from the center or the normalised value
-    :param point: current features
-    :param internal_normal: internal hull of the fitness landascape
-    :param internal_special: internal hull of the fitness landascape
-    :param external: external hull of the fitness landscape
-    :return:  fitness value current combination of fitness
-    """
-    value_from_curliness_length = _get_fitness_length_curliness(point=point,
-                                                                external=external,
-                                                                internal=internal_normal)
-    if value_from_curliness_length == 0:
-        value_from_curliness_length, _ = _get_distance_to_center(point=point,
-                                                                 internal=internal_special, new_min=100)
-    else:
-        value_from_curliness_length = convert(old_max=0, old_min=-150, new_max=100, new_min=-300,
-                                              old_value=value_from_curliness_length)
-    return value_from_curliness_length
-
-
-def _get_combination_two_fitness_curliness_distance(point, internal_normal, internal_special, external):
-    """
-        return fitness from two features (curliness and distance).
-        Depending on the result, it returns the value from the center or the normalised value
-        :param point: current features
-        :param internal_normal: internal hull of the fitness landascape
-        :param internal_special: internal hull of the fitness landascape
-        :param external: external hull of the fitness landscape
-        :return:  fitness value current combination of fitness
-        """
-    value_from_curliness_distance = _get_fitness_length_curliness(point=point,
-                                                                  external=external,
-                                                                  internal=internal_normal)
-    if value_from_curliness_distance == 0:
-        value_from_curliness_distance, _ = _get_distance_to_center(point=point,
-                                                                   internal=internal_special, new_min=100)
-    else:
-        value_from_curliness_distance = convert(old_max=0, old_min=-150, new_max=100, new_min=-300,
-                                                old_value=value_from_curliness_distance)
-    return value_from_curliness_distance
 
 
-def _get_combination_two_fitness_length_distance(point, internal_normal, internal_special, external):
-    """
-        return fitness from two features (distance and length).
-        Depending on the result, it returns the value from the center or the normalised value
-        :param point: current features
-        :param internal_normal: internal hull of the fitness landascape
-        :param internal_special: internal hull of the fitness landascape
-        :param external: external hull of the fitness landscape
-        :return:  fitness value current combination of fitness
-        """
-    value_from_distance_length = _get_fitness_length_curliness(point=point, external=external,
-                                                               internal=internal_normal)
-    if value_from_distance_length == 0:
-        value_from_distance_length, _ = _get_distance_to_center(point=point, internal=internal_special,
-                                                                new_min=100)
-    else:
-        value_from_distance_length = convert(old_max=0, old_min=-150, new_max=100, new_min=-300,
-                                             old_value=value_from_distance_length)
-    return value_from_distance_length
-
-
-def get_fitness_value(length, curliness, further_distance):
+def get_fitness_value(length, curliness, further_distance, point_distance=None):
     """
     Return the fitness value based on the features
+    If args.fitness_raster_resolution is set, the value is read from the precompiled fitness raster
+    (see FitnessRaster), otherwise it is computed on the hulls of the fitness landscape
     :param length: length of the current path
     :param curliness: curliness of the path
     :param further_distance: further distance to start of the current path
+    :param point_distance: terms using the distance to the central point. If None, args.point_distance is used
     :return: fitness value
     """
-    fitness_landscape = pickle.load(open("{}/3d_fitness_in_2d_with_limitation.pickle".format(args.data_path), 'rb'))
-    point_distance = args.point_distance
+    if point_distance is None:
+        point_distance = args.point_distance
     if point_distance is None:
         point_distance = []
 
-    point = Point(curliness * 100, length)
+    if args.fitness_raster_resolution is not None:
+        fitness_raster = load_fitness_raster(resolution=args.fitness_raster_resolution,
+                                             bilinear=args.fitness_raster_bilinear == 1)
+        values = fitness_raster.get_fitness_value(length=length, curliness=curliness,
+                                                  further_distance=further_distance, point_distance=point_distance)
+        # None if the features are outside the raster
+        if values is not None:
+            return values
+    return get_exact_fitness_value(length=length, curliness=curliness, further_distance=further_distance,
+                                   point_distance=point_distance)
 
-    if 0 in point_distance:
-        value_from_curliness_length = \
-            _get_combination_two_fitness_curliness_length(point=point, internal_normal=fitness_landscape[1],
-                                                          external=fitness_landscape[0],
-                                                          internal_special=fitness_landscape[6])
-        # value_from_curliness_length, _ = _get_distance_to_center(point=point, internal=fitness_landscape[6])
-    else:
-        value_from_curliness_length = _get_fitness_length_curliness(point=point, external=fitness_landscape[0],
-                                                                    internal=fitness_landscape[1])
-        value_from_curliness_length = convert(old_max=0, old_min=-150, new_max=MAX_FITNESS, new_min=-300,
-                                              old_value=value_from_curliness_length)
 
-    point = Point(curliness * 100, further_distance)
-    if 1 in point_distance:
-        value_from_curliness_distance = \
-            _get_combination_two_fitness_curliness_distance(point=point, internal_normal=fitness_landscape[3],
-                                                            external=fitness_landscape[2],
-                                                            internal_special=fitness_landscape[8])
-        # value_from_curliness_distance, _ = _get_distance_to_center(point=point, internal=fitness_landscape[8])
-    else:
-        value_from_curliness_distance = _get_fitness_length_curliness(point=point, external=fitness_landscape[2],
-                                                                      internal=fitness_landscape[3])
-        value_from_curliness_distance = convert(old_max=0, old_min=-150, new_max=MAX_FITNESS, new_min=-300,
-                                              old_value=value_from_curliness_distance)
-
-    point = Point(further_distance, length)
-    if 2 in point_distance:
-        value_from_distance_length = \
-            _get_combination_two_fitness_length_distance(point=point, internal_normal=fitness_landscape[5],
-                                                         external=fitness_landscape[4],
-                                                         internal_special=fitness_landscape[10])
-        # value_from_distance_length, _ = _get_distance_to_center(point=point, internal=fitness_landscape[10])
-    else:
-        value_from_distance_length = _get_fitness_length_curliness(point=point, external=fitness_landscape[4],
-                                                                   internal=fitness_landscape[5])
-        value_from_distance_length = convert(old_max=0, old_min=-150, new_max=MAX_FITNESS, new_min=-300,
-                                              old_value=value_from_distance_length)
-
-    return value_from_distance_length + value_from_curliness_length + value_from_curliness_distance, \
-           value_from_distance_length, value_from_curliness_length, value_from_curliness_distance
-
-
-def convert(old_max, old_min, new_max, new_min, old_value):
+def get_fitness_values(lengths, curliness, further_distances, point_distance=None):
     """
-    Convert one value to another scale
-    :param old_max: old max
-    :param old_min: old min
-    :param new_max: new max
-    :param new_min: new min
-    :param old_value: value to convert
-    :return:
+    Vectorised version of get_fitness_value.
+    If args.fitness_raster_resolution is set, the values are read from the precompiled fitness raster and only the
+    features it does not cover are computed on the hulls
+    :param lengths: array of lengths of the paths
+    :param curliness: array of curliness of the paths
+    :param further_distances: array of further distances to start of the paths
+    :param point_distance: terms using the distance to the central point. If None, args.point_distance is used
+    :return: array of fitness values and arrays of the three components
     """
-    old_range = (old_max - old_min)
-    new_range = (new_max - new_min)
-    new_value = (((old_value - old_min) * new_range) / old_range) + new_min
-    return new_value
+    if point_distance is None:
+        point_distance = args.point_distance
+    if point_distance is None:
+        point_distance = []
+    lengths = np.asarray(lengths, dtype=np.float64)
+    curliness = np.asarray(curliness, dtype=np.float64)
+    further_distances = np.asarray(further_distances, dtype=np.float64)
+
+    if args.fitness_raster_resolution is None:
+        return get_exact_fitness_values(lengths=lengths, curliness=curliness, further_distances=further_distances,
+                                        point_distance=point_distance)
+    fitness_raster = load_fitness_raster(resolution=args.fitness_raster_resolution,
+                                         bilinear=args.fitness_raster_bilinear == 1)
+    values, covered = fitness_raster.get_fitness_values(lengths=lengths, curliness=curliness,
+                                                        further_distances=further_distances,
+                                                        point_distance=point_distance)
+    if not covered.all():
+        missing = ~covered
+        exact_values = get_exact_fitness_values(lengths=lengths[missing], curliness=curliness[missing],
+                                                further_distances=further_distances[missing],
+                                                point_distance=point_distance)
+        for component, exact_component in zip(values, exact_values):
+            component[missing] = exact_component
+    return values
 
 
 def get_next_point(current_point, direction):
@@ -18,9 +18,11 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 import numpy as np
 
 import random
-from haversine import haversine
 
+from src.Astar.OpenList import BUCKET_WIDTH
 from src.Astar.PointGenerator import PointGenerator
+from src.Helpers.Division.ChargeField import get_charge_memo
+from src.Utils.Funcs import compute_step_costs, get_step_cost
 from src.Utils.Point import Point
 from src.Utils.RandomWrappers import random_wrapper_lognorm
 
@@ -30,26 +32,62 @@ TIMESTEP = 1
 
 class TrajectoryGeneration(object):
     def __init__(self, x_value, values_matrix, apf, genome_meaning, pre_loaded_points,
-                 type_of_generator, pre_matrix, type_astar, genotype=None, total_distance_to_travel=5000):
+                 type_of_generator, pre_matrix, type_astar, genotype=None, total_distance_to_travel=5000,
+                 index_astar="flat", batch_astar=True, step_costs=None, charge_field=None, open_list="heap",
+                 bucket_width=BUCKET_WIDTH, max_open_size=None, max_expansions=None, max_search_time=None,
+                 charge_memo=False, charge_memo_size=None, paths_per_search=1, max_overlap=1.0, road_graph=None,
+                 coarse_grid=None, corridor_width=1, neighbour_mask=None, successor_field=None):
         self.path = []
         self.tra = []
         self.tra_real_coordinates = []
+        # statistics of the last search
+        self.search_report = {}
+        # True if a budget or the beam stopped the last search before reaching the distance
+        self.truncated = False
 
         self._x_value = x_value
 
         self.genome = genotype
         #
         self._values_matrix = values_matrix
+        # length of the steps per row and direction, shared by all the generators
+        self._step_costs = step_costs if step_costs is not None else compute_step_costs(values_matrix=values_matrix)
+        # charge field of the genome, None to compute the charges on pre_matrix
+        self._charge_field = charge_field
+        # remember the charges of the cells across the searches of the process (only without charge field)
+        self._charge_memo = charge_memo
+        self._charge_memo_size = charge_memo_size
+        # greedy moves of the genome for the default generator, None to look for them at every step
+        self._successor_field = successor_field
+        # routing system (RoadMask), only its shape is needed by the astar
         self._apf = apf
         self._genome_meaning = genome_meaning
         self._pre_loaded_points = pre_loaded_points
         self._pre_matrix = pre_matrix
         #
         self.generator = PointGenerator(typology_needed=type_of_generator, pre_matrix=self._pre_matrix,
-                                        type_astar=type_astar)
+                                        type_astar=type_astar, index_astar=index_astar,
+                                        batch_astar=batch_astar, open_list=open_list,
+                                        bucket_width=bucket_width, max_open_size=max_open_size,
+                                        paths_per_search=paths_per_search, max_overlap=max_overlap,
+                                        road_graph=road_graph, coarse_grid=coarse_grid,
+                                        corridor_width=corridor_width, neighbour_mask=neighbour_mask)
+        self._paths_per_search = paths_per_search
         self._total_distance_to_travel = total_distance_to_travel
+        # budgets of every search, None for no limit
+        self._max_expansions = max_expansions
+        self._max_search_time = max_search_time
 
     def create_trajectory(self, random_seed, idx):
+        """
+        Create one trajectory, the first one of create_trajectories
+        :param random_seed: seed for random
+        :param idx: index starting point
+        :return: total distance traveled, the final path, the real coordinates of the path, and the real trajecotry
+        """
+        return self.create_trajectories(random_seed=random_seed, idx=idx)[0]
+
+    def create_trajectories(self, random_seed, idx):
         """
         Function that creates a trajectory from the value of the genome
 
@@ -61,9 +99,14 @@ class TrajectoryGeneration(object):
         -> depending on the method chosen, generate the path
 
         -> transform path into trajectory
+
+        With paths_per_search > 1, or with a sorted list of distances to travel, the astar returns several paths
+        from the same search and every path becomes a trajectory (the distances not reached have no trajectory).
+        self.path, self.tra and self.tra_real_coordinates are the ones of the first trajectory
         :param random_seed: seed for random
         :param idx: index starting point
-        :return: total distance traveled, the final path, the real coordinates of the path, and the real trajecotry
+        :return: list of (total distance traveled, the final path, the real coordinates of the path, and the real
+        trajecotry), one per path
         """
         random.seed(random_seed)
         np.random.seed(random_seed)
@@ -71,7 +114,17 @@ class TrajectoryGeneration(object):
         self.path = []
         self.tra = []
         self.tra_real_coordinates = []
+        self.search_report = {}
         distances = []
+        multiple_distances = isinstance(self._total_distance_to_travel, (list, tuple))
+        charge_field = self._charge_field
+        charge_memo = None
+        if charge_field is None and self._charge_memo:
+            charge_memo = get_charge_memo(pre_matrix=self._pre_matrix, genome=self.genome, K=K,
+                                          max_size=self._charge_memo_size)
+            charge_field = charge_memo
+            # the memo lives across the searches of the process, only the charges asked by this one are reported
+            hits, lookups = charge_memo.hits, charge_memo.hits + charge_memo.misses
         while self.path is None or len(self.path) == 0:
             if self.path is None:
                 self.path = []
@@ -80,25 +133,81 @@ class TrajectoryGeneration(object):
             current_node = Point(x=pre_loaded_point[0], y=pre_loaded_point[1])
             self.path.append(current_node)
             # get the path using the methodology chosen
-            self.path = self.generator.get_path(total_distance=self._total_distance_to_travel,
+            self.path, self.truncated = self.generator.get_path(total_distance=self._total_distance_to_travel,
                                                 genome=self.genome, genome_meaning=self._genome_meaning,
                                                 values_matrix=self._values_matrix, K=K, distances=distances,
                                                 current_node=current_node, apf=self._apf.shape,
-                                                x_value=self._x_value)
+                                                x_value=self._x_value, step_costs=self._step_costs,
+                                                charge_field=charge_field,
+                                                max_expansions=self._max_expansions,
+                                                max_time=self._max_search_time, report=self.search_report,
+                                                road_mask=self._apf, successor_field=self._successor_field)
+            if multiple_distances:
+                # one path per distance, None for the distances not reached
+                self.path = [path for path in self.path if path is not None]
 
+        if charge_memo is not None:
+            self.search_report["charge_memo_hits"] = charge_memo.hits - hits
+            self.search_report["charge_memo_lookups"] = charge_memo.hits + charge_memo.misses - lookups
+
+        paths = self.path if self._paths_per_search > 1 or multiple_distances else [self.path]
+        results = [self._path_to_trajectory(path=path, distances=distances) for path in paths]
+        _, self.tra, self.tra_real_coordinates, self.path = results[0]
+        return results
+
+    def create_trajectories_batch(self, random_seed, idxs):
+        """
+        Create the trajectories of many starting points with the default generator, walking all the paths together
+        on the successor field. The results are the ones of create_trajectory called for every index.
+        Without successor field, or for the starting points not on a road, create_trajectory is called
+        :param random_seed: seed for random
+        :param idxs: indexes starting points
+        :return: list of (total distance traveled, the final path, the real coordinates of the path, and the real
+        trajecotry), one per index
+        """
+        results = [None] * len(idxs)
+        if self._successor_field is not None:
+            starts = []
+            for idx in idxs:
+                pre_loaded_point = self._pre_loaded_points.get_point(idx_tra=idx)
+                starts.append(self._successor_field.get_road_cell(x=int(pre_loaded_point[0]),
+                                                                  y=int(pre_loaded_point[1])))
+            on_road = [i for i in range(len(idxs)) if starts[i] >= 0]
+            cells, steps = self._successor_field.walk(starts=[starts[i] for i in on_road],
+                                                      total_distances=self._total_distance_to_travel)
+            for i, path_cells, path_steps in zip(on_road, cells, steps):
+                if len(path_cells) == 0:
+                    continue
+                # same random numbers of create_trajectory
+                random.seed(random_seed)
+                np.random.seed(random_seed)
+                xs, ys = self._successor_field.get_positions(cells=path_cells)
+                path = [Point(x, y) for x, y in zip(xs.tolist(), ys.tolist())]
+                results[i] = self._path_to_trajectory(path=path, distances=path_steps.tolist())
+        for i in range(len(idxs)):
+            if results[i] is None:
+                results[i] = self.create_trajectory(random_seed=random_seed, idx=idxs[i])
+        return results
+
+    def _path_to_trajectory(self, path, distances):
+        """
+        Transform a path into a trajectory
+        :param path: list of points
+        :param distances: distances between the points of the path, empty to compute them
+        :return: total distance traveled, the trajectory, the real coordinates of the trajectory, and the path
+        """
         if len(distances) == 0:
-            for i in range(len(self.path) - 1):
-                start = self.path[i]
-                end = self.path[i + 1]
-                dis = haversine((self._values_matrix[0][start.x], self._values_matrix[1][start.y]),
-                                (self._values_matrix[0][end.x],
-                                 self._values_matrix[1][end.y])) * 1000  # in metres
+            distances = []
+            for i in range(len(path) - 1):
+                start = path[i]
+                end = path[i + 1]
+                dis = get_step_cost(step_costs=self._step_costs, current_point=start, next_point=end)  # in metres
                 distances.append(dis)
 
         # now I have the path. Need to transform it in to a trajectory
-        self.tra.append(self.path[0])
+        tra = [path[0]]
         i = 0
-        while i < len(self.path) - 1:
+        while i < len(path) - 1:
             # speed is in metres per second
             speed = random_wrapper_lognorm(mean=0, std=1)
             # space is in metres
@@ -112,17 +221,17 @@ class TrajectoryGeneration(object):
                     break
                 current_distance += distances[i]
                 i += 1
-            self.tra.append(self.path[i])
+            tra.append(path[i])
 
-        self.tra_real_coordinates = [Point(self._values_matrix[0][p.x], self._values_matrix[1][p.y]) for p in self.tra]
+        tra_real_coordinates = [Point(self._values_matrix[0][p.x], self._values_matrix[1][p.y]) for p in tra]
 
         # return the distances to every points
         # now we will compute distances every time.
         # what can we use? To the nearest? To the five closest?
         # let's start distance to the nearest
-        total_distances = [self._pre_matrix.return_distance_from_point(current_position=point) for point in self.tra]
+        total_distances = [self._pre_matrix.return_distance_from_point(current_position=point) for point in tra]
 
-        return total_distances, self.tra, self.tra_real_coordinates, self.path
+        return total_distances, tra, tra_real_coordinates, path
 
     def save_trajectory_generated(self):
         """
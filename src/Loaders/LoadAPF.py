@@ -15,38 +15,394 @@ GNU General Public License for more details.
 You should have received a copy of the GNU General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
+import hashlib
+import json
+import logging
+import os
+import struct
+import time
+
 import matplotlib.pyplot as plt
 import numpy as np
 
+from src.Helpers.Division.ChargeField import read_road_fingerprint, write_road_fingerprint
 from src.Settings.args import args
+from src.Utils.Funcs import compute_step_costs
+
+# rows of the APF converted together while building the road mask and the raster, and hashed together for the
+# fingerprint of the roads
+ROWS_CHUNK = 512
+# first bytes of a raster file, followed by the length of the header (uint32 little endian) and the json header
+RASTER_MAGIC = b"APFRAST\x00"
+RASTER_VERSION = 1
+# the raw data of a raster starts at a multiple of RASTER_ALIGNMENT bytes
+RASTER_ALIGNMENT = 64
+# axes of the APF: the rows go from west to east, the columns from south to north (match_index_with_coordinates)
+RASTER_ORIENTATION = {"rows": "west_to_east", "columns": "south_to_north"}
+# orientation of the rows after invert_apf
+_INVERTED_ROWS = {"west_to_east": "east_to_west", "east_to_west": "west_to_east"}
+
+
+def get_source_signature(file_name, shape):
+    """
+    Signature of the matrix a file is built on: shape, size and last modification of the file holding it
+    :param file_name: file with the matrix
+    :param shape: shape of the matrix
+    :return: string
+    """
+    stat = os.stat(file_name)
+    return "{}x{}-{}-{}".format(shape[0], shape[1], stat.st_size, stat.st_mtime_ns)
+
+
+def compute_road_fingerprint(roads):
+    """
+    Shape of the map and hash of the cells on a road. It is saved next to the files computed on the roads
+    (ChargeField, NeighbourMask, ...), that are built again when the roads change
+    :param roads: SubMatrix or RoadMask (get_shape and get_road_mask)
+    :return: string
+    """
+    shape = roads.get_shape()
+    digest = hashlib.sha1()
+    for start in range(0, shape[0], ROWS_CHUNK):
+        mask = roads.get_road_mask(start=start, end=min(start + ROWS_CHUNK, shape[0]))
+        digest.update(np.packbits(mask, axis=1).tobytes())
+    return "{}x{}-{}".format(shape[0], shape[1], digest.hexdigest())
+
+
+class RoadMask(object):
+    """
+    Cells on a road (value != 0) of a matrix, memory mapped from a file saved next to it: the APF for the
+    default generator, indexing_fast for SubMatrix (the two do not always agree).
+    The mask is a numpy bool matrix or, if packed, a uint8 matrix with 8 cells of a row per byte (np.packbits),
+    8 times smaller.
+    The file keeps the rows in the order of the matrix, inverted shows them in the opposite order (invert).
+    source (get_source_signature) identifies the matrix, the mask is built again when it changes
+    """
+    def __init__(self, path, packed=False, source=None):
+        self._path = path
+        self.packed = packed
+        self.source = source
+        self.inverted = False
+        self.shape = None
+        self.mask = None
+        self._road_fingerprint = None
+
+    def _file_mask(self):
+        return "{}.road_mask{}.npy".format(self._path, "_packed" if self.packed else "")
+
+    def _file_shape(self):
+        return "{}.road_mask_shape.npy".format(self._path)
+
+    def _file_source(self):
+        return "{}.road_mask{}.source".format(self._path, "_packed" if self.packed else "")
+
+    def exists(self):
+        return os.path.isfile(self._file_mask()) and os.path.isfile(self._file_shape()) and \
+            read_road_fingerprint(self._file_source()) == self.source
+
+    def build(self, apf):
+        """
+        Compute the mask row by row and save it on file
+        :param apf: Dataframe describing the routing system (or numpy matrix)
+        :return:
+        """
+        values = apf.values if hasattr(apf, "values") else apf
+        shape = values.shape
+        columns = (shape[1] + 7) // 8 if self.packed else shape[1]
+        mask = np.lib.format.open_memmap(self._file_mask(), mode="w+", dtype=np.uint8 if self.packed else bool,
+                                         shape=(shape[0], columns))
+        for start in range(0, shape[0], ROWS_CHUNK):
+            chunk = np.asarray(values[start:start + ROWS_CHUNK]) != 0
+            mask[start:start + len(chunk)] = np.packbits(chunk, axis=1) if self.packed else chunk
+        mask.flush()
+        del mask
+        np.save(self._file_shape(), np.array(shape, dtype=np.int64))
+        if self.source is not None:
+            write_road_fingerprint(self._file_source(), self.source)
+        self.load()
+
+    def load(self):
+        """
+        Open the mask saved on file
+        :return:
+        """
+        self.shape = tuple(int(value) for value in np.load(self._file_shape()))
+        # indexing a np.memmap goes through its python __getitem__, the ndarray view does not
+        self.mask = np.load(self._file_mask(), mmap_mode="r").view(np.ndarray)
+        if self.inverted:
+            self.mask = self.mask[::-1]
+
+    def invert(self):
+        """
+        Invert the order of the rows, without copying the mask
+        :return:
+        """
+        self.inverted = not self.inverted
+        self.mask = self.mask[::-1]
+        self._road_fingerprint = None
+
+    def is_road(self, x, y):
+        """
+        :param x: x value
+        :param y: y value
+        :return: True if the cell is on a road
+        """
+        if self.packed:
+            return (self.mask.item(x, y >> 3) >> (7 - (y & 7))) & 1 == 1
+        return self.mask.item(x, y)
+
+    def contains(self, xs, ys):
+        """
+        Vectorised check if the cells are on a road
+        :param xs: array of x values
+        :param ys: array of y values
+        :return: boolean array
+        """
+        if self.packed:
+            return (self.mask[xs, ys >> 3] >> (7 - (ys & 7)).astype(np.uint8)) & 1 == 1
+        return self.mask[xs, ys]
+
+    def get_shape(self):
+        """
+        :return: number of rows and columns of the map
+        """
+        return self.shape
+
+    def get_road_mask(self, start, end):
+        """
+        Mask of the rows from start to end
+        :param start: first row
+        :param end: last row (excluded)
+        :return: boolean matrix
+        """
+        if self.packed:
+            return np.unpackbits(self.mask[start:end], axis=1, count=self.shape[1]).astype(bool)
+        return self.mask[start:end]
+
+    def get_road_fingerprint(self):
+        """
+        :return: fingerprint of the roads (compute_road_fingerprint), in the order of the rows seen
+        """
+        if self._road_fingerprint is None:
+            self._road_fingerprint = compute_road_fingerprint(roads=self)
+        return self._road_fingerprint
+
+    def __getstate__(self):
+        # the mask is opened again from file, it is not copied to the workers
+        return {"_path": self._path, "packed": self.packed, "source": self.source, "inverted": self.inverted,
+                "_road_fingerprint": self._road_fingerprint}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.load()
+
+
+class APFRaster(object):
+    """
+    APF saved as a binary raster next to the feather file ({path}.raster):
+    magic | length of the header | json header (version, shape, dtype, bounds, orientation) | padding | raw data.
+    The raw data is a C ordered matrix memory mapped without copying, so opening the raster only reads the header
+    """
+    def __init__(self, path):
+        self._path = path
+        self.header = None
+        self.values = None
+
+    def _file_raster(self):
+        return "{}.raster".format(self._path)
+
+    def exists(self):
+        return os.path.isfile(self._file_raster())
+
+    def get_shape(self):
+        return self.values.shape
+
+    def get_signature(self):
+        """
+        :return: signature of the raster (get_source_signature), read from the header and the file
+        """
+        header, _ = self.read_header()
+        return get_source_signature(file_name=self._file_raster(), shape=header["shape"])
+
+    def build(self, apf, bounds=None, orientation=None):
+        """
+        Write the raster row by row
+        :param apf: Dataframe describing the routing system (or numpy matrix)
+        :param bounds: dictionary with north, south, east and west of the APF. If None, the ones in args are used
+        :param orientation: dictionary with the direction of the rows and of the columns. If None,
+        RASTER_ORIENTATION
+        :return:
+        """
+        if bounds is None:
+            bounds = {"north": args.north, "south": args.south, "east": args.east, "west": args.west}
+        values = apf.values if hasattr(apf, "values") else apf
+        dtype = np.dtype(values.dtype).newbyteorder("<")
+        header = json.dumps({"version": RASTER_VERSION, "shape": [int(value) for value in values.shape],
+                             "dtype": dtype.str, "order": "C",
+                             "bounds": {key: float(value) for key, value in bounds.items()},
+                             "orientation": orientation if orientation is not None else RASTER_ORIENTATION})
+        header = header.encode("utf-8")
+        offset = len(RASTER_MAGIC) + 4 + len(header)
+        with open(self._file_raster(), "wb") as handle:
+            handle.write(RASTER_MAGIC)
+            handle.write(struct.pack("<I", len(header)))
+            handle.write(header)
+            handle.write(b"\x00" * (-offset % RASTER_ALIGNMENT))
+            for start in range(0, values.shape[0], ROWS_CHUNK):
+                handle.write(np.ascontiguousarray(values[start:start + ROWS_CHUNK], dtype=dtype).tobytes())
+        self.load()
+
+    def read_header(self):
+        """
+        Read the header of the raster
+        :return: header and position of the raw data in the file
+        """
+        with open(self._file_raster(), "rb") as handle:
+            if handle.read(len(RASTER_MAGIC)) != RASTER_MAGIC:
+                raise ValueError("{} is not an APF raster".format(self._file_raster()))
+            length = struct.unpack("<I", handle.read(4))[0]
+            header = json.loads(handle.read(length).decode("utf-8"))
+        if header["version"] != RASTER_VERSION:
+            raise ValueError("APF raster version {} not supported".format(header["version"]))
+        offset = len(RASTER_MAGIC) + 4 + length
+        return header, offset + (-offset % RASTER_ALIGNMENT)
+
+    def load(self):
+        """
+        Open the raster saved on file
+        :return:
+        """
+        self.header, offset = self.read_header()
+        values = np.memmap(self._file_raster(), dtype=np.dtype(self.header["dtype"]), mode="r", offset=offset,
+                           shape=tuple(self.header["shape"]), order=self.header["order"])
+        # indexing a np.memmap goes through its python __getitem__, the ndarray view does not
+        self.values = values.view(np.ndarray)
+        if self.header["orientation"]["rows"] != RASTER_ORIENTATION["rows"]:
+            # a raster saved inverted is seen with the rows in the usual order
+            self.values = self.values[::-1]
+
+    def __getstate__(self):
+        # the raster is opened again from file, it is not copied to the workers
+        return {"_path": self._path}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.load()
 
 
 class LoadAPF(object):
     """
-    Loads the APF from file
+    Loads the APF from file.
+    The generators only need the road mask (load_road_mask), the values are memory mapped from the raster
+    (load_raster) and the Dataframe is built on them the first time apf is used
     """
     def __init__(self, path, logger=None):
         self._path = path
         self._log = logger
-        self.apf = None
+        self._apf = None
+        self.raster = None
+        # the rows of the values are inverted (invert_apf)
+        self._inverted = False
+        self.road_mask = None
         self.coordinates = {}
         self.x_values = []
         self.y_values = []
+        self.step_costs = None
+
+    @property
+    def apf(self):
+        if self._apf is None:
+            self.load_apf_only_routing_system()
+        return self._apf
+
+    @apf.setter
+    def apf(self, value):
+        self._apf = value
+
+    @property
+    def values(self):
+        """
+        :return: numpy matrix of the APF, memory mapped from the raster
+        """
+        if self.raster is None:
+            self.load_raster()
+        return self.raster.values[::-1] if self._inverted else self.raster.values
+
+    def get_shape(self):
+        """
+        :return: shape of the APF, read from the road mask or from the raster if they are loaded
+        """
+        if self.road_mask is not None:
+            return self.road_mask.shape
+        return self.values.shape
+
+    def read_feather(self):
+        """
+        Reads the APF from the feather file
+        :return: Dataframe describing the routing system
+        """
+        # self.apf = pd.read_feather(self._path)
+        import feather
+        return feather.read_dataframe(self._path)
+
+    def load_raster(self):
+        """
+        Opens the raster of the APF.
+        The first time, the feather file is converted to the raster and saved next to it
+        :return:
+        """
+        start_time = time.time()
+        self.raster = APFRaster(path=self._path)
+        if self.raster.exists():
+            self.raster.load()
+        else:
+            if self._log is not None:
+                self._log.debug("Converting the APF from feather to raster...")
+            self.raster.build(apf=self.read_feather())
+        if self._log is not None:
+            self._log.info("APF raster opened {} in {:.3f}s".format(self.raster.get_shape(), time.time() - start_time))
+            bounds = {"north": args.north, "south": args.south, "east": args.east, "west": args.west}
+            if any(not np.isclose(self.raster.header["bounds"][key], value) for key, value in bounds.items()):
+                self._log.warning("The bounds of the APF raster {} are not the ones in the arguments {}".format(
+                    self.raster.header["bounds"], bounds))
 
     def load_apf_only_routing_system(self):
         """
-         Loads the APF from file
+         Loads the APF from file, as a Dataframe over the values of the raster (no copy)
         :return:
         """
         if self._log is not None:
             self._log.debug("Loading APF from file...")
-        # self.apf = pd.read_feather(self._path)
-        import feather
-        self.apf = feather.read_dataframe(self._path)
+        import pandas as pd
+        self.apf = pd.DataFrame(self.values, copy=False)
         # self.apf.info(verbose=False)
         if self._log is not None:
             self._log.info("APF with routing system loaded {}".format(self.apf.shape))
 
+    def load_road_mask(self, packed=False):
+        """
+        Loads the road mask from file.
+        The first time, or if the raster changed, the mask is computed from the APF and saved next to it.
+        The file follows the rows of the raster, if the APF is inverted the mask is inverted as well
+        :param packed: bitpacked mask (8 cells per byte)
+        :return:
+        """
+        # opening the raster only reads its header
+        if self.raster is None:
+            self.load_raster()
+        self.road_mask = RoadMask(path=self._path, packed=packed, source=self.raster.get_signature())
+        if self.road_mask.exists():
+            self.road_mask.load()
+        else:
+            if self._log is not None:
+                self._log.debug("Building the road mask from the APF...")
+            self.road_mask.build(apf=self.raster.values)
+        if self._inverted:
+            self.road_mask.invert()
+        if self._log is not None:
+            self._log.info("Road mask loaded {}, {:.1f} MB".format(self.road_mask.shape,
+                                                                   self.road_mask.mask.nbytes / 1024 / 1024))
+
     def save_apf(self, path_file="apf.csv"):
         """
         Saves the APF to file
@@ -79,16 +435,20 @@ class LoadAPF(object):
         Invert the APF
         :return:
         """
-        if self.apf is not None:
-            if self._log is not None:
-                self._log.debug("Inverting Heat Map.")
-            self.apf = self.apf.iloc[::-1]
+        if self._log is not None:
+            self._log.debug("Inverting Heat Map.")
+        # the raster and the road mask are seen in the inverted order, the Dataframe is built again on request
+        self._inverted = not self._inverted
+        if self.road_mask is not None:
+            self.road_mask.invert()
+        self.apf = None
 
     def match_index_with_coordinates(self):
         """
         The APF has index from 0 to N
         Every cells correspond to real world coordinates
         This method matches the to systems
+        It also computes the length of the steps per row and direction, used by all the generators
         :return:
         """
         if self._log is not None:
@@ -101,10 +461,28 @@ class LoadAPF(object):
             "west": args.west}
 
         # resolution image
-        x_max = self.apf.shape[0]
-        y_max = self.apf.shape[1]
+        x_max, y_max = self.get_shape()
 
         # creation of the real coordinates
         # now the index correspond to a real coordinate
         self.x_values = np.linspace(start=self.coordinates["west"], stop=self.coordinates["east"], num=x_max)
-        self.y_values = np.linspace(start=self.coordinates["south"], stop=self.coordinates["north"], num=y_max)
\ No newline at end of file
+        self.y_values = np.linspace(start=self.coordinates["south"], stop=self.coordinates["north"], num=y_max)
+        self.step_costs = compute_step_costs(values_matrix=(self.x_values, self.y_values))
+
+
+if __name__ == '__main__':
+    # convert the APF from feather to raster in advance
+    # python -m src.Loaders.LoadAPF --data_path ... --apf_name ...
+    logger = logging.getLogger("LoadAPF")
+    logger.setLevel(logging.DEBUG)
+    ch = logging.StreamHandler()
+    ch.setLevel(logging.DEBUG)
+    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    ch.setFormatter(formatter)
+    logger.addHandler(ch)
+
+    loader = LoadAPF(path=args.data_path + args.apf_name, logger=logger)
+    loader.raster = APFRaster(path=loader._path)
+    loader.raster.build(apf=loader.read_feather())
+    logger.info("APF raster saved in {}, {:.1f} MB".format(loader.raster._file_raster(),
+                                                            loader.raster.values.nbytes / 1024 / 1024))
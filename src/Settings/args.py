@@ -31,6 +31,52 @@ def prepare_parser():
     parser.add_argument("--type_generator", default="astar")
     parser.add_argument("--type_astar", type=int, default=1, choices=[0, 1],
                         help="0 balance attraction and distance, 1 balanced fitness and distance")
+    parser.add_argument("--index_astar", default="flat", choices=["flat", "string"],
+                        help="flat keeps open and closed cells in arrays indexed by x * width + y, "
+                             "string keeps them in dictionaries indexed by x-y")
+    parser.add_argument("--batch_astar", type=int, default=1, choices=[0, 1],
+                        help="1 evaluates all the children of a node together with numpy, 0 one by one")
+    parser.add_argument("--charge_field", type=int, default=0, choices=[0, 1, 2],
+                        help="1 computes the charge of all the road cells once per genome and reads it from there, "
+                             "2 computes it as weighted sum of the distances per typology of all the road cells, "
+                             "0 computes it for every cell visited")
+    parser.add_argument("--charge_memo", type=int, default=0, choices=[0, 1],
+                        help="1 remembers the charge of the cells visited, shared by all the searches of a worker "
+                             "(only without --charge_field)")
+    parser.add_argument("--charge_memo_size", type=int, default=None,
+                        help="maximum number of cells remembered by --charge_memo (LRU), no limit if not set")
+    parser.add_argument("--open_list", default="heap", choices=["heap", "bucket"],
+                        help="heap keeps the open cells of the A* in a binary heap, bucket in a bucket queue over f "
+                             "quantised with --bucket_width (FIFO inside a bucket)")
+    parser.add_argument("--bucket_width", type=float, default=0.0001,
+                        help="width of the buckets of f for --open_list bucket")
+    parser.add_argument("--max_open_size", type=int, default=None,
+                        help="maximum number of cells in the open list of the A*. When it is exceeded the worst "
+                             "cells are pruned (beam search) and their nodes are forgotten. It bounds the open list, "
+                             "the cells already expanded are still kept")
+    parser.add_argument("--max_expansions", type=int, default=None,
+                        help="maximum number of cells expanded by one A* search, then the best partial path is used")
+    parser.add_argument("--max_search_time", type=float, default=None,
+                        help="maximum time in seconds of one A* search, then the best partial path is used")
+    parser.add_argument("--paths_per_search", type=int, default=1,
+                        help="number of paths extracted from every A* search, one trajectory each")
+    parser.add_argument("--max_overlap", type=float, default=1.0,
+                        help="maximum fraction of cells a path can share with the other paths of the same search")
+    parser.add_argument("--road_graph", type=int, default=0, choices=[0, 1],
+                        help="1 runs the A* on the road graph (chains of road cells contracted in edges between "
+                             "junctions), 0 on the road cells")
+    parser.add_argument("--corridor_width", type=int, default=None,
+                        help="if set, a coarse search on the grid of cells picks a corridor first and the A* moves "
+                             "only in the cells within corridor_width cells from it")
+    parser.add_argument("--neighbour_mask", type=int, default=0, choices=[0, 1],
+                        help="1 reads the neighbours on a road of a cell from a byte per cell precomputed once, "
+                             "0 checks the 8 neighbours one by one")
+    parser.add_argument("--successor_field", type=int, default=0, choices=[0, 1],
+                        help="1 precomputes the most attractive neighbour of every road cell for the genome and the "
+                             "default generator walks the paths of a worker together on it")
+    parser.add_argument("--road_mask", default="bool", choices=["bool", "packed"],
+                        help="cells on a road kept as bool matrix or bitpacked (8 cells per byte), both memory mapped "
+                             "from a file next to the APF")
 
     # general settings
     parser.add_argument("--name_exp", default="generate_more_trajectories_bis")
@@ -39,12 +85,19 @@ def prepare_parser():
     parser.add_argument("--apf_name", default="the_right_one_fast")
     parser.add_argument("--n_tra_generated", type=int, default=500)
     parser.add_argument("--x_value", type=int, default=50)
-    parser.add_argument("--total_distance_to_travel", type=int, default=5000)
+    parser.add_argument("--total_distance_to_travel", type=int, nargs="+", default=5000,
+                        help="distance of the trajectories. With several sorted distances (only astar), every search "
+                             "returns one trajectory per distance reached")
 
     # fitness settings
     parser.add_argument("--point_distance", type=eval, choices=["[0]", "[1]", "[2]", "[0, 1]", "[0, 2]", "[0, 1, 2]",
                                                                 "[1, 2]"],
                         help="Select witch term to use for fitness only distance to ""central point")
+    parser.add_argument("--fitness_raster_resolution", type=float, default=None,
+                        help="If set, the fitness is read from the fitness raster with this resolution "
+                             "(feature units per cell) instead of being computed on the hulls")
+    parser.add_argument("--fitness_raster_bilinear", type=int, default=1, choices=[0, 1],
+                        help="1 bilinear interpolation of the fitness raster, 0 nearest cell")
     return parser
 
 
@@ -18,11 +18,29 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 import math
 
 import numpy as np
-from scipy.spatial import distance
 
-from src.Helpers.Fitness.ValueGraphFitness import get_fitness_value
+from src.Helpers.Fitness.ValueGraphFitness import get_fitness_value, get_fitness_values
 from src.Utils.Point import Point
 
+# index of the direction in the one-hot vector returned by _get_direction, keyed by (diff_x, diff_y)
+DIRECTION_CODES = {(1, -1): 0, (0, -1): 1, (-1, -1): 2, (-1, 0): 3, (-1, 1): 4, (0, 1): 5, (1, 1): 6, (1, 0): 7}
+# DIRECTION_CODES as a table indexed by [diff_x + 1, diff_y + 1], -1 for the differences that are not a step
+DIRECTION_CODES_TABLE = np.full((3, 3), -1, dtype=np.int64)
+for (_diff_x, _diff_y), _code in DIRECTION_CODES.items():
+    DIRECTION_CODES_TABLE[_diff_x + 1, _diff_y + 1] = _code
+# euclidean distance between two different one-hot directions
+DIRECTION_CHANGE_DISTANCE = math.sqrt(2)
+# offsets of the neighbours of a cell, in the order used by list_neighbours
+NEIGHBOURS_X = np.array([-1, 0, 1, 1, 1, 0, -1, -1])
+NEIGHBOURS_Y = np.array([1, 1, 1, 0, -1, -1, -1, 0])
+# position in NEIGHBOURS_X / NEIGHBOURS_Y of every (diff_x, diff_y)
+NEIGHBOURS_DIRECTION = {(int(diff_x), int(diff_y)): direction
+                        for direction, (diff_x, diff_y) in enumerate(zip(NEIGHBOURS_X, NEIGHBOURS_Y))}
+# points below which TrajectoryFeatures.extend_many adds them one by one
+EXTEND_MANY_MIN_POINTS = 24
+# same earth radius used by the haversine package
+AVG_EARTH_RADIUS_KM = 6371.0088
+
 
 def list_neighbours(x_value, y_value, apf, list_already_visited=None):
     """
@@ -33,39 +51,115 @@ def list_neighbours(x_value, y_value, apf, list_already_visited=None):
     :param list_already_visited: list of point already visited
     :return: list of neighbours
     """
-    xx = [x_value - 1, x_value, x_value + 1, x_value + 1, x_value + 1, x_value, x_value - 1, x_value - 1]
-    yy = [y_value + 1, y_value + 1, y_value + 1, y_value, y_value - 1, y_value - 1, y_value - 1, y_value]
-
-    # remove negative values and values outside bounds apf
-    to_erase_x = []
-    for i in range(len(xx) - 1, -1, -1):
-        if xx[i] < 0:
-            to_erase_x.append(i)
-        if xx[i] >= apf[0]:
-            to_erase_x.append(i)
-    to_erase_y = []
-    for i in range(len(yy) - 1, -1, -1):
-        if yy[i] < 0:
-            to_erase_y.append(i)
-        if yy[i] >= apf[1]:
-            to_erase_x.append(i)
-
-    for i in range(len(xx) - 1, -1, -1):
-        erase = False
-        if i in to_erase_x or i in to_erase_y:
-            erase = True
-        if erase:
-            del xx[i]
-            del yy[i]
-
+    visited = None
+    if list_already_visited is not None and len(list_already_visited) > 0:
+        # the cells are integers, comparing them with a set is the same of Point.equals
+        visited = set((p.x, p.y) for p in list_already_visited)
     points = []
-    for i in range(len(xx)):
-        p = Point(xx[i], yy[i])
-        if not is_in_list(list_of_points=list_already_visited, point_to_check=p):
-            points.append(p)
+    for diff_x, diff_y in zip(NEIGHBOURS_X.tolist(), NEIGHBOURS_Y.tolist()):
+        x = x_value + diff_x
+        y = y_value + diff_y
+        # remove negative values and values outside bounds apf
+        if x < 0 or x >= apf[0] or y < 0 or y >= apf[1]:
+            continue
+        if visited is not None and (x, y) in visited:
+            continue
+        points.append(Point(x, y))
     return points
 
 
+def list_neighbour_cells(x_value, y_value, apf, visited=None):
+    """
+    Return the neighbours cells inside the APF and not visited, in the same order of list_neighbours.
+    The cells are flat indexes (x * apf[1] + y), checking if one is visited costs the same for any length of the path
+    :param x_value: x value starting point
+    :param y_value: y value starting point
+    :param apf: shape of the APF
+    :param visited: set of the flat indexes of the cells visited, or boolean array (apf[0] x apf[1] or flat) with
+    the cells visited set to True. None to keep all the neighbours
+    :return: array of flat indexes
+    """
+    xx, yy, _ = list_neighbours_vectorised(x_value=x_value, y_value=y_value, apf=apf)
+    cells = xx * apf[1] + yy
+    if visited is None:
+        return cells
+    if isinstance(visited, np.ndarray):
+        return cells[~visited.reshape(-1)[cells]]
+    return cells[[cell not in visited for cell in cells.tolist()]]
+
+
+def list_neighbours_vectorised(x_value, y_value, apf):
+    """
+    Return all the neighbours cells inside the APF, in the same order of list_neighbours
+    :param x_value: x value starting point
+    :param y_value: y value starting point
+    :param apf: shape of the APF
+    :return: array with the x values, array with the y values and array with the directions of the neighbours
+    (position in NEIGHBOURS_X / NEIGHBOURS_Y)
+    """
+    xx = x_value + NEIGHBOURS_X
+    yy = y_value + NEIGHBOURS_Y
+    inside = (xx >= 0) & (xx < apf[0]) & (yy >= 0) & (yy < apf[1])
+    return xx[inside], yy[inside], np.flatnonzero(inside)
+
+
+def haversine_vectorised(point1, point2):
+    """
+    Same computation of haversine(point1, point2) from the haversine package, on arrays of coordinates
+    :param point1: tuple (array of first coordinates, array of second coordinates)
+    :param point2: tuple (array of first coordinates, array of second coordinates)
+    :return: array of distances in km
+    """
+    lat1 = np.radians(point1[0])
+    lng1 = np.radians(point1[1])
+    lat2 = np.radians(point2[0])
+    lng2 = np.radians(point2[1])
+    lat = lat2 - lat1
+    lng = lng2 - lng1
+    d = np.sin(lat * 0.5) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin(lng * 0.5) ** 2
+    return 2 * AVG_EARTH_RADIUS_KM * np.arcsin(np.sqrt(d))
+
+
+def compute_step_costs(values_matrix):
+    """
+    Length in metres of a step in each of the 8 directions (NEIGHBOURS_X / NEIGHBOURS_Y), for every row of the APF
+
+    The coordinates of the cells are linspaces, so the length of a step only depends on the row
+    (the first coordinate is the one haversine uses as latitude).
+    Steps leaving the APF are nan
+    :param values_matrix: values to translate cells to coordinates
+    :return: matrix rows x 8
+    """
+    x_values = np.asarray(values_matrix[0])
+    y_values = np.asarray(values_matrix[1])
+    rows = x_values.shape[0]
+    # any column works, the middle one has neighbours in both directions
+    column = y_values.shape[0] // 2
+    xs = np.arange(rows)
+    step_costs = np.full((rows, len(NEIGHBOURS_X)), np.nan)
+    for direction in range(len(NEIGHBOURS_X)):
+        next_xs = xs + NEIGHBOURS_X[direction]
+        inside = (next_xs >= 0) & (next_xs < rows)
+        next_ys = np.full(np.count_nonzero(inside), y_values[column + NEIGHBOURS_Y[direction]])
+        ys = np.full(np.count_nonzero(inside), y_values[column])
+        step_costs[inside, direction] = haversine_vectorised((x_values[next_xs[inside]], next_ys),
+                                                             (x_values[xs[inside]], ys)) * 1000  # in metres
+    return step_costs
+
+
+def get_step_cost(step_costs, current_point, next_point):
+    """
+    Length in metres of the step between two neighbour cells
+    :param step_costs: table computed by compute_step_costs
+    :param current_point: current position
+    :param next_point: neighbour cell
+    :return: float length
+    """
+    direction = NEIGHBOURS_DIRECTION[(int(next_point.x) - int(current_point.x),
+                                      int(next_point.y) - int(current_point.y))]
+    return step_costs.item(int(current_point.x), direction)
+
+
 def is_in_list(list_of_points, point_to_check):
     """
     Check if a point is already in the list.
@@ -117,48 +211,184 @@ def _get_direction(current_point, next_point):
         raise Exception("{} and {} not present".format(diff_x, diff_y))
 
 
+def _get_direction_code(current_point, next_point):
+    """
+    From coordinates get the index of the direction used to reach the second point from the first one
+    It is the position of the 1 in the vector returned by _get_direction
+    :param current_point: current position
+    :param next_point: position moved
+    :return: int code of the direction
+    """
+    diff = (int(next_point.x) - int(current_point.x), int(next_point.y) - int(current_point.y))
+    code = DIRECTION_CODES.get(diff)
+    if code is None:
+        raise Exception("{} and {} not present".format(diff[0], diff[1]))
+    return code
+
+
+def _get_direction_codes(xs, ys):
+    """
+    Vectorised version of _get_direction_code for all the steps of a trajectory
+    :param xs: array of x values of the points
+    :param ys: array of y values of the points
+    :return: array of int codes of the directions, one less than the points
+    """
+    return _get_step_codes(diff_x=np.diff(np.asarray(xs, dtype=np.int64)),
+                           diff_y=np.diff(np.asarray(ys, dtype=np.int64)))
+
+
+def _get_step_codes(diff_x, diff_y):
+    """
+    Int codes of the directions of the steps
+    :param diff_x: array of differences of the x values
+    :param diff_y: array of differences of the y values
+    :return: array of int codes of the directions
+    """
+    steps = (np.abs(diff_x) <= 1) & (np.abs(diff_y) <= 1)
+    codes = np.full(len(diff_x), -1, dtype=np.int64)
+    codes[steps] = DIRECTION_CODES_TABLE[diff_x[steps] + 1, diff_y[steps] + 1]
+    if (codes < 0).any():
+        wrong = np.flatnonzero(codes < 0)[0]
+        raise Exception("{} and {} not present".format(diff_x[wrong], diff_y[wrong]))
+    return codes
+
+
+class TrajectoryFeatures(object):
+    """
+    Features of a trajectory kept up to date point after point.
+    Adding a point costs O(1) and the features are the same computed by compute_fintess_trajectory
+    (length, curliness and further distance), without walking the trajectory again
+    """
+    __slots__ = ['start', 'last', 'steps', 'direction', 'direction_changes', 'further_distance']
+
+    def __init__(self, start):
+        self.start = start
+        self.last = start
+        self.steps = 0
+        self.direction = None
+        # every change of direction adds sqrt(2) to the curliness sum
+        self.direction_changes = 0
+        # max cityblock distance from the start, excluding the first and the last point
+        self.further_distance = 0
+
+    def extend(self, point):
+        """
+        Return the features of the trajectory with the point added at the end
+        :param point: next point of the trajectory
+        :return: new TrajectoryFeatures, the current one is not modified
+        """
+        new_features = TrajectoryFeatures(start=self.start)
+        new_features.last = point
+        new_features.steps = self.steps + 1
+        new_features.direction = _get_direction_code(current_point=self.last, next_point=point)
+        new_features.direction_changes = self.direction_changes
+        new_features.further_distance = self.further_distance
+        if self.steps > 0:
+            if new_features.direction != self.direction:
+                new_features.direction_changes += 1
+            # the previous last point is now an internal point of the trajectory
+            new_features.further_distance = max(self.further_distance,
+                                                abs(self.last.x - self.start.x) + abs(self.last.y - self.start.y))
+        return new_features
+
+    def extend_many(self, xs, ys):
+        """
+        Return the features of the trajectory with many points added at the end, same of calling extend for every
+        point
+        :param xs: array of x values of the points
+        :param ys: array of y values of the points
+        :return: new TrajectoryFeatures, the current one is not modified
+        """
+        if len(xs) < EXTEND_MANY_MIN_POINTS:
+            # numpy does not pay off for few points
+            new_features = self
+            for x, y in zip(np.asarray(xs).tolist(), np.asarray(ys).tolist()):
+                new_features = new_features.extend(point=Point(x, y))
+            return new_features
+        codes = _get_direction_codes(xs=np.concatenate(([self.last.x], xs)), ys=np.concatenate(([self.last.y], ys)))
+        new_features = TrajectoryFeatures(start=self.start)
+        new_features.last = Point(int(xs[-1]), int(ys[-1]))
+        new_features.steps = self.steps + len(xs)
+        new_features.direction = int(codes[-1])
+        new_features.direction_changes = self.direction_changes + int(np.count_nonzero(codes[1:] != codes[:-1]))
+        new_features.further_distance = self.further_distance
+        # the points becoming internal points of the trajectory
+        internal_xs = np.asarray(xs[:-1], dtype=np.int64)
+        internal_ys = np.asarray(ys[:-1], dtype=np.int64)
+        if self.steps > 0:
+            if codes[0] != self.direction:
+                new_features.direction_changes += 1
+            internal_xs = np.concatenate(([self.last.x], internal_xs))
+            internal_ys = np.concatenate(([self.last.y], internal_ys))
+        if len(internal_xs) > 0:
+            new_features.further_distance = max(self.further_distance, int(np.max(
+                np.abs(internal_xs - self.start.x) + np.abs(internal_ys - self.start.y))))
+        return new_features
+
+    def get_length(self):
+        return self.steps + 1
+
+    def get_curliness(self):
+        """
+        Mean of the distances between consecutive directions
+        :return: curliness
+        """
+        if self.steps < 2:
+            return 0.0
+        return self.direction_changes * DIRECTION_CHANGE_DISTANCE / (self.steps - 1)
+
+    def get_fitness(self):
+        """
+        Fitness of the trajectory, same value of the first output of compute_fintess_trajectory
+        :return: fitness value
+        """
+        out, _, _, _ = get_fitness_value(length=self.get_length(), curliness=self.get_curliness(),
+                                         further_distance=self.further_distance)
+        return out
+
+
 def compute_fintess_trajectory(tra_moved_so_far):
     """
     Compute the fitness of the path moved so far
     :param tra_moved_so_far: list of points moved till now
     :return:
     """
+    return compute_fintess_trajectory_vectorised(
+        tra_moved_so_far=np.array([[p.x, p.y] for p in tra_moved_so_far]).reshape(-1, 2))
+
+
+def compute_fintess_trajectory_vectorised(tra_moved_so_far):
+    """
+    Compute the fitness of the path moved so far, given as array.
+    The directions are the codes of the steps (np.diff and DIRECTION_CODES_TABLE): two different one-hot directions
+    are always sqrt(2) apart, so the curliness is the mean of sqrt(2) for every change of direction
+    :param tra_moved_so_far: array N x 2 with the x and y values of the points moved till now
+    :return: fitness, [total length, curliness, further distance, distance to middle point, distance to end point]
+    """
+    tra_moved_so_far = np.asarray(tra_moved_so_far)
     # now I have trajectory and direction, need to compute the fitness
     # as distance I am using the number of timesteps of the trajectories
     total_length = len(tra_moved_so_far)
-    directions = [_get_direction(current_point=tra_moved_so_far[ii - 1], next_point=tra_moved_so_far[ii])
-                  for ii in range(1, len(tra_moved_so_far))]
+    directions = _get_direction_codes(xs=tra_moved_so_far[:, 0], ys=tra_moved_so_far[:, 1])
     # compute the curliness of the tra
-    distances = [distance.euclidean(directions[j - 1], directions[j]) for j in range(1, len(directions))]
-    if len(distances) > 0:
-        curliness = np.mean(np.array(distances))
-        if np.isnan(curliness):
-            curliness = 0.0
+    if len(directions) > 1:
+        curliness = np.mean(np.where(directions[1:] != directions[:-1], DIRECTION_CHANGE_DISTANCE, 0.0))
     else:
         curliness = 0.0
-    vector_distances = []
-    if len(tra_moved_so_far) > 0:
-        starting_point = [tra_moved_so_far[0].x, tra_moved_so_far[0].y]
-        # compute distance to further point
-        vector_distances = [distance.cityblock(starting_point, [tra_moved_so_far[idx].x, tra_moved_so_far[idx].y]) for
-                            idx
-                            in range(1, len(tra_moved_so_far) - 1)]
-
-    if len(vector_distances) > 0:
-        further_distance_to_point = max(vector_distances)
-    else:
-        further_distance_to_point = 0
 
+    further_distance_to_point = 0
     distance_to_middle_point = 0
     distance_to_end_point = 0
-    if len(tra_moved_so_far) > 0:
-        starting_point = [tra_moved_so_far[0].x, tra_moved_so_far[0].y]
+    if total_length > 0:
+        # cityblock distances from the starting point
+        vector_distances = np.abs(tra_moved_so_far - tra_moved_so_far[0]).sum(axis=1)
+        # compute distance to further point
+        if total_length > 2:
+            further_distance_to_point = vector_distances[1:-1].max()
         # compute distance to middle point
-        middle_point = tra_moved_so_far[int(len(tra_moved_so_far) / 2)]
-        distance_to_middle_point = distance.cityblock(starting_point, [middle_point.x, middle_point.y])
+        distance_to_middle_point = vector_distances[int(total_length / 2)]
         # compute distance to end
-        end_point = tra_moved_so_far[len(tra_moved_so_far) - 1]
-        distance_to_end_point = distance.cityblock(starting_point, [end_point.x, end_point.y])
+        distance_to_end_point = vector_distances[-1]
 
     out, _, _, _ = get_fitness_value(length=total_length, curliness=curliness,
                                      further_distance=further_distance_to_point)
@@ -166,7 +396,57 @@ def compute_fintess_trajectory(tra_moved_so_far):
     return out, [total_length, curliness, further_distance_to_point, distance_to_middle_point, distance_to_end_point]
 
 
-def compute_charge_points(genome, current_position, K, pre_matrix):
+def compute_fintess_trajectories(coordinates, offsets, point_distance=None):
+    """
+    Compute the fitness of many trajectories at once, same values of compute_fintess_trajectory_vectorised for every
+    trajectory. The trajectories are concatenated: the i-th is coordinates[offsets[i]:offsets[i + 1]]
+    :param coordinates: array M x 2 with the x and y values of the points of all the trajectories
+    :param offsets: array with the position of the first point of every trajectory, followed by M
+    :param point_distance: terms using the distance to the central point. If None, args.point_distance is used
+    :return: array of fitness values, array trajectories x 5 with [total length, curliness, further distance,
+    distance to middle point, distance to end point] of every trajectory
+    """
+    coordinates = np.asarray(coordinates).reshape(-1, 2)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    total_lengths = np.diff(offsets)
+    starts = offsets[:-1]
+    not_empty = total_lengths > 0
+    # trajectory of every point
+    trajectory = np.repeat(np.arange(len(total_lengths)), total_lengths)
+
+    # the steps between the last point of a trajectory and the first of the next one are not steps
+    inside = trajectory[1:] == trajectory[:-1]
+    points = coordinates.astype(np.int64)
+    directions = _get_step_codes(diff_x=np.diff(points[:, 0])[inside], diff_y=np.diff(points[:, 1])[inside])
+    step_trajectory = trajectory[1:][inside]
+    same_trajectory = step_trajectory[1:] == step_trajectory[:-1]
+    changes = np.where(directions[1:] != directions[:-1], DIRECTION_CHANGE_DISTANCE, 0.0)[same_trajectory]
+    number_changes = np.maximum(total_lengths - 2, 0)
+    changes_offsets = np.concatenate(([0], np.cumsum(number_changes)))
+    curliness = np.zeros(len(total_lengths), dtype=np.float64)
+    # np.mean of every trajectory: its pairwise sum gives the same last digits of the single trajectory
+    for i in np.flatnonzero(number_changes > 0).tolist():
+        curliness[i] = np.mean(changes[changes_offsets[i]:changes_offsets[i + 1]])
+
+    # cityblock distances from the starting point of the trajectory
+    vector_distances = np.abs(coordinates - coordinates[starts[trajectory]]).sum(axis=1)
+    internal = np.ones(len(coordinates), dtype=bool)
+    internal[starts[not_empty]] = False
+    internal[offsets[1:][not_empty] - 1] = False
+    further_distances = np.zeros(len(total_lengths), dtype=vector_distances.dtype)
+    np.maximum.at(further_distances, trajectory[internal], vector_distances[internal])
+    distances_to_middle_point = np.zeros(len(total_lengths), dtype=vector_distances.dtype)
+    distances_to_middle_point[not_empty] = vector_distances[starts[not_empty] + total_lengths[not_empty] // 2]
+    distances_to_end_point = np.zeros(len(total_lengths), dtype=vector_distances.dtype)
+    distances_to_end_point[not_empty] = vector_distances[offsets[1:][not_empty] - 1]
+
+    out, _, _, _ = get_fitness_values(lengths=total_lengths, curliness=curliness, further_distances=further_distances,
+                                      point_distance=point_distance)
+    return out, np.stack((total_lengths, curliness, further_distances, distances_to_middle_point,
+                          distances_to_end_point), axis=1)
+
+
+def compute_charge_points(genome, current_position, K, pre_matrix, charge_field=None):
     """
     Compute the attraction of the points
     :param genome: genome
@@ -175,8 +455,14 @@ def compute_charge_points(genome, current_position, K, pre_matrix):
     :param current_position: current position
     :param K: constant for the computation of the charge
     :param pre_matrix: pre computation of distance from the cell to the objects
+    :param charge_field: charge field of the genome (ChargeField or ChargeMemo). If given, the charge is read from it
     :return: total charge
     """
+    if charge_field is not None:
+        total_charge = charge_field.get_charge(x=current_position.x, y=current_position.y)
+        # cells outside the road cells of the charge field are computed as usual
+        if total_charge is not None:
+            return total_charge
     # now prematrix is the cell system optimised
     # start_time = time.time()
     total_charge = pre_matrix.return_charge_from_point(current_position=current_position, genome=genome, K=K)
@@ -186,17 +472,16 @@ def compute_charge_points(genome, current_position, K, pre_matrix):
     return total_charge
 
 
-def keep_only_points_on_street(apf, points):
+def keep_only_points_on_street(road_mask, points):
     """
     Check if the points provided are on a route
-    :param apf: Dataframe describing the routing system
+    :param road_mask: RoadMask of the routing system
     :param points: list of points to check
     :return: list of points from the input list that are actually on a route
     """
     points_on_street = []
     for p in points:
-        # print("{}-{} -> {}".format(int(p.x), int(p.y), apf.iloc[int(p.x)][int(p.y)]))
-        if apf.iloc[int(p.x)][int(p.y)] != 0:
+        if road_mask.is_road(int(p.x), int(p.y)):
             points_on_street.append(p)
     return points_on_street
 